@@ -1,19 +1,32 @@
 #!/usr/bin/env python3
 
-"""This module creates BaselineModels for the Spotify MPD Playlist Challenge."""
+"""
+This module creates BaselineModels for the Spotify MPD Playlist Challenge.
+
+Only NumPy and pandas are imported at module load. A model built once from DataFrames can be
+saved with save_snapshot and reopened with BaselineModels.load_snapshot, which memory-maps the
+indexes instead of rebuilding them, so scripts and worker processes start in well under a second.
+
+Usage (build a snapshot):
+    python3 baselinemodels.py ../data/tracks_2017.csv --playlists ../data/playlists_2017.csv --out ../data/snapshot
+"""
 
 # ---------- Imports ---------- #
-import random
 import os
 import csv
-
-from tqdm import tqdm
-tqdm.pandas()
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 
-import tensorflow as tf
+import clean_raw_data
+import instrumentation
+from trackstore import TrackStore
+from embedding_index import EmbeddingIndex
+from cooccurrence import CooccurrenceIndex
+from title_index import TitleIndex
 
 
 # ---------- BaselineModels Class ---------- #
@@ -22,17 +35,98 @@ class BaselineModels:
     """This class offers naive baseline recommendation behavior to compare
     machine learning based recommendations against."""
 
-    def __init__(self, playlist_df, track_df):
+    # Strategy names accepted by recommend_batch
+    BATCH_STRATEGIES = ['artists', 'albums', 'popular']
+
+    def __init__(self, playlist_df, track_df, seed=None, track_store=None):
 
         # Save arguments
         self.playlist_df = playlist_df
         self.track_df = track_df
-        self.playlist_dict, self.track_dict = self.playlist_df.to_dict(), self.track_df.to_dict()
+
+        # Random generator for all random picks; pass `seed` for reproducible recommendations
+        self.rng = np.random.default_rng(seed)
+
+        # Track IDs and artist/album indexes used by the recommenders
+        self.build_indexes()
+
+        # Optional memory-mapped metadata store (a TrackStore or its directory) behind get_track_feature
+        self.track_store = None
+        if track_store is not None:
+            self.attach_track_store(track_store)
+
+        # Optional EmbeddingIndex / CooccurrenceIndex behind recommend_tracks_by_embeddings / _by_cooccurrence
+        self.embedding_index = None
+        self.cooccurrence_index = None
+
+        # Optional TitleIndex behind recommend_tracks_by_title
+        self.title_index = None
+
+        # Directory the indexes were loaded from by load_snapshot (None when built from DataFrames)
+        self.snapshot_directory = None
+
+
+    def build_indexes(self, pop_col_name='popularity'):
+        """
+        Assign every track in track_df a dense integer ID (its row position) and build
+        artist -> tracks and album -> tracks indexes, each group's tracks sorted by
+        descending `pop_col_name`. Rerun whenever track_df or its popularity changes.
+        """
+
+        self.track_uris = self.track_df.index.to_numpy()
+        self.track_uri_index = pd.Index(self.track_uris)
+        if not self.track_uri_index.is_unique:
+            raise ValueError('track_df must be indexed by unique track URIs.')
+
+        # Tracks without a popularity value yet keep their track_df order
+        if pop_col_name in self.track_df.columns:
+            self.popularity = np.nan_to_num(self.track_df[pop_col_name].to_numpy(dtype=float))
+        else:
+            self.popularity = np.zeros(len(self.track_uris))
+
+        # Global ranking is computed on first use
+        self._popularity_ranking = None
+
+        self.indexes = {}
+        for kind in ['artist', 'album']:
+            group_codes, group_uris = pd.factorize(self.track_df[kind + '_uri'])
+            self.indexes[kind] = TrackGroupIndex(group_codes, group_uris.to_numpy(), self.popularity)
+
+
+    def popularity_ranking(self):
+        """
+        Return all track IDs ordered by descending popularity (ties in track_df order).
+        Cached until build_indexes runs again, e.g. after calculate_track_popularities.
+        """
+        if self._popularity_ranking is None:
+            instrumentation.count('cache_requests_total', cache='popularity_ranking', result='miss')
+            self._popularity_ranking = np.argsort(-self.popularity, kind='stable')
+        else:
+            instrumentation.count('cache_requests_total', cache='popularity_ranking', result='hit')
+        return self._popularity_ranking
+
+
+    def attach_track_store(self, track_store):
+        """
+        Serve track features from a TrackStore (or the directory of one) built from this model's
+        track_df, so that its track IDs match the model's. See also build_track_store.
+        """
+        if not isinstance(track_store, TrackStore):
+            track_store = TrackStore(track_store)
+        if len(track_store) != len(self.track_uris):
+            raise ValueError(f'TrackStore has {len(track_store)} tracks, the model has {len(self.track_uris)}.')
+        self.track_store = track_store
+
+
+    def build_track_store(self, directory):
+        """Write this model's track_df to a TrackStore in `directory` and serve track features from it."""
+        self.attach_track_store(TrackStore.build(directory, self.track_df))
 
 
     def get_track_feature(self, uri, feature='track_name'):
         """
         Given a track uri (as a string) and the track dictionary, return the requested feature.
+        Reads from the track store when one is attached, otherwise from track_df.
         
         Features include:
             - 'track_name'
@@ -43,266 +137,795 @@ class BaselineModels:
             - 'duration_ms'
         """
         try:
+            if self.track_store is not None:
+                track_id = self.track_store.track_id(uri)
+                if track_id < 0:
+                    raise KeyError(uri)
+                return self.track_store.get(track_id, feature)
             return self.track_df[feature][uri]
         except Exception as e:
             return e
 
 
-    def calculate_track_popularities(self, pop_col_name='popularity'):
-        """Create counts of song appearances in playlists and save in a new column with value of <pop_col> parameter."""
+    def get_track_features(self, track_ids, fields=('track_name', 'artist_name')):
+        """
+        Return a DataFrame with the requested `fields` (see get_track_feature, plus 'track_uri')
+        for an array of track IDs, e.g. the output of recommend_batch(..., return_ids=True): 2-D
+        arrays are flattened row by row, and the -1 padding IDs give rows of NaN / None.
+        """
+        track_ids = np.ravel(np.asarray(track_ids, dtype=np.int64))
+        if self.track_store is not None:
+            return self.track_store.get_many(track_ids, fields)
 
-        # Local copy to work with
-        track_df = self.track_df
+        # Look up the valid IDs only, then spread them back over every row
+        valid = np.flatnonzero(track_ids >= 0)
+        features = self.track_df.iloc[track_ids[valid]].reset_index()[list(fields)]
+        features.index = valid
+        features = features.reindex(np.arange(len(track_ids)))
+        features.index = track_ids
+        return features
 
-        # Columns in playlist_df with track URIs
-        track_uri_cols = [col for col in self.playlist_df.columns
-                            if 'uri' in col
-                            and 'album' not in col
-                            and 'artist' not in col]
 
-        # Use dictionary to hold song appearances
-        track_counts_dict = {}
-        for col in track_uri_cols:
-            for uri in self.playlist_df[col].tolist():
-                if uri not in track_counts_dict.keys():
-                    track_counts_dict.update({uri: 1})
-                else:
-                    track_counts_dict.update({uri: track_counts_dict.get(uri) + 1})
+    @instrumentation.instrumented('calculate_track_popularities')
+    def calculate_track_popularities(self, pop_col_name='popularity', playlist_tracks_df=None, playlist_store=None):
+        """
+        Create counts of song appearances in playlists and save in a new column with value of <pop_col> parameter.
 
-        # Add dictionary values to track_df
-        track_df.reset_index(inplace=True)
-        track_df['appears_in_count'] = track_df.reset_index(drop=True).apply(lambda row: int(track_counts_dict.get(row.track_uri, 0)), axis=1)
-        track_df.set_index('track_uri', inplace=True)
+        Album and artist popularities (appearances of any of their songs) are computed in the
+        same pass and saved as Series in self.album_popularity and self.artist_popularity.
 
-        # Update self.track_df
-        self.track_df = track_df
+        By default only the track_N_uri columns of playlist_df (the first songs of each playlist)
+        are counted. Pass the MPD tracks table, with one row per playlist song and a track_uri
+        column, as `playlist_tracks_df`, or a PlaylistStore as `playlist_store`, to count over
+        full playlists instead.
+        """
 
+        if self.track_df is None:
+            raise ValueError('Models loaded from a snapshot have no track_df; rebuild the snapshot instead.')
 
-    def recommend_tracks_by_artists(self, num_tracks=5, input_track_uris=[], popularity=True):
+        if playlist_store is not None:
+            # Count per store track ID, then map store IDs to track IDs once per distinct track
+            store_counts = playlist_store.counts('tracks')
+            store_track_ids = self.track_uri_index.get_indexer(playlist_store.uris('tracks').decode(np.arange(len(store_counts))))
+            known = store_track_ids >= 0
+            track_counts = np.bincount(store_track_ids[known], weights=store_counts[known],
+                                       minlength=len(self.track_uris)).astype(np.int64)
+        else:
+            if playlist_tracks_df is None:
+                # Columns in playlist_df with track URIs
+                track_uri_cols = [col for col in self.playlist_df.columns
+                                    if 'uri' in col
+                                    and 'album' not in col
+                                    and 'artist' not in col]
+
+                # Stack all track URI columns into one array
+                uris = self.playlist_df[track_uri_cols].to_numpy().ravel()
+            else:
+                uris = playlist_tracks_df['track_uri'].to_numpy()
+
+            # Convert to track IDs; padding and songs not in track_df become -1 and are dropped
+            track_ids = self.track_uri_index.get_indexer(uris)
+            track_counts = np.bincount(track_ids[track_ids >= 0], minlength=len(self.track_uris))
+            instrumentation.count('rows_scanned_total', len(uris), method='calculate_track_popularities')
+
+        # Count appearances per track, album and artist
+        self.track_df[pop_col_name] = track_counts
+
+        for kind in ['artist', 'album']:
+            index = self.indexes[kind]
+            grouped = index.group_codes >= 0
+            group_counts = np.bincount(index.group_codes[grouped], weights=track_counts[grouped],
+                                       minlength=len(index.group_uris)).astype(np.int64)
+            setattr(self, f'{kind}_popularity', pd.Series(group_counts, index=index.group_uris))
+
+        # Re-sort the artist/album indexes by the new popularity
+        self.build_indexes(pop_col_name)
+
+
+    def load_track_popularities(self, ids_output, pop_col_name='popularity', count='counts'):
+        """
+        Set track, album and artist popularities from the counts merged during ingestion
+        (clean_raw_data.py --encode-ids writes <ids_output>/popularity.npz) instead of counting
+        playlists again. Results are saved like calculate_track_popularities.
+
+        `count` is one of:
+            - 'counts': appearances in full playlists
+            - 'head_counts': appearances among the first tracks_per_playlist songs of each
+              playlist, the same as calculate_track_popularities over playlist_df
+            - 'follower_counts': appearances weighted by the playlist's num_followers
+        """
+
+        if self.track_df is None:
+            raise ValueError('Models loaded from a snapshot have no track_df; rebuild the snapshot instead.')
+        if count not in clean_raw_data.AGGREGATE_COUNTS:
+            raise ValueError(f'Unknown count {count!r}, expected one of {clean_raw_data.AGGREGATE_COUNTS}.')
+
+        totals = clean_raw_data.load_popularity(ids_output)
+        for kind in ['track', 'artist', 'album']:
+            uris = clean_raw_data.UriDictionary.load(os.path.join(ids_output, f'{kind}_uris.txt')).uris
+            counts = totals[f'{kind}_{count}']
+            num_ids = min(len(uris), len(counts))
+            uris, counts = uris[:num_ids], counts[:num_ids]
+
+            if kind == 'track':
+                # Map dictionary IDs to track IDs; tracks never seen in a playlist keep 0
+                track_ids = self.track_uri_index.get_indexer(uris)
+                known = track_ids >= 0
+                track_counts = np.zeros(len(self.track_uris), dtype=np.int64)
+                track_counts[track_ids[known]] = counts[known]
+            else:
+                group_uris = self.indexes[kind].group_uris
+                group_counts = pd.Series(counts, index=uris).reindex(group_uris, fill_value=0)
+                setattr(self, f'{kind}_popularity', group_counts.astype(np.int64))
+
+        self.track_df[pop_col_name] = track_counts
+        self.build_indexes(pop_col_name)
+
+
+    def _seed_track_ids(self, input_track_uris):
+        """Return the track IDs of the input track URIs, skipping URIs not in track_df."""
+
+        # Seed lists are short, so per-URI lookups are faster than one get_indexer call
+        seed_ids = []
+        for uri in input_track_uris:
+            try:
+                seed_ids.append(self.track_uri_index.get_loc(uri))
+            except KeyError:
+                continue
+        return np.array(seed_ids, dtype=np.int64)
+
+
+    def _recommend_from_groups(self, kind, num_tracks, seed_ids, popularity=True, skip_single_track_groups=False,
+                               rng=None):
+        """
+        Recommend track IDs from the artists or albums (`kind`) of the seed tracks.
+
+        Repeatedly picks a random group of a seed track (groups with more seed tracks are
+        picked more often) and recommends its most popular track not yet in the playlist or
+        recommendations. Groups that run out of tracks are dropped, so fewer than `num_tracks`
+        IDs are returned only when every seed group is exhausted.
+        If `popularity` is False, random tracks are drawn instead (see _sample_from_groups).
+        """
+
+        rng = self.rng if rng is None else rng
+        if not popularity:
+            return self._sample_from_groups(kind, num_tracks, seed_ids, skip_single_track_groups, rng)
+
+        index = self.indexes[kind]
+        excluded = set(seed_ids.tolist())
+        recommended_ids = []
+
+        # One entry per seed track, so groups are weighted by their number of seed tracks
+        candidate_groups = [group for group in index.group_codes[seed_ids].tolist() if group >= 0]
+
+        # Position in each group's popularity-ordered tracks to resume searching from
+        next_position = {}
+
+        # Loop costs, recorded when instrumentation is enabled
+        picks, dropped_groups, scanned = 0, 0, 0
+
+        while len(recommended_ids) < num_tracks and candidate_groups:
+
+            # Pick a random artist / album to get songs from
+            picks += 1
+            group = candidate_groups[rng.integers(len(candidate_groups))]
+            group_tracks = index.tracks_of(group)
+
+            # If this group only has one song, pick a different group from the list
+            if skip_single_track_groups and len(group_tracks) == 1:
+                candidate_groups = [g for g in candidate_groups if g != group]
+                dropped_groups += 1
+                continue
+
+            # Walk down the group's tracks in order of popularity
+            position = start_position = next_position.get(group, 0)
+            while position < len(group_tracks) and int(group_tracks[position]) in excluded:
+                position += 1
+            next_position[group] = position + 1
+            scanned += min(position + 1, len(group_tracks)) - start_position
+
+            if position == len(group_tracks):
+                # No songs left to recommend from this group
+                candidate_groups = [g for g in candidate_groups if g != group]
+                dropped_groups += 1
+                continue
+
+            try_song = int(group_tracks[position])
+            recommended_ids.append(try_song)
+            excluded.add(try_song)
+
+        if instrumentation.ENABLED:
+            self._record_group_loop(kind, seed_ids, picks, dropped_groups, scanned, len(recommended_ids))
+
+        return recommended_ids
+
+
+    def _record_group_loop(self, kind, seed_ids, picks, dropped_groups, scanned, num_recommended):
+        """Record the loop costs of one _recommend_from_groups call, keeping the seed sets of the costliest calls."""
+        metrics = instrumentation.METRICS
+        metrics.observe('group_picks_per_call', picks, instrumentation.COUNT_BUCKETS, kind=kind)
+        metrics.count('group_picks_total', picks, kind=kind)
+        metrics.count('groups_dropped_total', dropped_groups, kind=kind)
+        metrics.count('tracks_scanned_total', scanned, kind=kind)
+        # Picks that recommended nothing: re-picks of single-track or exhausted groups
+        metrics.count('group_repicks_total', picks - num_recommended, kind=kind)
+        metrics.record_slowest(f'{kind}_group_picks', picks, lambda: {
+            'seed_track_uris': self.track_uris[seed_ids].tolist(),
+            'recommended': num_recommended,
+            'groups_dropped': dropped_groups,
+            'tracks_scanned': scanned,
+        })
+
+
+    def _sample_from_groups(self, kind, num_tracks, seed_ids, skip_single_track_groups=False, rng=None):
+        """
+        Draw random track IDs, without replacement, from the artists or albums (`kind`) of the seed tracks.
+
+        All tracks of the seed groups form one candidate pool, weighted so that a group is
+        picked in proportion to its number of seed tracks and a track uniformly within its
+        group, as when picking a random group and then a random song by it. Seed tracks are
+        removed from the pool and the recommendations are drawn in one call.
+        """
+
+        rng = self.rng if rng is None else rng
+        index = self.indexes[kind]
+
+        groups = index.group_codes[seed_ids]
+        groups, seed_counts = np.unique(groups[groups >= 0], return_counts=True)
+        group_sizes = index.offsets[groups + 1] - index.offsets[groups]
+
+        # Skip groups with only one song
+        if skip_single_track_groups:
+            keep = group_sizes > 1
+            groups, seed_counts, group_sizes = groups[keep], seed_counts[keep], group_sizes[keep]
+
+        if len(groups) == 0:
+            return []
+
+        pool = np.concatenate([index.tracks_of(group) for group in groups])
+        weights = np.repeat(seed_counts / group_sizes, group_sizes)
+
+        # Remove songs already in the playlist
+        available = ~np.isin(pool, seed_ids)
+        pool, weights = pool[available], weights[available]
+        instrumentation.count('tracks_scanned_total', len(available), kind=kind)
+
+        if len(pool) == 0:
+            return []
+
+        return rng.choice(pool, size=min(num_tracks, len(pool)), replace=False, p=weights / weights.sum()).tolist()
+
+
+    @instrumentation.instrumented('recommend_tracks_by_artists')
+    def recommend_tracks_by_artists(self, num_tracks=5, input_track_uris=[], popularity=True, rng=None):
         """
         Recommend tracks by the same artists as those in input_track_uris.
         If `popularity` is set to True, recommend popular songs by the same artist;
         if False, recommend random songs by the same artist.
+        Artists with a single song are skipped.
+        Random picks use `rng` (a numpy Generator), or the model's generator by default.
         """
-        
-        recommended_track_uris = []
-
-        # Create list of artists presented in input tracks
-        input_artists = []
-        for track_uri in input_track_uris:
-            artist_uri = self.get_track_feature(track_uri, 'artist_uri')
-            input_artists.append(artist_uri)
-
-        # RECOMMENDING SONGS BY POPULARITY
-        if popularity:
-            # Create recommendations by randomly picking an artist
-            # and finding their most popular tracks
-            # that aren't already in the playlist
-            while len(recommended_track_uris) < num_tracks:
-
-                # Pick a random artist to get songs by
-                this_artist = random.choice(input_artists)
-
-                # Find this artist's top songs and save track_uris in a list
-                artist_top_songs = self.track_df.sort_values(by='popularity', ascending=False)
-                artist_top_songs = artist_top_songs[artist_top_songs.artist_uri == this_artist]\
-                                    .reset_index()\
-                                    ['track_uri']\
-                                    .to_list()
-
-                # If this artist only has one song, pick a different artist from the list
-                if len(artist_top_songs) == 1:
-                    continue
-
-                # Loop through in order of popularity and add songs not already in playlist
-                # and not already in recommendation list
-                while True:
-
-                    # Try to pop, if fails then break and pick new artist
-                    try:
-                        try_song = artist_top_songs.pop(0)
-                    except Exception as e:
-                        break
-
-                    if try_song in input_track_uris or try_song in recommended_track_uris:
-                        # If this song is already in the playlist, do nothing
-                        # If there are no more songs left to try to recommend, break without appending
-                        if len(artist_top_songs) == 0:
-                            break
-                    else:
-                        # If not already in playlist, add this song to the recommendations and break
-                        recommended_track_uris.append(try_song)
-                        break
-        
-        # RECOMMENDING ARTIST SONGS RANDOMLY
-        else:
-            # Create recommendations by randomly picking an artist
-            # and recommending a random song by them
-            while len(recommended_track_uris) < num_tracks:
-
-                # Pick a random artist to get songs by
-                this_artist = random.choice(input_artists)
-
-                # Find this artist's songs and save track_uris in a list
-                # If no results found, repeat loop
-                while True:
-                    try:
-                        artist_songs_df = self.track_df[self.track_df.artist_uri == this_artist].reset_index()
-                        break
-                    except Exception as e:
-                        continue
-
-                # If this artist only has one song, pick a different artist from the list
-                if artist_songs_df.shape[0] == 1:
-                    continue
-
-                # Loop until we find a song not already in the playlist
-                attempts = 0
-                while True and attempts <= artist_songs_df.shape[0]:
-                    try_song = artist_songs_df.sample()['track_uri'].iloc[0]
-
-                    if try_song in input_track_uris or try_song in recommended_track_uris:
-                        # If this song is already in the playlist, do nothing.
-                        attempts += 1
-                        pass
-                    else:
-                        # If not already in playlist, add this song to the recommendations and break
-                        recommended_track_uris.append(try_song)
-                        break
+
+        seed_ids = self._seed_track_ids(input_track_uris)
+        recommended_ids = self._recommend_from_groups('artist', num_tracks, seed_ids, popularity,
+                                                      skip_single_track_groups=True, rng=rng)
 
         # Return recommendations
-        return recommended_track_uris
+        return self.track_uris[recommended_ids].tolist()
 
 
-    def recommend_tracks_by_albums(self, num_tracks=5, input_track_uris=[], popularity=True):
+    @instrumentation.instrumented('recommend_tracks_by_albums')
+    def recommend_tracks_by_albums(self, num_tracks=5, input_track_uris=[], popularity=True, rng=None):
         """
         Recommend tracks from the same albums as those in input_track_uris.
         If `popularity` is set to True, recommend popular songs from the same album;
-        if False, recommend random songs from the same album.
-        """
-
-        recommended_track_uris = []
-
-        # Create list of albums presented in input tracks
-        input_albums = []
-        for track_uri in input_track_uris:
-            album_uri = self.get_track_feature(track_uri, 'album_uri')
-            input_albums.append(album_uri)
-
-        # RECOMMENDING SONGS BY POPULARITY
-        if popularity:
-            # Create recommendations by randomly picking an album
-            # and finding its most popular tracks
-            # that aren't already in the playlist
-            while len(recommended_track_uris) < num_tracks:
-
-                # Pick a random album to get songs from
-                this_album = random.choice(input_albums)
-
-                # Find this album's top songs and save track_uris in a list
-                album_top_songs = self.track_df.sort_values(by='popularity', ascending=False)
-                album_top_songs = album_top_songs[album_top_songs.album_uri == this_album]\
-                                    .reset_index()\
-                                    ['track_uri']\
-                                    .to_list()
-
-                # If this artist only has one song, pick a different album from the list
-                # if len(album_top_songs) == 1:
-                #     continue
-
-                # Loop through in order of popularity and add songs not already in playlist
-                while True:
-
-                     # Try to pop, if fails then break and pick new artist
-                    try:
-                        try_song = album_top_songs.pop(0)
-                    except Exception as e:
-                        break
-                    
-                    if len(album_top_songs) == 1 and try_song in recommended_track_uris:
-                        # If there is only one song on the album and it's already in the
-                        # recommended songs, just add it again
-                        recommended_track_uris.append(try_song)
-                        break
-
-                    if try_song in input_track_uris or try_song in recommended_track_uris:
-                        # If this song is already in the playlist, do nothing
-                        # If there are no more songs left to try to recommend, break without appending
-                        if len(album_top_songs) == 0:
-                            break
-                    else:
-                        # If not already in playlist, add this song to the recommendations and break
-                        recommended_track_uris.append(try_song)
-                        break
-        
-        # RECOMMENDING ALBUM SONGS RANDOMLY
-        else:
-            # Create recommendations by randomly picking an album
-            # and recommending a random song from it
-            while len(recommended_track_uris) < num_tracks:
-
-                # Pick a random artist to get songs by
-                this_album = random.choice(input_albums)
-
-                # Find this album's songs and save track_uris in a list
-                # If no results found, repeat loop
-                while True:
-                    try:
-                        album_songs_df = self.track_df[self.track_df.album_uri == this_album].reset_index()
-                        break
-                    except Exception as e:
-                        continue
-
-                # If this album only has one song, pick a different album from the list
-                if album_songs_df.shape[0] == 1:
-                    continue
-
-                # Loop until we find a song not already in the playlist
-                attempts = 0
-                while True and attempts <= album_songs_df.shape[0]:
-                    try:
-                        try_song = album_songs_df.sample()['track_uri'].iloc[0]
-                    except Exception as e:
-                        break
-
-                    if try_song in input_track_uris or try_song in recommended_track_uris:
-                        # If this song is already in the playlist, do nothing.
-                        attempts += 1
-                        pass
-                    else:
-                        # If not already in playlist, add this song to the recommendations and break
-                        recommended_track_uris.append(try_song)
-                        break
+        if False, recommend random songs from the same album (skipping single-song albums).
+        Random picks use `rng` (a numpy Generator), or the model's generator by default.
+        """
+
+        seed_ids = self._seed_track_ids(input_track_uris)
+        recommended_ids = self._recommend_from_groups('album', num_tracks, seed_ids, popularity,
+                                                      skip_single_track_groups=not popularity, rng=rng)
 
         # Return recommendations
-        return recommended_track_uris
+        return self.track_uris[recommended_ids].tolist()
                 
 
+    @instrumentation.instrumented('recommend_popular_tracks')
     def recommend_popular_tracks(self, num_tracks=5, input_track_uris=[], popularity=True):
         """
         Recommend the most popular tracks in our dataset.
         """
 
-        recommended_track_uris = []
-        
-        while len(recommended_track_uris) < num_tracks:
-
-            # Order all songs by popularity and save track_uris to a list
-            pop_songs = self.track_df.\
-                sort_values(by='popularity', ascending=False)\
-                .reset_index()['track_uri']\
-                .to_list()
-
-            # Loop through in order of popularity and add songs not already in playlist
-            while True:
-                try_song = pop_songs.pop(0)
-                if try_song in input_track_uris or try_song in recommended_track_uris:
-                    # If this song is already in the playlist, do nothing
-                    pass
-                else:
-                    # If not already in playlist, add this song to the recommendations and break
-                    recommended_track_uris.append(try_song)
-                    break
+        seed_ids = self._seed_track_ids(input_track_uris)
+        excluded = set(seed_ids.tolist())
+
+        # At most len(seed_ids) of the top tracks can be in the playlist already
+        candidates = self.popularity_ranking()[:num_tracks + len(seed_ids)].tolist()
+        instrumentation.count('tracks_scanned_total', len(candidates), kind='popular')
+        recommended_ids = [track_id for track_id in candidates if track_id not in excluded][:num_tracks]
 
         # Return recommendations
-        return recommended_track_uris
+        return self.track_uris[recommended_ids].tolist()
+
+
+    def attach_embedding_index(self, embedding_index):
+        """Serve recommend_tracks_by_embeddings from an EmbeddingIndex (or the directory of a saved one)."""
+        if not isinstance(embedding_index, EmbeddingIndex):
+            embedding_index = EmbeddingIndex.load(embedding_index)
+        self.embedding_index = embedding_index
+
+
+    @instrumentation.instrumented('recommend_tracks_by_embeddings')
+    def recommend_tracks_by_embeddings(self, num_tracks=5, input_track_uris=[]):
+        """
+        Recommend the tracks whose embeddings (e.g. word2vec track vectors) are closest to the
+        average embedding of input_track_uris, using the attached EmbeddingIndex.
+        """
+        if self.embedding_index is None:
+            raise ValueError('No embedding index attached; see attach_embedding_index.')
+        return self.embedding_index.recommend_tracks(num_tracks, input_track_uris)
+
+
+    def attach_cooccurrence_index(self, cooccurrence_index):
+        """Serve recommend_tracks_by_cooccurrence from a CooccurrenceIndex (or the directory of a saved one)."""
+        if not isinstance(cooccurrence_index, CooccurrenceIndex):
+            cooccurrence_index = CooccurrenceIndex.load(cooccurrence_index)
+        self.cooccurrence_index = cooccurrence_index
+
+
+    @instrumentation.instrumented('recommend_tracks_by_cooccurrence')
+    def recommend_tracks_by_cooccurrence(self, num_tracks=5, input_track_uris=[]):
+        """
+        Recommend the tracks that appear in the most playlists together with the tracks in
+        input_track_uris, using the attached CooccurrenceIndex.
+        """
+        if self.cooccurrence_index is None:
+            raise ValueError('No co-occurrence index attached; see attach_cooccurrence_index.')
+        return self.cooccurrence_index.recommend_tracks(num_tracks, input_track_uris)
+
+
+    def attach_title_index(self, title_index):
+        """Serve recommend_tracks_by_title from a TitleIndex (or the directory of a saved one)."""
+        if not isinstance(title_index, TitleIndex):
+            title_index = TitleIndex.load(title_index)
+        self.title_index = title_index
+
+
+    @instrumentation.instrumented('recommend_tracks_by_title')
+    def recommend_tracks_by_title(self, num_tracks=5, input_track_uris=[], *, name=''):
+        """
+        Recommend tracks for a playlist from its name alone (the cold-start case), using the tracks
+        most common in playlists whose names share its tokens (see TitleIndex). Tracks already in
+        input_track_uris are skipped, and popular tracks fill up when the name matches too little.
+        `name` is keyword-only, after the arguments shared with the other recommend_* methods.
+        """
+        if self.title_index is None:
+            raise ValueError('No title index attached; see attach_title_index.')
+
+        excluded = set(input_track_uris)
+        recommended = [uri for uri in self.title_index.recommend_tracks(num_tracks + len(excluded), name)
+                       if uri not in excluded][:num_tracks]
+
+        if len(recommended) < num_tracks:
+            instrumentation.count('title_fallback_total')
+            fill = self.recommend_popular_tracks(num_tracks, list(excluded.union(recommended)))
+            recommended += fill[:num_tracks - len(recommended)]
+        return recommended
+
+
+    # ---------- Snapshots ---------- #
+
+    def save_snapshot(self, directory):
+        """
+        Save the track IDs, popularity and artist/album indexes to `directory` as .npy files, to be
+        reopened with BaselineModels.load_snapshot. URIs are stored as fixed-width byte strings with
+        their sorted order, so lookups are binary searches over memory-mapped arrays.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        UriIndex.save(os.path.join(directory, 'track'), self.track_uris)
+        np.save(os.path.join(directory, 'popularity.npy'), self.popularity)
+        np.save(os.path.join(directory, 'popularity_ranking.npy'), self.popularity_ranking())
+
+        for kind, index in self.indexes.items():
+            UriIndex.save(os.path.join(directory, kind), index.group_uris)
+            np.save(os.path.join(directory, f'{kind}.group_codes.npy'), index.group_codes)
+            np.save(os.path.join(directory, f'{kind}.tracks.npy'), index.tracks)
+            np.save(os.path.join(directory, f'{kind}.offsets.npy'), index.offsets)
+
+        with open(os.path.join(directory, 'meta.json'), 'w') as file:
+            json.dump({'num_tracks': len(self.track_uris),
+                       'num_groups': {kind: len(index.group_uris) for kind, index in self.indexes.items()}}, file)
+
+
+    @classmethod
+    def load_snapshot(cls, directory, seed=None, track_store=None, embedding_index=None, cooccurrence_index=None,
+                      title_index=None):
+        """
+        Open a snapshot written by save_snapshot. Arrays are memory-mapped, so loading takes
+        milliseconds and processes serving from the same directory share one page-cache copy.
+
+        The model has no playlist_df or track_df: every recommend_* method works, while
+        calculate_track_popularities and get_track_feature (without a track store) do not.
+        Optional stores and indexes are attached as in __init__ and the attach_* methods.
+        """
+
+        model = cls.__new__(cls)
+        model.playlist_df = None
+        model.track_df = None
+        model.rng = np.random.default_rng(seed)
+        model.track_store = None
+        model.embedding_index = None
+        model.cooccurrence_index = None
+        model.title_index = None
+        model._open_snapshot(directory)
+
+        if track_store is not None:
+            model.attach_track_store(track_store)
+        if embedding_index is not None:
+            model.attach_embedding_index(embedding_index)
+        if cooccurrence_index is not None:
+            model.attach_cooccurrence_index(cooccurrence_index)
+        if title_index is not None:
+            model.attach_title_index(title_index)
+        return model
+
+
+    def _open_snapshot(self, directory):
+        self.snapshot_directory = directory
+        self.track_uris = UriIndex(os.path.join(directory, 'track'))
+        self.track_uri_index = self.track_uris
+        self.popularity = _load_mapped(os.path.join(directory, 'popularity.npy'))
+        self._popularity_ranking = _load_mapped(os.path.join(directory, 'popularity_ranking.npy'))
+
+        self.indexes = {}
+        for kind in ['artist', 'album']:
+            self.indexes[kind] = TrackGroupIndex.from_arrays(
+                _load_mapped(os.path.join(directory, f'{kind}.group_codes.npy')),
+                UriIndex(os.path.join(directory, kind)),
+                _load_mapped(os.path.join(directory, f'{kind}.tracks.npy')),
+                _load_mapped(os.path.join(directory, f'{kind}.offsets.npy')))
+
+
+    def __getstate__(self):
+        # Snapshot models are sent to worker processes as their directory and reopened there
+        state = self.__dict__.copy()
+        if self.snapshot_directory is not None:
+            for name in ['track_uris', 'track_uri_index', 'popularity', '_popularity_ranking', 'indexes']:
+                del state[name]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.snapshot_directory is not None and 'indexes' not in state:
+            self._open_snapshot(self.snapshot_directory)
+
+
+    # ---------- Batch Recommendations ---------- #
+
+    @instrumentation.instrumented('recommend_batch')
+    def recommend_batch(self, seed_playlists, strategy='popular', num_tracks=5, popularity=True,
+                        num_workers=1, return_ids=False, rng=None):
+        """
+        Recommend `num_tracks` tracks for each of many seed playlists in one call.
+
+        `seed_playlists` is one of:
+            - a playlist DataFrame with track_N_uri columns (one playlist per row)
+            - a list of lists of seed track URIs
+            - an (offsets, track_ids) pair of arrays: the seed track IDs of playlist i
+              are track_ids[offsets[i]:offsets[i + 1]]
+
+        Ragged track IDs are this model's track IDs (rows of track_df), not the IDs of the URI
+        dictionaries of the ID-encoded tables or a PlaylistStore; convert those with
+        ragged_from_ingest_ids first. IDs outside the model's range raise a ValueError.
+
+        `strategy` is one of BATCH_STRATEGIES and behaves like recommend_tracks_by_artists,
+        recommend_tracks_by_albums or recommend_popular_tracks. 'popular' is fully vectorized;
+        the artist and album strategies are spread over `num_workers` processes.
+
+        Returns a (num_playlists, num_tracks) array of track URIs, padded with None where fewer
+        tracks could be recommended, or of track IDs padded with -1 if `return_ids` is set.
+
+        Random picks use `rng` (a numpy Generator), or the model's generator by default; each
+        worker process gets its own generator seeded from it, so results are reproducible for
+        a given seed and `num_workers`.
+        """
+
+        rng = self.rng if rng is None else rng
+
+        if strategy not in self.BATCH_STRATEGIES:
+            raise ValueError(f'Unknown strategy {strategy!r}, expected one of {self.BATCH_STRATEGIES}.')
+
+        offsets, seed_ids = self._batch_seed_ids(seed_playlists)
+        num_playlists = len(offsets) - 1
+
+        if num_workers > 1 and strategy != 'popular' and num_playlists > 1:
+            # Split playlists into a few chunks per worker; each chunk is sent as its own ragged array
+            bounds = np.linspace(0, num_playlists, min(num_playlists, num_workers * 4) + 1).astype(int)
+            chunk_seeds = rng.integers(2**63, size=len(bounds) - 1)
+            chunks = [(offsets[a:b + 1] - offsets[a], seed_ids[offsets[a]:offsets[b]], strategy, num_tracks, popularity,
+                       chunk_seed)
+                      for a, b, chunk_seed in zip(bounds[:-1], bounds[1:], chunk_seeds)]
+
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_batch_worker,
+                                     initargs=(self,)) as executor:
+                results = list(executor.map(_recommend_batch_chunk, chunks))
+
+            # Workers send back their metrics with each chunk when instrumentation is enabled
+            for _, worker_metrics in results:
+                if worker_metrics is not None:
+                    instrumentation.METRICS.merge(worker_metrics)
+            recommended_ids = np.concatenate([chunk_ids for chunk_ids, _ in results])
+        else:
+            recommended_ids = self._recommend_batch_ids(offsets, seed_ids, strategy, num_tracks, popularity, rng)
+
+        if return_ids:
+            return recommended_ids
+
+        recommended_uris = np.full(recommended_ids.shape, None, dtype=object)
+        found = recommended_ids >= 0
+        recommended_uris[found] = self.track_uris[recommended_ids[found]]
+        return recommended_uris
+
+
+    def _batch_seed_ids(self, seed_playlists):
+        """Convert any seed_playlists input of recommend_batch to (offsets, track_ids) ragged arrays."""
+
+        if isinstance(seed_playlists, tuple):
+            offsets, seed_ids = seed_playlists
+            seed_ids = np.asarray(seed_ids)
+            if len(seed_ids) and (seed_ids.min() < 0 or seed_ids.max() >= len(self.track_uris)):
+                raise ValueError(f'Seed track IDs must be model track IDs in [0, {len(self.track_uris)}); '
+                                 'convert ingest dictionary IDs with ragged_from_ingest_ids.')
+            return np.asarray(offsets, dtype=np.int64), seed_ids
+
+        if isinstance(seed_playlists, pd.DataFrame):
+            # Columns in playlist_df with track URIs
+            track_uri_cols = [col for col in seed_playlists.columns
+                                if 'uri' in col
+                                and 'album' not in col
+                                and 'artist' not in col]
+            uri_matrix = seed_playlists[track_uri_cols].to_numpy()
+            id_matrix = self.track_uri_index.get_indexer(uri_matrix.ravel()).reshape(uri_matrix.shape)
+            known = id_matrix >= 0
+            seed_ids = id_matrix[known]
+            lengths = known.sum(axis=1)
+        else:
+            uris = [uri for playlist in seed_playlists for uri in playlist]
+            row = np.repeat(np.arange(len(seed_playlists)), [len(playlist) for playlist in seed_playlists])
+            all_ids = self.track_uri_index.get_indexer(uris)
+            known = all_ids >= 0
+            seed_ids = all_ids[known]
+            lengths = np.bincount(row[known], minlength=len(seed_playlists))
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return offsets, seed_ids
+
+
+    def ragged_from_ingest_ids(self, offsets, track_ids, ingest_track_uris):
+        """
+        Convert ragged (offsets, track_ids) arrays whose IDs index `ingest_track_uris` (the track
+        UriDictionary of the ID-encoded tables, e.g. PlaylistStore.uris(), or its list of URIs) to
+        this model's track IDs, for recommend_batch. Tracks not in the model are dropped.
+
+            model.recommend_batch(model.ragged_from_ingest_ids(*store.ragged(), store.uris()))
+        """
+        if isinstance(ingest_track_uris, clean_raw_data.UriDictionary):
+            ingest_track_uris = ingest_track_uris.uris
+        mapping = np.asarray(self.track_uri_index.get_indexer(ingest_track_uris), dtype=np.int64)
+
+        model_ids = mapping[np.asarray(track_ids)]
+        known = model_ids >= 0
+        kept_before = np.zeros(len(known) + 1, dtype=np.int64)
+        np.cumsum(known, out=kept_before[1:])
+        return kept_before[np.asarray(offsets, dtype=np.int64)], model_ids[known]
+
+
+    def _recommend_batch_ids(self, offsets, seed_ids, strategy, num_tracks, popularity=True, rng=None):
+        """Serial core of recommend_batch: return a (num_playlists, num_tracks) track ID array padded with -1."""
+
+        if strategy == 'popular':
+            return self._recommend_popular_batch(offsets, seed_ids, num_tracks)
+
+        kind = 'artist' if strategy == 'artists' else 'album'
+        skip_single_track_groups = strategy == 'artists' or not popularity
+
+        recommended_ids = np.full((len(offsets) - 1, num_tracks), -1, dtype=np.int64)
+        for row in range(len(offsets) - 1):
+            row_ids = self._recommend_from_groups(kind, num_tracks, seed_ids[offsets[row]:offsets[row + 1]],
+                                                  popularity, skip_single_track_groups, rng)
+            recommended_ids[row, :len(row_ids)] = row_ids
+        return recommended_ids
+
+
+    def _recommend_popular_batch(self, offsets, seed_ids, num_tracks, chunk_size=4096):
+        """
+        Recommend the most popular tracks not in each seed playlist, for all playlists at once.
+
+        Each playlist's candidates are the top (num_tracks + longest seed list) tracks, which is
+        always enough; seed tracks are masked out with one vectorized membership test per chunk.
+        """
+
+        ranking = self.popularity_ranking()
+
+        num_playlists = len(offsets) - 1
+        lengths = np.diff(offsets)
+        recommended_ids = np.full((num_playlists, num_tracks), -1, dtype=np.int64)
+        if num_playlists == 0:
+            return recommended_ids
+
+        candidates = ranking[:num_tracks + int(lengths.max())]
+        num_ids = len(self.track_uris)
+
+        for start in range(0, num_playlists, chunk_size):
+            stop = min(start + chunk_size, num_playlists)
+            rows = np.arange(start, stop)
+
+            # Encode (playlist, track) pairs as single integers so membership is one np.isin call
+            seed_rows = np.repeat(rows, lengths[start:stop])
+            seed_keys = seed_rows * num_ids + seed_ids[offsets[start]:offsets[stop]]
+            candidate_keys = rows[:, None] * num_ids + candidates[None, :]
+            is_seed = np.isin(candidate_keys, seed_keys)
+            instrumentation.count('tracks_scanned_total', candidate_keys.size, kind='popular_batch')
+
+            # Stable sort puts each row's non-seed candidates first, still in popularity order
+            first_free = np.argsort(is_seed, axis=1, kind='stable')[:, :num_tracks]
+            chunk_ids = candidates[first_free]
+            chunk_ids[np.take_along_axis(is_seed, first_free, axis=1)] = -1
+            recommended_ids[start:stop, :chunk_ids.shape[1]] = chunk_ids
+
+        return recommended_ids
+
+
+# ---------- Batch Worker Processes ---------- #
+
+# Model used by recommend_batch worker processes, set once per process by _init_batch_worker
+_batch_model = None
+
+
+def _init_batch_worker(model):
+    global _batch_model
+    _batch_model = model
+
+
+def _recommend_batch_chunk(args):
+    offsets, seed_ids, strategy, num_tracks, popularity, chunk_seed = args
+    recommended_ids = _batch_model._recommend_batch_ids(offsets, seed_ids, strategy, num_tracks, popularity,
+                                                        np.random.default_rng(chunk_seed))
+    return recommended_ids, instrumentation.METRICS.drain() if instrumentation.ENABLED else None
+
+
+# ---------- Track Group Index ---------- #
+
+class TrackGroupIndex:
+    """
+    Inverted index from groups of tracks (artists or albums) to their track IDs.
+
+    Stored CSR-style: the tracks of group g are tracks[offsets[g]:offsets[g + 1]],
+    sorted by descending popularity. group_codes[track_id] is the group of a track
+    (-1 if it has none) and group_uris[g] is the URI of group g.
+    """
+
+    def __init__(self, group_codes, group_uris, popularity):
+
+        self.group_codes = np.asarray(group_codes, dtype=np.int32)
+        self.group_uris = group_uris
+
+        # Sort tracks by group, then by descending popularity within each group
+        track_ids = np.flatnonzero(self.group_codes >= 0)
+        order = np.lexsort((-popularity[track_ids], self.group_codes[track_ids]))
+        self.tracks = track_ids[order].astype(np.int32)
+
+        group_sizes = np.bincount(self.group_codes[track_ids], minlength=len(group_uris))
+        self.offsets = np.zeros(len(group_uris) + 1, dtype=np.int64)
+        np.cumsum(group_sizes, out=self.offsets[1:])
+
+
+    def tracks_of(self, group):
+        """Return the track IDs of `group`, most popular first (a view, not a copy)."""
+        return self.tracks[self.offsets[group]:self.offsets[group + 1]]
+
+
+    @classmethod
+    def from_arrays(cls, group_codes, group_uris, tracks, offsets):
+        """Create an index from already sorted arrays, e.g. memory-mapped from a snapshot."""
+        index = cls.__new__(cls)
+        index.group_codes = group_codes
+        index.group_uris = group_uris
+        index.tracks = tracks
+        index.offsets = offsets
+        return index
+
+
+# ---------- URI Index ---------- #
+
+def _load_mapped(filepath):
+    """
+    Memory-map a .npy file as a plain ndarray. Slicing an np.memmap creates another memmap
+    object, which costs more than the slice itself in the per-track loops of the recommenders.
+    """
+    return np.asarray(np.load(filepath, mmap_mode='r'))
+
+
+class UriIndex:
+    """
+    Memory-mapped replacement for the pd.Index of URIs used by BaselineModels, read from a snapshot.
+
+    URIs are a fixed-width byte string array in ID order plus the order that sorts them, so
+    get_loc / get_indexer are binary searches and indexing with IDs returns URI strings,
+    without building a Python object per URI at load time.
+    """
+
+    def __init__(self, path_prefix):
+        self.uris = _load_mapped(path_prefix + '.uris.npy')
+        self.order = _load_mapped(path_prefix + '.uri_order.npy')
+
+
+    def __len__(self):
+        return len(self.uris)
+
+
+    def __getitem__(self, ids):
+        """URI of an ID, or an object array of URIs for an array (or list) of IDs."""
+        if np.isscalar(ids):
+            return self.uris[ids].decode('utf-8')
+        return np.char.decode(self.uris[np.asarray(ids, dtype=np.int64)], 'utf-8').astype(object)
+
+
+    def get_indexer(self, uris):
+        """Return the ID of each URI, with -1 for URIs (or padding values) not in the index."""
+        encoded = np.array([uri.encode('utf-8') if isinstance(uri, str) else b'' for uri in uris], dtype=bytes)
+        if len(self.uris) == 0 or len(encoded) == 0:
+            return np.full(len(encoded), -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(self.uris, encoded, sorter=self.order), len(self.uris) - 1)
+        ids = np.asarray(self.order[positions], dtype=np.int64)
+        return np.where((self.uris[ids] == encoded) & (encoded != b''), ids, -1)
+
+
+    def get_loc(self, uri):
+        """Return the ID of one URI, or raise KeyError like pd.Index.get_loc."""
+        track_id = int(self.get_indexer([uri])[0])
+        if track_id < 0:
+            raise KeyError(uri)
+        return track_id
+
+
+    @staticmethod
+    def save(path_prefix, uris):
+        encoded = np.array([str(uri).encode('utf-8') for uri in uris], dtype=bytes)
+        np.save(path_prefix + '.uris.npy', encoded)
+        np.save(path_prefix + '.uri_order.npy', np.argsort(encoded, kind='stable').astype(np.int64))
+
+
+# Running from Command Line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a BaselineModels snapshot for fast loading.')
+    parser.add_argument('track_table', help='unique track CSV indexed by track_uri (e.g. tracks_2017.csv)')
+    parser.add_argument('--playlists', default=None,
+                        help='playlist table (file or directory of slices) whose track_N_uri columns give popularity')
+    parser.add_argument('--playlist-store', default=None, help='PlaylistStore directory to count full playlists from')
+    parser.add_argument('--aggregates', default=None,
+                        help='ids directory of clean_raw_data.py --encode-ids; popularity comes from its popularity.npz')
+    parser.add_argument('--count', choices=clean_raw_data.AGGREGATE_COUNTS, default='counts',
+                        help='popularity count to use with --aggregates')
+    parser.add_argument('--out', default='../data/snapshot', help='directory to save the snapshot to')
+    args = parser.parse_args()
+
+    track_df = pd.read_csv(args.track_table, index_col='track_uri')
+    playlist_df = clean_raw_data.load_mpd_table(args.playlists, index_col='pid') if args.playlists else pd.DataFrame()
+    model = BaselineModels(playlist_df, track_df)
+
+    if args.aggregates:
+        model.load_track_popularities(args.aggregates, count=args.count)
+    elif args.playlist_store:
+        from playliststore import PlaylistStore
+        model.calculate_track_popularities(playlist_store=PlaylistStore(args.playlist_store))
+    elif args.playlists:
+        model.calculate_track_popularities()
+
+    model.save_snapshot(args.out)
+    print(f"Snapshot of {len(model.track_uris)} tracks saved to {args.out}")
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+This script benchmarks the ingestion pipeline and the BaselineModels recommenders
+on synthetic MPD-shaped data.
+
+Usage:
+    python3 benchmarks.py [--slices N] [--playlists-per-slice N] [--catalog-size N] [--output results.json]
+
+Synthetic slice JSON files are generated with Zipfian track popularity, then the script times:
+
+- parse_spotify_mpd_json_to_csv, per slice
+- BaselineModels.calculate_track_popularities
+- every BaselineModels.recommend_* mode, per call
+- cold start of a fresh process loading a BaselineModels snapshot and answering one query
+
+Results (throughput, p50/p99 latency and peak RSS after each stage) are printed as JSON.
+"""
+
+
+# ---------- Imports ---------- #
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+
+import numpy as np
+
+import clean_raw_data
+from baselinemodels import BaselineModels
+
+
+# ---------- Synthetic Data ---------- #
+
+def generate_mpd_slices(directory, num_slices=4, playlists_per_slice=1000, mean_tracks_per_playlist=66,
+                        catalog_size=100_000, zipf_exponent=1.0, tracks_per_album=10, albums_per_artist=3, seed=0):
+    """
+    Write `num_slices` MPD-shaped JSON slice files (mpd.slice.<start>-<end>.json) to `directory`.
+
+    Tracks are drawn with Zipfian popularity: the track of popularity rank r is picked with
+    probability proportional to 1 / r ** zipf_exponent. Playlist lengths are Poisson around
+    `mean_tracks_per_playlist` (at least 1). Returns the list of written file paths.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    # Popularity rank -> track ID, shuffled so popular tracks are spread over albums and artists
+    weights = 1.0 / np.arange(1, catalog_size + 1) ** zipf_exponent
+    weights /= weights.sum()
+    track_of_rank = rng.permutation(catalog_size)
+
+    filepaths = []
+    for slice_num in range(num_slices):
+        first_pid = slice_num * playlists_per_slice
+        lengths = np.maximum(rng.poisson(mean_tracks_per_playlist, size=playlists_per_slice), 1)
+        picks = track_of_rank[rng.choice(catalog_size, size=lengths.sum(), p=weights)].tolist()
+
+        playlists = []
+        position = 0
+        for n, length in enumerate(lengths.tolist()):
+            tracks = []
+            for pos, track in enumerate(picks[position:position + length]):
+                album = track // tracks_per_album
+                artist = album // albums_per_artist
+                tracks.append({
+                    'pos': pos,
+                    'artist_name': f'Artist {artist}',
+                    'track_uri': f'spotify:track:{track:022d}',
+                    'artist_uri': f'spotify:artist:{artist:022d}',
+                    'track_name': f'Track {track}',
+                    'album_uri': f'spotify:album:{album:022d}',
+                    'duration_ms': 120_000 + (track * 7919) % 240_000,
+                    'album_name': f'Album {album}',
+                })
+            position += length
+
+            playlists.append({
+                'name': f'Playlist {first_pid + n}',
+                'collaborative': 'false',
+                'pid': first_pid + n,
+                'modified_at': 1483228800 + int(rng.integers(0, 31536000)),
+                'num_tracks': length,
+                'num_albums': len({t['album_uri'] for t in tracks}),
+                'num_followers': int(rng.integers(1, 10)),
+                'num_edits': int(rng.integers(1, 20)),
+                'duration_ms': sum(t['duration_ms'] for t in tracks),
+                'num_artists': len({t['artist_uri'] for t in tracks}),
+                'tracks': tracks,
+            })
+
+        filepath = os.path.join(directory, f'mpd.slice.{first_pid}-{first_pid + playlists_per_slice - 1}.json')
+        with open(filepath, 'w') as file:
+            json.dump({'info': {'generated_on': 'benchmarks.py'}, 'playlists': playlists}, file)
+        filepaths.append(filepath)
+
+    return filepaths
+
+
+# ---------- Measurements ---------- #
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def summarize_latencies(seconds, items=None):
+    """Summarize a list of per-call times (seconds) as throughput and p50/p99 latency in milliseconds."""
+    seconds = np.asarray(seconds)
+    total = seconds.sum()
+    summary = {
+        'calls': len(seconds),
+        'total_s': float(total),
+        'calls_per_s': float(len(seconds) / total) if total > 0 else None,
+        'p50_ms': float(np.percentile(seconds, 50) * 1000),
+        'p99_ms': float(np.percentile(seconds, 99) * 1000),
+    }
+    if items is not None:
+        summary['items'] = int(items)
+        summary['items_per_s'] = float(items / total) if total > 0 else None
+    summary['peak_rss_mb'] = peak_rss_mb()
+    return summary
+
+
+# ---------- Benchmarks ---------- #
+
+def bench_ingest(slice_filepaths, out_path, tracks_per_playlist=15, output_format='csv'):
+    """Time parse_spotify_mpd_json_to_csv on each slice; throughput is counted in track rows."""
+
+    playlist_output = os.path.join(out_path, 'playlists')
+    track_output = os.path.join(out_path, 'tracks')
+    os.makedirs(playlist_output, exist_ok=True)
+    os.makedirs(track_output, exist_ok=True)
+
+    seconds, num_rows, num_bytes = [], 0, 0
+    for filepath in slice_filepaths:
+        suffix = os.path.basename(filepath).split('.')[-2]
+        start = time.perf_counter()
+        # Keep the parser's progress messages out of the JSON report on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            _, num_tracks, _ = clean_raw_data.parse_spotify_mpd_json_to_csv(
+                input_filepath=filepath,
+                output_filepaths=[playlist_output, track_output],
+                playlist_csv_name='mpd_playlists_' + suffix,
+                tracks_csv_name='mpd_tracks_' + suffix,
+                tracks_per_playlist=tracks_per_playlist,
+                output_format=output_format)
+        seconds.append(time.perf_counter() - start)
+        num_rows += num_tracks
+        num_bytes += os.path.getsize(filepath)
+
+    summary = summarize_latencies(seconds, items=num_rows)
+    summary['input_mb_per_s'] = num_bytes / 2**20 / summary['total_s']
+    return summary
+
+
+def bench_popularity(model, repeats=3):
+    """Time BaselineModels.calculate_track_popularities over the playlist table."""
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.calculate_track_popularities()
+        seconds.append(time.perf_counter() - start)
+    return summarize_latencies(seconds, items=model.playlist_df.shape[0])
+
+
+def bench_recommenders(model, seed_lists, num_tracks=10):
+    """Time each recommend_* mode once per seed list."""
+
+    modes = {
+        'recommend_tracks_by_artists(popularity=True)': lambda seeds: model.recommend_tracks_by_artists(num_tracks, seeds, True),
+        'recommend_tracks_by_artists(popularity=False)': lambda seeds: model.recommend_tracks_by_artists(num_tracks, seeds, False),
+        'recommend_tracks_by_albums(popularity=True)': lambda seeds: model.recommend_tracks_by_albums(num_tracks, seeds, True),
+        'recommend_tracks_by_albums(popularity=False)': lambda seeds: model.recommend_tracks_by_albums(num_tracks, seeds, False),
+        'recommend_popular_tracks': lambda seeds: model.recommend_popular_tracks(num_tracks, seeds),
+    }
+
+    results = {}
+    for name, recommend in modes.items():
+        seconds = []
+        for seeds in seed_lists:
+            start = time.perf_counter()
+            recommend(seeds)
+            seconds.append(time.perf_counter() - start)
+        results[name] = summarize_latencies(seconds)
+    return results
+
+
+def bench_cold_start(snapshot_directory, repeats=3):
+    """
+    Time fresh Python processes that import baselinemodels, load a snapshot and run one
+    recommendation, as a spawned serving or evaluation worker would.
+    """
+
+    script = ("import time; start = time.perf_counter(); from baselinemodels import BaselineModels; "
+              f"model = BaselineModels.load_snapshot({snapshot_directory!r}); "
+              "model.recommend_tracks_by_artists(10, [model.track_uris[0]]); print(time.perf_counter() - start)")
+    code_directory = os.path.dirname(os.path.abspath(__file__))
+
+    seconds = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', script], cwd=code_directory, check=True,
+                                capture_output=True, text=True).stdout
+        seconds.append(float(output.split()[-1]))
+    return summarize_latencies(seconds)
+
+
+def run_benchmarks(workdir, num_slices=4, playlists_per_slice=1000, mean_tracks_per_playlist=66,
+                   catalog_size=100_000, zipf_exponent=1.0, tracks_per_playlist=15, output_format='csv',
+                   num_queries=1000, seeds_per_query=5, seed=0):
+    """Generate data in `workdir`, run every benchmark and return the results as a dictionary."""
+
+    results = {'config': {
+        'slices': num_slices,
+        'playlists_per_slice': playlists_per_slice,
+        'mean_tracks_per_playlist': mean_tracks_per_playlist,
+        'catalog_size': catalog_size,
+        'zipf_exponent': zipf_exponent,
+        'tracks_per_playlist': tracks_per_playlist,
+        'output_format': output_format,
+        'queries': num_queries,
+        'seeds_per_query': seeds_per_query,
+        'seed': seed,
+    }}
+
+    start = time.perf_counter()
+    slice_filepaths = generate_mpd_slices(os.path.join(workdir, 'json'), num_slices, playlists_per_slice,
+                                          mean_tracks_per_playlist, catalog_size, zipf_exponent, seed=seed)
+    results['generate_s'] = time.perf_counter() - start
+
+    out_path = os.path.join(workdir, 'data')
+    results['ingest'] = bench_ingest(slice_filepaths, out_path, tracks_per_playlist, output_format)
+
+    # Tables in the shape the notebooks use: playlists by pid, unique tracks by track_uri
+    playlist_df = clean_raw_data.load_mpd_table(os.path.join(out_path, 'playlists'), index_col='pid')
+    track_df = clean_raw_data.load_mpd_table(os.path.join(out_path, 'tracks'))
+    track_df = track_df.drop(columns=['pid', 'pos']).drop_duplicates(subset=['track_uri']).set_index('track_uri')
+
+    start = time.perf_counter()
+    model = BaselineModels(playlist_df, track_df, seed=seed)
+    results['model_build_s'] = time.perf_counter() - start
+    results['calculate_track_popularities'] = bench_popularity(model)
+
+    # Seeds are the first tracks of randomly chosen playlists, as in the challenge
+    rng = np.random.default_rng(seed)
+    track_uri_cols = [f'track_{n}_uri' for n in range(1, min(seeds_per_query, tracks_per_playlist) + 1)]
+    rows = rng.integers(0, len(playlist_df), size=num_queries)
+    seed_lists = [[uri for uri in row if isinstance(uri, str)]
+                  for row in playlist_df[track_uri_cols].iloc[rows].to_numpy()]
+    results['recommenders'] = bench_recommenders(model, seed_lists)
+
+    snapshot_directory = os.path.join(workdir, 'snapshot')
+    model.save_snapshot(snapshot_directory)
+    results['cold_start'] = bench_cold_start(snapshot_directory)
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+# Running from Command Line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark MPD ingestion and BaselineModels on synthetic data.')
+    parser.add_argument('--slices', type=int, default=4, help='number of slice files to generate')
+    parser.add_argument('--playlists-per-slice', type=int, default=1000)
+    parser.add_argument('--mean-tracks', type=int, default=66, help='mean tracks per playlist')
+    parser.add_argument('--catalog-size', type=int, default=100_000, help='number of distinct tracks')
+    parser.add_argument('--zipf', type=float, default=1.0, help='Zipf exponent of track popularity')
+    parser.add_argument('--num-tracks', type=int, default=15, help='tracks saved as columns of each playlist row')
+    parser.add_argument('--format', choices=clean_raw_data.OUTPUT_FORMATS, default='csv')
+    parser.add_argument('--queries', type=int, default=1000, help='recommendation calls per mode')
+    parser.add_argument('--seeds', type=int, default=5, help='seed tracks per recommendation call')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--workdir', default=None, help='keep generated data here instead of a temporary directory')
+    parser.add_argument('--output', default=None, help='write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = run_benchmarks(args.workdir or tmpdir, args.slices, args.playlists_per_slice, args.mean_tracks,
+                                 args.catalog_size, args.zipf, args.num_tracks, args.format,
+                                 args.queries, args.seeds, args.seed)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(report)
+    else:
+        print(report)
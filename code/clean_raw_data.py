@@ -2,36 +2,135 @@
 This script parse's Spotify's MPD Dataset.
 
 Usage:
-    python3 clean_raw_data.py <path-to-data-directory>
+    python3 clean_raw_data.py <path-to-data-directory> [--num-tracks N] [--workers N] [--format csv|parquet] [--force]
 
-The JSON slice files are converted to CSV slices. The result is:
+The JSON slice files are converted to CSV (or Parquet) slices. The result is:
 
 - playlists.csv
 - tracks.csv
 
+A manifest.json in the output directory records what has been parsed, so reruns only
+parse new or changed slices (use --force to reparse everything).
+
 """
 
 
 # Imports
 import numpy as np
 import pandas as pd
-import sys
 import os
 import json
 import csv
+import time
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+
+
+# Playlist fields copied from each MPD playlist, in CSV column order
+PLAYLIST_FIELDS = ['pid', 'name', 'description', 'modified_at', 'num_artists', 'num_albums',
+                   'num_tracks', 'num_followers', 'num_edits', 'duration_ms', 'collaborative']
+
+# Track fields copied from each MPD playlist track, in CSV column order
+TRACK_FIELDS = ['pid', 'track_name', 'track_uri', 'album_name', 'album_uri',
+                'artist_name', 'artist_uri', 'duration_ms', 'pos']
+
+# Column types used for columnar (Parquet) output.
+# 'dictionary' columns are stored dictionary-encoded and load as pandas categoricals.
+PLAYLIST_TYPES = {
+    'pid': 'int32',
+    'name': 'string',
+    'description': 'string',
+    'modified_at': 'int64',
+    'num_artists': 'int32',
+    'num_albums': 'int32',
+    'num_tracks': 'int32',
+    'num_followers': 'int32',
+    'num_edits': 'int32',
+    'duration_ms': 'int64',
+    'collaborative': 'bool',
+}
+
+TRACK_TYPES = {
+    'pid': 'int32',
+    'track_name': 'dictionary',
+    'track_uri': 'dictionary',
+    'album_name': 'dictionary',
+    'album_uri': 'dictionary',
+    'artist_name': 'dictionary',
+    'artist_uri': 'dictionary',
+    'duration_ms': 'int32',
+    'pos': 'int32',
+}
+
+# Supported output formats; the format name is also the file extension
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+
+def playlist_track_columns(tracks_per_playlist=15):
+    """Return the track_N_uri, track_N_album_uri, track_N_artist_uri column names for the playlist CSV."""
+    columns = []
+    for n in range(1, tracks_per_playlist + 1):
+        columns += [f'track_{n}_uri', f'track_{n}_album_uri', f'track_{n}_artist_uri']
+    return columns
+
+
+def _slice_sort_key(filename):
+    """Sort key putting slice files in playlist ID order, e.g. mpd_tracks_1000-1999.csv after mpd_tracks_0-999.csv."""
+    suffix = filename.rsplit('.', 1)[0].split('.')[-1].split('_')[-1]
+    try:
+        return (int(suffix.split('-')[0]), filename)
+    except ValueError:
+        return (-1, filename)
+
+
+def list_mpd_slices(mpd_filepath, extension='.json'):
+    """
+    Return the slice filenames in `mpd_filepath` ending with `extension`, ordered by their playlist
+    ID range (mpd.slice.0-999.json, mpd.slice.1000-1999.json, ...) so that output is deterministic.
+    """
+    slice_files = [ff for ff in os.listdir(mpd_filepath) if ff.endswith(extension)]
+    return sorted(slice_files, key=_slice_sort_key)
+
+
+def process_mpd_data(path='', num_tracks=15, out_path='../data', num_workers=1, output_format='csv', encode_ids=False,
+                     force=False):
+    """
+    Parse every MPD JSON slice in `path` into playlist and track slices.
+    `output_format` is 'csv' or 'parquet' (one Parquet file per slice, see load_mpd_table).
+
+    Runs are incremental: <out_path>/manifest.json records every parsed slice (input size,
+    mtime and SHA-1, output files, row counts and settings) and is rewritten after each slice.
+    A rerun, including one after an interrupted run, only parses slices that are new or changed
+    or whose outputs are missing, and only rewrites the outputs affected by changed settings
+    (see slice_outputs_to_build). Pass `force` to rebuild everything.
+
+    Slices are parsed in order of their playlist ID range. With `num_workers` greater
+    than 1 the slices are parsed concurrently in a process pool; the output files and
+    the order in which slices are reported are the same as for a serial run.
 
+    With `encode_ids` every track, album and artist URI is also assigned a dense int32 ID
+    (in order of first appearance) and ID-encoded copies of the tables are written to
+    <out_path>/ids, together with the URI dictionaries (see write_slice_ids). On incremental
+    runs the saved dictionaries are extended, so existing IDs never change. Each slice's
+    partial counts are saved too and merged into <out_path>/ids/popularity.npz (see
+    slice_aggregates and merge_slice_aggregates).
 
-def process_mpd_data(path='', num_tracks=15):
+    Returns a list with one dictionary of row counts and parse time per parsed slice.
+    """
 
     # --- Use default input path if one isn't provided
-    path = "../spotify_million_playlist_dataset/data/"
+    if not path:
+        path = "../spotify_million_playlist_dataset/data/"
     mpd_filepath = os.path.relpath(path)
     print('Input directory:')
     print(mpd_filepath)
 
     # --- Define output paths
     # Base output directory
-    out_path = '../data'
     output_filepath_root = os.path.relpath(out_path)
 
     # Output playlists into playlists directory
@@ -40,43 +139,308 @@ def process_mpd_data(path='', num_tracks=15):
     # Output tracks into tracks directory
     track_output = os.path.join(output_filepath_root, 'tracks')
 
+    os.makedirs(playlist_output, exist_ok=True)
+    os.makedirs(track_output, exist_ok=True)
+
     print('Output directories:')
     print(output_filepath_root)
     print(playlist_output)
     print(track_output)
 
+    # --- Manifest of slices parsed by previous runs
+    manifest = new_manifest() if force else load_manifest(output_filepath_root)
+    config = {'tracks_per_playlist': num_tracks, 'output_format': output_format, 'encode_ids': encode_ids}
+
+    # ID-encoded tables and URI dictionaries go into the ids directory
+    ids_output = os.path.join(output_filepath_root, 'ids')
+    ids_valid = False
+    if encode_ids:
+        os.makedirs(os.path.join(ids_output, 'playlists'), exist_ok=True)
+        os.makedirs(os.path.join(ids_output, 'tracks'), exist_ok=True)
+        os.makedirs(os.path.join(ids_output, 'aggregates'), exist_ok=True)
+        print(ids_output)
+
+        # Continue from the dictionaries as of the last completed slice; without them,
+        # every slice's ID tables are rebuilt from empty dictionaries
+        ids_valid = 'uri_counts' in manifest
+        if ids_valid:
+            uri_dictionaries = load_uri_dictionaries(ids_output, manifest['uri_counts'])
+        else:
+            uri_dictionaries = {kind: UriDictionary() for kind in URI_KINDS}
+        save_uri_dictionaries(uri_dictionaries, ids_output)
+        saved_uri_counts = {kind: len(uri_dictionaries[kind]) for kind in URI_KINDS}
+
     # --- 
-    # Input for number of tracks to include as features for each playlist
-    num_tracks = num_tracks
+    # One parsing task per slice file that has outputs to build
+    slice_files = list_mpd_slices(mpd_filepath)
+    tasks = []
+    for ff in slice_files:
+        suffix = str(ff.split('.')[-2])
+        input_filepath = os.path.join(mpd_filepath, ff)
+        output_filepaths = slice_output_filepaths(output_filepath_root, suffix, output_format)
+
+        entry = manifest['slices'].get(ff)
+        outputs = slice_outputs_to_build(entry, input_filepath, config, output_filepaths, ids_valid)
+        if not outputs:
+            continue
+
+        tasks.append({
+            'input_filepath': input_filepath,
+            'output_filepaths': [playlist_output, track_output],
+            'playlist_csv_name': 'mpd_playlists_' + suffix,
+            'tracks_csv_name': 'mpd_tracks_' + suffix,
+            'tracks_per_playlist': num_tracks,
+            'output_format': output_format,
+            'encode_ids': 'ids' in outputs,
+            'write_playlists': 'playlists' in outputs,
+            'write_tracks': 'tracks' in outputs,
+        })
+
+    # Slices whose input file has gone are reported, but their outputs are kept
+    missing = sorted(set(manifest['slices']) - set(slice_files), key=_slice_sort_key)
+    if missing:
+        print(f'{len(missing)} slice(s) in the manifest have no input file in {mpd_filepath}, e.g. {missing[0]}')
 
     # Begin parsing JSON files
-    print('\nParsing JSONs...\n')
-    length = len(os.listdir(mpd_filepath))
+    print(f'\n{len(slice_files) - len(tasks)} of {len(slice_files)} slices are up to date.')
+    print(f'Parsing {len(tasks)} JSONs with {num_workers} worker(s)...\n')
+    length = len(tasks)
+    start = time.perf_counter()
 
-    for ii, ff in enumerate(os.listdir(mpd_filepath)):
-        print(f"Slice {ii + 1} of {length}: {ff}")
-        suffix = str(ff.split('.')[-2])
+    # executor.map yields results in submission order, so reporting
+    # and ID assignment happen in slice order for any number of workers
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    results = executor.map(_parse_slice, tasks) if executor else map(_parse_slice, tasks)
 
-        # Call parsing helper function
-        parse_spotify_mpd_json_to_csv(
-            input_filepath=os.path.join(mpd_filepath, ff),
-            output_filepaths=[playlist_output, track_output],
-            playlist_csv_name='mpd_playlists_' + suffix,
-            tracks_csv_name='mpd_tracks_' + suffix,
-            tracks_per_playlist=num_tracks)
+    slice_stats = []
+    try:
+        for ii, (task, stats) in enumerate(zip(tasks, results)):
+            print(f"Slice {ii + 1} of {length}: {stats['slice']}")
 
-        print()
+            slice_ids = stats.pop('ids')
+            worker_metrics = stats.pop('metrics')
+            if worker_metrics is not None:
+                instrumentation.METRICS.merge(worker_metrics)
 
+            suffix = task['tracks_csv_name'].split('_')[-1]
+            if task['encode_ids']:
+                with instrumentation.timed('ingest_stage_seconds', stage='encode_ids'):
+                    global_ids = write_slice_ids(slice_ids, uri_dictionaries, ids_output, suffix, num_tracks,
+                                                 output_format)
+                    saved_uri_counts = append_uri_dictionaries(uri_dictionaries, ids_output, saved_uri_counts)
+                with instrumentation.timed('ingest_stage_seconds', stage='aggregates'):
+                    save_slice_aggregates(slice_aggregates(slice_ids, global_ids, num_tracks),
+                                          os.path.join(ids_output, 'aggregates', f'mpd_aggregates_{suffix}.npz'))
+                manifest['uri_counts'] = saved_uri_counts
+                instrumentation.count('ingest_rows_written_total', len(slice_ids['track']), table='ids_tracks')
+                instrumentation.count('ingest_rows_written_total', len(slice_ids['playlist_pid']), table='ids_playlists')
 
+            # Record the slice only once all of its outputs are written; paths are relative to out_path
+            output_filepaths = slice_output_filepaths('', suffix, output_format)
+            manifest['slices'][stats['slice']] = update_manifest_entry(
+                manifest['slices'].get(stats['slice']), task, stats, output_filepaths)
+            with instrumentation.timed('ingest_stage_seconds', stage='manifest'):
+                save_manifest(manifest, output_filepath_root)
+
+            slice_stats.append(stats)
+    finally:
+        if executor:
+            executor.shutdown()
+
+    if encode_ids and not tasks:
+        manifest['uri_counts'] = saved_uri_counts
+        save_manifest(manifest, output_filepath_root)
+
+    if encode_ids:
+        save_uri_dictionaries(uri_dictionaries, ids_output)
+        print('\nURI dictionaries: ' + ', '.join(f'{len(uri_dictionaries[kind])} {kind}s' for kind in URI_KINDS))
+
+        with instrumentation.timed('ingest_stage_seconds', stage='merge_aggregates'):
+            totals = merge_slice_aggregates(ids_output, saved_uri_counts, num_workers)
+        print(f"Popularity of {totals['num_playlists']} playlists saved to {os.path.join(ids_output, POPULARITY_FILENAME)}")
+
+    report_slice_timings(slice_stats, time.perf_counter() - start)
+
+    return slice_stats
+
+
+def _parse_slice(task):
+    """
+    Process pool entry point: parse one slice and return its row counts, parse time, input stats
+    and slice IDs, plus the metrics recorded while parsing when instrumentation is enabled.
+    """
+    start = time.perf_counter()
+    input_stat = os.stat(task['input_filepath'])
+    with instrumentation.timed('ingest_stage_seconds', stage='sha1'):
+        sha1 = file_sha1(task['input_filepath'])
+    instrumentation.count('ingest_bytes_read_total', input_stat.st_size, stage='sha1')
+    num_playlists, num_tracks, slice_ids = parse_spotify_mpd_json_to_csv(**task)
 
+    return {
+        'slice': os.path.basename(task['input_filepath']),
+        'playlists': num_playlists,
+        'tracks': num_tracks,
+        'seconds': time.perf_counter() - start,
+        'size': input_stat.st_size,
+        'mtime': input_stat.st_mtime,
+        'sha1': sha1,
+        'ids': slice_ids,
+        # Worker metrics go back to the parent (see instrumentation.Metrics.merge)
+        'metrics': instrumentation.METRICS.drain() if instrumentation.ENABLED else None,
+    }
 
-def parse_spotify_mpd_json_to_csv(input_filepath, output_filepaths, playlist_csv_name, tracks_csv_name, tracks_per_playlist=15):
+
+# ---------- Manifest ---------- #
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+def new_manifest():
+    return {'version': MANIFEST_VERSION, 'slices': {}}
+
+
+def load_manifest(out_path):
+    """Load <out_path>/manifest.json, or return an empty manifest if there is none."""
+    filepath = os.path.join(out_path, MANIFEST_FILENAME)
+    if not os.path.exists(filepath):
+        return new_manifest()
+    with open(filepath, 'r') as file:
+        manifest = json.load(file)
+    if manifest.get('version') != MANIFEST_VERSION:
+        print(f'Ignoring {filepath}: unsupported manifest version.')
+        return new_manifest()
+    return manifest
+
+
+def save_manifest(manifest, out_path):
+    """Write <out_path>/manifest.json atomically, so an interrupted run never leaves a partial manifest."""
+    filepath = os.path.join(out_path, MANIFEST_FILENAME)
+    with open(filepath + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(filepath + '.tmp', filepath)
+
+
+def file_sha1(filepath, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def slice_output_filepaths(out_path, suffix, output_format='csv'):
+    """Return the output files of one slice, by output name."""
+    return {
+        'playlists': os.path.join(out_path, 'playlists', f'mpd_playlists_{suffix}.{output_format}'),
+        'tracks': os.path.join(out_path, 'tracks', f'mpd_tracks_{suffix}.{output_format}'),
+        'ids_playlists': os.path.join(out_path, 'ids', 'playlists', f'mpd_playlists_{suffix}.{output_format}'),
+        'ids_tracks': os.path.join(out_path, 'ids', 'tracks', f'mpd_tracks_{suffix}.{output_format}'),
+        'ids_aggregates': os.path.join(out_path, 'ids', 'aggregates', f'mpd_aggregates_{suffix}.npz'),
+    }
+
+
+def slice_outputs_to_build(entry, input_filepath, config, output_filepaths, ids_valid=True):
+    """
+    Compare a slice's manifest entry with its input file and the current settings, and return the
+    outputs that must be (re)built: a list of 'playlists', 'tracks' and 'ids' (empty if up to date).
+
+    - a new or changed input (size, or SHA-1 when only the mtime differs) or a new output format
+      rebuilds everything
+    - a new tracks_per_playlist rebuilds the playlist tables only
+    - missing output files are rebuilt; 'ids' are only built when config['encode_ids'] is set and
+      are rebuilt when the saved URI dictionaries cannot be trusted (`ids_valid` False)
+    """
+
+    all_outputs = ['playlists', 'tracks'] + (['ids'] if config['encode_ids'] else [])
+    if entry is None:
+        return all_outputs
+
+    input_stat = os.stat(input_filepath)
+    if (input_stat.st_size, input_stat.st_mtime) != (entry['size'], entry['mtime']):
+        if input_stat.st_size != entry['size'] or file_sha1(input_filepath) != entry['sha1']:
+            return all_outputs
+        # Touched but identical: remember the new mtime to avoid hashing again
+        entry['mtime'] = input_stat.st_mtime
+
+    if entry['output_format'] != config['output_format']:
+        return all_outputs
+
+    layout_changed = entry['tracks_per_playlist'] != config['tracks_per_playlist']
+    recorded = entry['outputs']
+
+    outputs = []
+    if layout_changed or not os.path.exists(output_filepaths['playlists']) or 'playlists' not in recorded:
+        outputs.append('playlists')
+    if not os.path.exists(output_filepaths['tracks']) or 'tracks' not in recorded:
+        outputs.append('tracks')
+    if config['encode_ids']:
+        ids_missing = any(not os.path.exists(output_filepaths[name]) or name not in recorded
+                          for name in ['ids_playlists', 'ids_tracks', 'ids_aggregates'])
+        if layout_changed or ids_missing or not ids_valid:
+            outputs.append('ids')
+    return outputs
+
+
+def update_manifest_entry(entry, task, stats, output_filepaths):
+    """Return the manifest entry of a slice after the outputs of `task` were written."""
+
+    # Outputs of a previous run stay valid unless the input or format changed (see slice_outputs_to_build)
+    rebuilt_all = task['write_playlists'] and task['write_tracks']
+    if entry is None or rebuilt_all:
+        entry = {'outputs': {}}
+    outputs = dict(entry['outputs'])
+
+    if task['write_playlists']:
+        outputs['playlists'] = output_filepaths['playlists']
+        # ID-encoded playlists with the old layout are stale unless rebuilt too
+        if not task['encode_ids']:
+            outputs.pop('ids_playlists', None)
+            outputs.pop('ids_tracks', None)
+            outputs.pop('ids_aggregates', None)
+    if task['write_tracks']:
+        outputs['tracks'] = output_filepaths['tracks']
+    if task['encode_ids']:
+        outputs['ids_playlists'] = output_filepaths['ids_playlists']
+        outputs['ids_tracks'] = output_filepaths['ids_tracks']
+        outputs['ids_aggregates'] = output_filepaths['ids_aggregates']
+
+    return {
+        'size': stats['size'],
+        'mtime': stats['mtime'],
+        'sha1': stats['sha1'],
+        'playlists': stats['playlists'],
+        'tracks': stats['tracks'],
+        'tracks_per_playlist': task['tracks_per_playlist'],
+        'output_format': task['output_format'],
+        'outputs': outputs,
+    }
+
+
+def report_slice_timings(slice_stats, wall_seconds):
+    """Print per-slice parse times followed by totals for the whole run."""
+    print('\nSlice timings:')
+    for stats in slice_stats:
+        print(f"{stats['slice']:<30} {stats['playlists']:>7} playlists {stats['tracks']:>9} tracks {stats['seconds']:>8.2f}s")
+
+    busy_seconds = sum(stats['seconds'] for stats in slice_stats)
+    num_playlists = sum(stats['playlists'] for stats in slice_stats)
+    num_tracks = sum(stats['tracks'] for stats in slice_stats)
+    print(f'\n{len(slice_stats)} slices, {num_playlists} playlists, {num_tracks} tracks')
+    print(f'Wall time {wall_seconds:.2f}s, summed slice time {busy_seconds:.2f}s '
+          f'({busy_seconds / max(wall_seconds, 1e-9):.1f}x parallelism)')
+
+
+def parse_spotify_mpd_json_to_csv(input_filepath, output_filepaths, playlist_csv_name, tracks_csv_name, tracks_per_playlist=15,
+                                  output_format='csv', encode_ids=False, write_playlists=True, write_tracks=True):
     """Parse through Spotify's Million Playlist Dataset (MPD) JSON slice file and produce the following CSV files:
     
         - {playlist_csv_name}.csv
         - {tracks_csv_name}.csv
         
         * Note: '.csv' suffice not required in argument string.
+        * With output_format='parquet' the files are {playlist_csv_name}.parquet and {tracks_csv_name}.parquet,
+          typed with PLAYLIST_TYPES and TRACK_TYPES. Padding track columns are null instead of 0.
         
         
     The MPD JSON has a *PLAYLIST* field for each playlist row. The *INFO* field is ignored for each slice file.
@@ -113,125 +477,934 @@ def parse_spotify_mpd_json_to_csv(input_filepath, output_filepaths, playlist_csv
     
     This function does not further process the rows, it simply converts the JSON to CSVs.
     Rows are not sorted, duplicates are not removed.
+
+    Rows are streamed to the CSV files as each playlist is parsed. With `write_playlists` or
+    `write_tracks` set to False that file is not written (e.g. to rebuild only the other one).
+    Returns the number of playlists and tracks written, and the slice's ID arrays when
+    `encode_ids` is set (None otherwise). Those IDs are local to the slice; see write_slice_ids.
     
     """
     
+    instrumented = instrumentation.ENABLED
+    start = time.perf_counter()
+
     # Load JSON from provided filepath
     j = ''
     with open(input_filepath, 'r') as file:
         j = json.load(file)
-        
-    # Lists to gather from nested JSON
-    playlists_json_list = []
-    tracks_json_list = []
-    
-    # MPD JSON structure has PLAYLISTs as outermost dictionary
-    # Step through PLAYLISTs
-    for playlist in j['playlists']:
-        
-        # -- Create this playlist's playlist row as JSON for CSV creation
-        playlist_json = {}
-        playlist_json['pid'] = playlist['pid']
-        playlist_json['name'] = playlist['name']
-
-        # Description is an optional field
-        if 'description' in playlist:
-            playlist_json['description'] = playlist['description']
+    load_seconds = time.perf_counter() - start
+
+    num_playlists = 0
+    num_tracks = 0
+
+    # Slice-local URI dictionaries and per-track ID columns
+    if encode_ids:
+        local_dictionaries = {kind: UriDictionary() for kind in URI_KINDS}
+        id_columns = {'pid': [], 'pos': [], 'track': [], 'album': [], 'artist': []}
+        playlist_pids = []
+        playlist_lengths = []
+        playlist_followers = []
+
+    # Columns of the playlist table, including the wide track columns
+    track_columns = playlist_track_columns(tracks_per_playlist)
+    playlist_types = dict(PLAYLIST_TYPES, **{col: 'dictionary' for col in track_columns})
+
+    PlaylistWriter = ROW_WRITERS[output_format] if write_playlists else NullRowWriter
+    TracksWriter = ROW_WRITERS[output_format] if write_tracks else NullRowWriter
+
+    playlist_writer = PlaylistWriter(f"{output_filepaths[0]}/{playlist_csv_name}.{output_format}",
+                                     PLAYLIST_FIELDS + track_columns, playlist_types)
+    tracks_writer = TracksWriter(f"{output_filepaths[1]}/{tracks_csv_name}.{output_format}",
+                                 TRACK_FIELDS, TRACK_TYPES)
+
+    # Time spent in the writers is measured separately from building rows
+    if instrumented:
+        playlist_writer, tracks_writer = TimedRowWriter(playlist_writer), TimedRowWriter(tracks_writer)
+
+    # Rows are written as soon as they are built rather than collected in lists first
+    with playlist_writer, tracks_writer:
+
+        # MPD JSON structure has PLAYLISTs as outermost dictionary
+        # Step through PLAYLISTs
+        for playlist in j['playlists']:
+
+            # -- Create this playlist's playlist row, in PLAYLIST_FIELDS order
+            # Description is an optional field
+            playlist_row = [
+                playlist['pid'],
+                playlist['name'],
+                playlist.get('description', ''),
+                playlist['modified_at'],
+                playlist['num_artists'],
+                playlist['num_albums'],
+                playlist['num_tracks'],
+                playlist['num_followers'],
+                playlist['num_edits'],
+                playlist['duration_ms'],
+                playlist['collaborative'],
+            ]
+
+            # -- Creating tracks csv
+            # Each playlist has any number of tracks.
+            # Use the *PID* to affiliate tracks with playlists
+
+            # -- Saving tracks for each playlist
+            # Add n tracks as features to the playlist csv
+            # Where n is the input tracks_per_playlist
+            # Format: track_1_uri, track_1_album_uri, track_1_artist_uri, track_2_uri,...
+            #
+            # Use padding where track does not exist (only 5 tracks in playlist when we want 15)
+
+            track_counter = 0
+
+            for track in playlist['tracks']:
+
+                if track_counter < tracks_per_playlist:
+                    playlist_row += [track['track_uri'], track['album_uri'], track['artist_uri']]
+
+                track_counter += 1
+
+                # Tracks CSV row, in TRACK_FIELDS order
+                tracks_writer.writerow([
+                    playlist['pid'],
+                    track['track_name'],
+                    track['track_uri'],
+                    track['album_name'],
+                    track['album_uri'],
+                    track['artist_name'],
+                    track['artist_uri'],
+                    track['duration_ms'],
+                    track['pos'],
+                ])
+
+                if encode_ids:
+                    id_columns['pid'].append(playlist['pid'])
+                    id_columns['pos'].append(track['pos'])
+                    for kind in URI_KINDS:
+                        id_columns[kind].append(local_dictionaries[kind].intern(track[kind + '_uri']))
+
+            # Check if there weren't enough tracks and we need to add padding
+            if track_counter < tracks_per_playlist:
+                playlist_row += [playlist_writer.pad_value] * 3 * (tracks_per_playlist - track_counter)
+
+            playlist_writer.writerow(playlist_row)
+
+            if encode_ids:
+                playlist_pids.append(playlist['pid'])
+                playlist_lengths.append(track_counter)
+                playlist_followers.append(playlist['num_followers'])
+
+            num_playlists += 1
+            num_tracks += track_counter
+
+    if instrumented:
+        write_seconds = playlist_writer.seconds + tracks_writer.seconds
+        instrumentation.observe('ingest_stage_seconds', load_seconds, stage='load_json')
+        instrumentation.observe('ingest_stage_seconds', write_seconds, stage='write')
+        instrumentation.observe('ingest_stage_seconds', time.perf_counter() - start - load_seconds - write_seconds,
+                                stage='build_rows')
+        instrumentation.count('ingest_bytes_read_total', os.path.getsize(input_filepath), stage='load_json')
+        if write_playlists:
+            instrumentation.count('ingest_rows_written_total', num_playlists, table='playlists')
+        if write_tracks:
+            instrumentation.count('ingest_rows_written_total', num_tracks, table='tracks')
+
+    if write_playlists:
+        print(f"{playlist_csv_name}.{output_format} saved to {output_filepaths[0]}")
+    if write_tracks:
+        print(f"{tracks_csv_name}.{output_format} saved to {output_filepaths[1]}")
+
+    slice_ids = None
+    if encode_ids:
+        slice_ids = {column: np.array(values, dtype=np.int32) for column, values in id_columns.items()}
+        slice_ids['playlist_pid'] = np.array(playlist_pids, dtype=np.int32)
+        slice_ids['playlist_length'] = np.array(playlist_lengths, dtype=np.int32)
+        slice_ids['playlist_followers'] = np.array(playlist_followers, dtype=np.int64)
+        for kind in URI_KINDS:
+            slice_ids[kind + '_uris'] = local_dictionaries[kind].uris
+
+    return num_playlists, num_tracks, slice_ids
+
+
+# ---------- URI Dictionaries ---------- #
+
+# Kinds of URI that get interned; each has a <kind>_uri field in the MPD tracks
+URI_KINDS = ['track', 'album', 'artist']
+
+
+class UriDictionary:
+    """
+    Assign dense int32 IDs to Spotify URIs in order of first appearance.
+
+    Playlists are not interned: their MPD pid is already a dense integer ID.
+    A dictionary is saved as a text file with one URI per line, the line number being the ID.
+    """
+
+    def __init__(self, uris=()):
+        self.uris = []
+        self.ids = {}
+        self._uri_array = None
+        for uri in uris:
+            self.intern(uri)
+
+    def __len__(self):
+        return len(self.uris)
+
+    def __contains__(self, uri):
+        return uri in self.ids
+
+    def intern(self, uri):
+        """Return the ID of `uri`, assigning the next free ID if it has not been seen."""
+        uri_id = self.ids.get(uri)
+        if uri_id is None:
+            uri_id = len(self.uris)
+            self.ids[uri] = uri_id
+            self.uris.append(uri)
+            self._uri_array = None
+        return uri_id
+
+    def intern_many(self, uris):
+        """Intern each URI in `uris` and return their IDs as an int32 array."""
+        return np.fromiter((self.intern(uri) for uri in uris), dtype=np.int32, count=len(uris))
+
+    def encode(self, uris):
+        """Return the IDs of `uris` as an int32 array, with -1 for URIs not in the dictionary."""
+        return np.fromiter((self.ids.get(uri, -1) for uri in uris), dtype=np.int32, count=len(uris))
+
+    def decode(self, ids):
+        """Return the URIs for an array of IDs."""
+        if self._uri_array is None:
+            self._uri_array = np.array(self.uris, dtype=object)
+        return self._uri_array[np.asarray(ids)]
+
+    def save(self, filepath):
+        with open(filepath, 'w') as file:
+            file.write('\n'.join(self.uris))
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath, 'r') as file:
+            uris = file.read().split('\n')
+        return cls(uri for uri in uris if uri)
+
+
+def save_uri_dictionaries(uri_dictionaries, ids_output):
+    """Save each URI dictionary to <ids_output>/<kind>_uris.txt."""
+    for kind, dictionary in uri_dictionaries.items():
+        dictionary.save(os.path.join(ids_output, f'{kind}_uris.txt'))
+
+
+def load_uri_dictionaries(ids_output, counts=None):
+    """
+    Load the track, album and artist URI dictionaries saved by process_mpd_data(encode_ids=True).
+    If `counts` is given, only the first counts[kind] URIs of each are kept (the URIs of the slices
+    recorded in the manifest; later ones were appended by an interrupted run).
+    """
+    uri_dictionaries = {}
+    for kind in URI_KINDS:
+        dictionary = UriDictionary.load(os.path.join(ids_output, f'{kind}_uris.txt'))
+        if counts is not None:
+            if len(dictionary) < counts[kind]:
+                raise ValueError(f'{kind}_uris.txt has {len(dictionary)} URIs, the manifest expects {counts[kind]}.')
+            dictionary = UriDictionary(dictionary.uris[:counts[kind]])
+        uri_dictionaries[kind] = dictionary
+    return uri_dictionaries
+
+
+def append_uri_dictionaries(uri_dictionaries, ids_output, saved_counts):
+    """
+    Append the URIs added since the dictionaries held `saved_counts` URIs to their files,
+    so the saved dictionaries stay current after every slice. Returns the new counts.
+    """
+    for kind, dictionary in uri_dictionaries.items():
+        new_uris = dictionary.uris[saved_counts[kind]:]
+        if new_uris:
+            with open(os.path.join(ids_output, f'{kind}_uris.txt'), 'a') as file:
+                file.write(('\n' if saved_counts[kind] else '') + '\n'.join(new_uris))
+    return {kind: len(dictionary) for kind, dictionary in uri_dictionaries.items()}
+
+
+def playlist_id_columns(tracks_per_playlist=15):
+    """Return the track_N_id, track_N_album_id, track_N_artist_id column names for the ID-encoded playlist table."""
+    columns = []
+    for n in range(1, tracks_per_playlist + 1):
+        columns += [f'track_{n}_id', f'track_{n}_album_id', f'track_{n}_artist_id']
+    return columns
+
+
+def write_slice_ids(slice_ids, uri_dictionaries, ids_output, suffix, tracks_per_playlist=15, output_format='csv'):
+    """
+    Map a slice's local IDs to global IDs and write its ID-encoded tables:
+
+        - ids/tracks/mpd_tracks_{suffix}: pid, pos, track_id, album_id, artist_id
+        - ids/playlists/mpd_playlists_{suffix}: pid, then track_N_id, track_N_album_id,
+          track_N_artist_id for the first `tracks_per_playlist` tracks, padded with -1
+
+    New URIs are added to `uri_dictionaries`, so slices must be passed in a fixed order
+    for IDs to be reproducible. Returns the global IDs of every track row, by kind.
+    """
+
+    # Global ID of every track row, per kind
+    global_ids = {}
+    for kind in URI_KINDS:
+        local_to_global = uri_dictionaries[kind].intern_many(slice_ids[kind + '_uris'])
+        global_ids[kind] = local_to_global[slice_ids[kind]]
+
+    track_table = {'pid': slice_ids['pid'], 'pos': slice_ids['pos']}
+    for kind in URI_KINDS:
+        track_table[kind + '_id'] = global_ids[kind]
+    _write_id_table(os.path.join(ids_output, 'tracks', f'mpd_tracks_{suffix}'), track_table, output_format)
+
+    # Playlist row and position within the playlist of every track row;
+    # track rows are in playlist order, so each playlist's rows are contiguous
+    playlist_pids = slice_ids['playlist_pid']
+    playlist_lengths = slice_ids['playlist_length']
+    playlist_starts = np.cumsum(playlist_lengths) - playlist_lengths
+    row = np.repeat(np.arange(len(playlist_pids)), playlist_lengths)
+    position = np.arange(len(row)) - np.repeat(playlist_starts, playlist_lengths)
+    keep = position < tracks_per_playlist
+
+    # Wide (playlists x tracks_per_playlist x kinds) ID matrix, padded with -1
+    wide = np.full((len(playlist_pids), tracks_per_playlist, len(URI_KINDS)), -1, dtype=np.int32)
+    for k, kind in enumerate(URI_KINDS):
+        wide[row[keep], position[keep], k] = global_ids[kind][keep]
+    wide = wide.reshape(len(playlist_pids), -1)
+
+    playlist_table = {'pid': playlist_pids}
+    for col, column_name in enumerate(playlist_id_columns(tracks_per_playlist)):
+        playlist_table[column_name] = wide[:, col]
+    _write_id_table(os.path.join(ids_output, 'playlists', f'mpd_playlists_{suffix}'), playlist_table, output_format)
+    return global_ids
+
+
+def _write_id_table(filepath, columns, output_format='csv'):
+    """Write a dictionary of equal-length integer arrays as a CSV or Parquet table."""
+    df = pd.DataFrame(columns)
+    if output_format == 'parquet':
+        pa, pq = _import_pyarrow()
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), f'{filepath}.parquet')
+    else:
+        df.to_csv(f'{filepath}.csv', index=False)
+
+
+# ---------- Slice Aggregates ---------- #
+
+# Merged aggregates of every slice, in the ids directory
+POPULARITY_FILENAME = 'popularity.npz'
+
+# Counts kept per track, album and artist ID
+AGGREGATE_COUNTS = ['counts', 'head_counts', 'follower_counts']
+
+
+def slice_aggregates(slice_ids, global_ids, tracks_per_playlist=15):
+    """
+    Return the partial aggregates of one slice, keyed by global ID (see write_slice_ids). For each
+    kind in URI_KINDS:
+
+        - {kind}_ids: the IDs appearing in the slice, ascending
+        - {kind}_counts: appearances in playlists (track rows, repeats included)
+        - {kind}_head_counts: appearances among the first `tracks_per_playlist` tracks of a
+          playlist, i.e. what calculate_track_popularities counts over the wide playlist columns
+        - {kind}_follower_counts: appearances weighted by the playlist's num_followers
+
+    plus position_counts (track rows at each position in a playlist), num_playlists and num_tracks.
+    """
+
+    followers = np.repeat(slice_ids['playlist_followers'], slice_ids['playlist_length'])
+    head = slice_ids['pos'] < tracks_per_playlist
+
+    aggregates = {
+        'position_counts': np.bincount(slice_ids['pos']).astype(np.int64),
+        'num_playlists': np.int64(len(slice_ids['playlist_pid'])),
+        'num_tracks': np.int64(len(slice_ids['pos'])),
+    }
+    for kind in URI_KINDS:
+        ids, rows = np.unique(global_ids[kind], return_inverse=True)
+        aggregates[f'{kind}_ids'] = ids.astype(np.int32)
+        aggregates[f'{kind}_counts'] = np.bincount(rows, minlength=len(ids)).astype(np.int64)
+        aggregates[f'{kind}_head_counts'] = np.bincount(rows[head], minlength=len(ids)).astype(np.int64)
+        aggregates[f'{kind}_follower_counts'] = np.bincount(rows, weights=followers, minlength=len(ids)).astype(np.int64)
+    return aggregates
+
+
+def save_slice_aggregates(aggregates, filepath):
+    """Save aggregates as an uncompressed .npz file, replacing `filepath` only once it is complete."""
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as file:
+        np.savez(file, **aggregates)
+    os.replace(tmp_filepath, filepath)
+
+
+def merge_slice_aggregates(ids_output, num_ids=None, num_workers=1):
+    """
+    Sum the partial aggregates in <ids_output>/aggregates into dense arrays indexed by ID (of
+    length num_ids[kind], by default the largest ID seen + 1) and save them to
+    <ids_output>/popularity.npz. The slices are split into groups summed in parallel by
+    `num_workers` processes, then the group totals are added up. Returns the totals.
+    """
+
+    filepaths = [os.path.join(ids_output, 'aggregates', ff)
+                 for ff in list_mpd_slices(os.path.join(ids_output, 'aggregates'), '.npz')]
+    groups = [group.tolist() for group in np.array_split(np.array(filepaths, dtype=object), max(num_workers, 1))
+              if len(group)]
+
+    if num_workers > 1 and len(groups) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            partials = list(executor.map(_sum_slice_aggregates, groups))
+    else:
+        partials = [_sum_slice_aggregates(group) for group in groups]
+
+    sizes = dict(num_ids or {})
+    for kind in URI_KINDS:
+        sizes[kind] = max([sizes.get(kind, 0)] + [len(partial[f'{kind}_counts']) for partial in partials])
+
+    totals = {'num_playlists': np.int64(0), 'num_tracks': np.int64(0), 'num_slices': np.int64(len(filepaths)),
+              'position_counts': np.zeros(0, dtype=np.int64)}
+    totals.update({f'{kind}_{name}': np.zeros(sizes[kind], dtype=np.int64)
+                   for kind in URI_KINDS for name in AGGREGATE_COUNTS})
+    for partial in partials:
+        for key, values in partial.items():
+            if np.ndim(values) == 0:
+                totals[key] += values
+            else:
+                totals[key] = _add_padded(totals[key], values)
+
+    save_slice_aggregates(totals, os.path.join(ids_output, POPULARITY_FILENAME))
+    return totals
+
+
+def load_popularity(ids_output):
+    """Load the merged aggregates of merge_slice_aggregates as a dictionary of arrays."""
+    with np.load(os.path.join(ids_output, POPULARITY_FILENAME)) as totals:
+        return dict(totals)
+
+
+def _sum_slice_aggregates(filepaths):
+    """Process pool entry point: sum the aggregates of a group of slices into dense arrays indexed by ID."""
+    totals = {'num_playlists': np.int64(0), 'num_tracks': np.int64(0), 'position_counts': np.zeros(0, dtype=np.int64)}
+    sizes = {kind: 0 for kind in URI_KINDS}
+    for filepath in filepaths:
+        with np.load(filepath) as aggregates:
+            totals['num_playlists'] += aggregates['num_playlists']
+            totals['num_tracks'] += aggregates['num_tracks']
+            totals['position_counts'] = _add_padded(totals['position_counts'], aggregates['position_counts'])
+            for kind in URI_KINDS:
+                ids = aggregates[f'{kind}_ids']
+                sizes[kind] = max(sizes[kind], int(ids.max(initial=-1)) + 1)
+                for name in AGGREGATE_COUNTS:
+                    key = f'{kind}_{name}'
+                    total = totals.get(key, np.zeros(0, dtype=np.int64))
+                    if len(total) < sizes[kind]:
+                        # New IDs keep appearing in later slices; grow by doubling
+                        grown = np.zeros(max(sizes[kind], 2 * len(total)), dtype=np.int64)
+                        grown[:len(total)] = total
+                        total = totals[key] = grown
+                    # IDs are unique within a slice, so indexed addition counts each once
+                    total[ids] += aggregates[key]
+
+    for kind in URI_KINDS:
+        for name in AGGREGATE_COUNTS:
+            key = f'{kind}_{name}'
+            totals[key] = totals.get(key, np.zeros(0, dtype=np.int64))[:sizes[kind]]
+    return totals
+
+
+def _add_padded(a, b):
+    """Add two 1-D count arrays, zero-padding the shorter one."""
+    if len(a) < len(b):
+        a, b = b, a
+    a = a.copy()
+    a[:len(b)] += b
+    return a
+
+
+# ---------- Output Formats ---------- #
+
+def _import_pyarrow():
+    """Import pyarrow on demand so that CSV-only use does not require it."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet output requires pyarrow (pip install pyarrow).") from e
+    return pa, pq
+
+
+class CsvRowWriter:
+    """Write rows to a CSV file, starting with a header row. Missing playlist tracks are padded with 0."""
+
+    pad_value = 0
+
+    def __init__(self, filepath, columns, column_types=None):
+        self.file = open(filepath, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ParquetRowWriter:
+    """
+    Write rows to a Parquet file. Rows are buffered column-wise and written one row group
+    at a time, so memory is bounded by `row_group_size`. Missing playlist tracks are null.
+    """
+
+    pad_value = None
+
+    def __init__(self, filepath, columns, column_types, row_group_size=100_000):
+        pa, pq = _import_pyarrow()
+        self.pa = pa
+        self.types = [column_types[col] for col in columns]
+        self.schema = pa.schema([(col, self._arrow_type(t)) for col, t in zip(columns, self.types)])
+        self.writer = pq.ParquetWriter(filepath, self.schema)
+        self.row_group_size = row_group_size
+        self.buffers = [[] for _ in columns]
+
+    def _arrow_type(self, type_name):
+        if type_name == 'dictionary':
+            return self.pa.dictionary(self.pa.int32(), self.pa.string())
+        if type_name == 'bool':
+            return self.pa.bool_()
+        return getattr(self.pa, type_name)()
+
+    def _arrow_array(self, values, type_name):
+        if type_name == 'dictionary':
+            return self.pa.array(values, self.pa.string()).dictionary_encode()
+        if type_name == 'bool':
+            # MPD stores booleans as 'true' / 'false' strings
+            return self.pa.array([value in (True, 'true') for value in values], self.pa.bool_())
+        return self.pa.array(values, self._arrow_type(type_name))
+
+    def writerow(self, row):
+        for buffer, value in zip(self.buffers, row):
+            buffer.append(value)
+        if len(self.buffers[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffers[0]:
+            return
+        arrays = [self._arrow_array(values, t) for values, t in zip(self.buffers, self.types)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        self.buffers = [[] for _ in self.buffers]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TimedRowWriter:
+    """Wrap a row writer and add up the seconds spent writing rows and closing, for instrumentation."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pad_value = writer.pad_value
+        self.seconds = 0.0
+
+    def writerow(self, row):
+        start = time.perf_counter()
+        self.writer.writerow(row)
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        start = time.perf_counter()
+        self.writer.close()
+        self.seconds += time.perf_counter() - start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NullRowWriter:
+    """Row writer that discards its rows, for outputs that are not being rebuilt."""
+
+    pad_value = None
+
+    def __init__(self, filepath, columns, column_types=None):
+        pass
+
+    def writerow(self, row):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+ROW_WRITERS = {'csv': CsvRowWriter, 'parquet': ParquetRowWriter}
+
+
+def mpd_table_filepaths(path):
+    """Return [path] for a table file, or the slice files of an output directory in playlist ID order."""
+    if os.path.isdir(path):
+        # Prefer Parquet slices when a directory holds both formats
+        filenames = list_mpd_slices(path, '.parquet') or list_mpd_slices(path, '.csv')
+        filepaths = [os.path.join(path, ff) for ff in filenames]
+    else:
+        filepaths = [path]
+
+    if not filepaths:
+        raise FileNotFoundError(f"No .csv or .parquet slices found in {path}")
+    return filepaths
+
+
+def load_mpd_table(path, columns=None, index_col=None):
+    """
+    Load a playlist or track table written by this script into a DataFrame.
+
+    `path` may be a single .csv / .parquet file (e.g. playlists_2017.csv) or an output
+    directory of slices (e.g. ../data/tracks), in which case all slices are concatenated
+    in playlist ID order. Only the requested `columns` are read. Parquet URI columns load
+    as pandas categoricals.
+    """
+
+    filepaths = mpd_table_filepaths(path)
+
+    if filepaths[0].endswith('.parquet'):
+        pa, pq = _import_pyarrow()
+        table = pa.concat_tables([pq.read_table(fp, columns=columns) for fp in filepaths])
+        # Slices each carry their own dictionaries; merge them so columns load as one categorical
+        df = table.unify_dictionaries().to_pandas()
+    else:
+        df = pd.concat([pd.read_csv(fp, usecols=columns) for fp in filepaths], ignore_index=True)
+        if columns is not None:
+            df = df[columns]
+
+    if index_col is not None:
+        df.set_index(index_col, inplace=True)
+
+    return df
+
+
+# ---------- Consolidation ---------- #
+
+# Columns of the de-duplicated tables built by consolidate_mpd_data, each unique on its last column
+UNIQUE_TABLE_COLUMNS = {
+    'unique_tracks': ['track_name', 'track_uri', 'album_name', 'album_uri', 'artist_name', 'artist_uri', 'duration_ms'],
+    'unique_albums': ['album_name', 'album_uri'],
+    'unique_artists': ['artist_name', 'artist_uri'],
+}
+
+
+def consolidate_mpd_data(out_path='../data', include_tracks=True, chunk_rows=100_000):
+    """
+    Combine the playlist and track slices in <out_path>/playlists and <out_path>/tracks into
+    single tables in <out_path>, in the slices' format:
+
+        - playlists: every playlist slice, in playlist ID order
+        - tracks: every track slice (skipped if `include_tracks` is False)
+        - unique_tracks: track_name, track_uri, album_name, album_uri, artist_name, artist_uri, duration_ms
+        - unique_albums: album_name, album_uri
+        - unique_artists: artist_name, artist_uri
+
+    Replaces the pd.concat loops of parse_spotify_mpd_data.ipynb. Each slice is read once and
+    appended to the outputs `chunk_rows` rows at a time, so memory does not grow with the
+    number of slices. Unique tables keep the first row seen for each URI; URIs already seen are
+    tracked by their 64-bit hashes (pd.util.hash_array) in a SeenHashes, 8 bytes per URI. Outputs are written to temporary files
+    and renamed when complete. Returns the number of rows of each unique table.
+    """
+
+    output_filepath_root = os.path.relpath(out_path)
+    playlist_files = mpd_table_filepaths(os.path.join(output_filepath_root, 'playlists'))
+    track_files = mpd_table_filepaths(os.path.join(output_filepath_root, 'tracks'))
+    output_format = playlist_files[0].rsplit('.', 1)[-1]
+
+    # Playlist and track slices are copied through unchanged
+    tables = [('playlists', playlist_files)] + ([('tracks', track_files)] if include_tracks else [])
+    for name, filepaths in tables:
+        output_filepath = os.path.join(output_filepath_root, f'{name}.{output_format}')
+        print(f'Concatenating {len(filepaths)} {name} slices...')
+        with instrumentation.timed('ingest_stage_seconds', stage='concatenate'):
+            concatenate_slices(filepaths, output_filepath, chunk_rows)
+        instrumentation.count('ingest_bytes_read_total', sum(os.path.getsize(f) for f in filepaths), stage='concatenate')
+        print(f'Saved to {output_filepath}')
+
+    # Unique tracks, albums and artists in order of first appearance
+    column_types = {col: ('string' if TRACK_TYPES[col] == 'dictionary' else TRACK_TYPES[col])
+                    for col in UNIQUE_TABLE_COLUMNS['unique_tracks']}
+    appenders = {name: TableAppender(os.path.join(output_filepath_root, f'{name}.{output_format}'), columns, column_types)
+                 for name, columns in UNIQUE_TABLE_COLUMNS.items()}
+    seen_hashes = {kind: SeenHashes() for kind in URI_KINDS}
+
+    print('\nDe-duplicating tracks, albums and artists...')
+    try:
+        for ii, filepath in enumerate(track_files):
+            added = 0
+            slice_start = time.perf_counter()
+            for chunk in iter_table_chunks(filepath, UNIQUE_TABLE_COLUMNS['unique_tracks'], chunk_rows):
+                new_tracks = _unseen_rows(chunk, 'track_uri', seen_hashes['track'])
+                appenders['unique_tracks'].append(new_tracks)
+                # An album or artist is first seen together with one of its tracks, so only new tracks can add them
+                for kind, name in [('album', 'unique_albums'), ('artist', 'unique_artists')]:
+                    appenders[name].append(_unseen_rows(new_tracks[UNIQUE_TABLE_COLUMNS[name]], kind + '_uri',
+                                                        seen_hashes[kind]))
+                added += len(new_tracks)
+            instrumentation.observe('ingest_stage_seconds', time.perf_counter() - slice_start, stage='deduplicate')
+            print(f'Slice {ii + 1} of {len(track_files)}: {added} unique tracks added')
+            instrumentation.count('ingest_bytes_read_total', os.path.getsize(filepath), stage='deduplicate')
+    finally:
+        for appender in appenders.values():
+            appender.close()
+
+    for name, appender in appenders.items():
+        print(f'{appender.rows} rows saved to {appender.filepath}')
+        instrumentation.count('ingest_rows_written_total', appender.rows, table=name)
+
+    return {name: appender.rows for name, appender in appenders.items()}
+
+
+def concatenate_slices(filepaths, output_filepath, chunk_rows=100_000):
+    """
+    Concatenate table slices with identical columns into `output_filepath`.
+    CSV slices are copied byte for byte (without their repeated header rows); Parquet slices are
+    copied `chunk_rows` rows at a time.
+    """
+
+    tmp_filepath = output_filepath + '.tmp'
+
+    if output_filepath.endswith('.csv'):
+        header = None
+        with open(tmp_filepath, 'wb') as output_file:
+            for filepath in filepaths:
+                with open(filepath, 'rb') as file:
+                    first_line = file.readline()
+                    if header is None:
+                        header = first_line
+                        output_file.write(header)
+                    elif first_line != header:
+                        raise ValueError(f'{filepath} has different columns than {filepaths[0]}.')
+                    shutil.copyfileobj(file, output_file, 1 << 20)
+    else:
+        pa, pq = _import_pyarrow()
+        writer = None
+        try:
+            for filepath in filepaths:
+                parquet_file = pq.ParquetFile(filepath)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_filepath, parquet_file.schema_arrow)
+                elif not parquet_file.schema_arrow.equals(writer.schema):
+                    raise ValueError(f'{filepath} has different columns than {filepaths[0]}.')
+                for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+                    writer.write_table(pa.Table.from_batches([batch], schema=writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+
+    os.replace(tmp_filepath, output_filepath)
+
+
+def iter_table_chunks(filepath, columns=None, chunk_rows=100_000):
+    """Yield a CSV or Parquet table file as DataFrames of up to `chunk_rows` rows; string columns are plain objects."""
+    if filepath.endswith('.parquet'):
+        pa, pq = _import_pyarrow()
+        for batch in pq.ParquetFile(filepath).iter_batches(batch_size=chunk_rows, columns=columns):
+            df = batch.to_pandas()
+            for col in df.columns:
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    df[col] = df[col].astype(object)
+            yield df
+    else:
+        yield from pd.read_csv(filepath, usecols=columns, chunksize=chunk_rows)
+
+
+def _unseen_rows(df, key_col, seen_hashes):
+    """
+    Return the rows of `df` whose `key_col` value has not been seen before (first row per value),
+    and add their hashes to `seen_hashes` (a SeenHashes).
+
+    Values are compared by 64-bit hash only: two distinct URIs with the same hash would keep
+    only the first. For n distinct URIs the chance of any collision is about n^2 / 2^65, under
+    1e-6 for the MPD's 2.3 million tracks.
+    """
+    hashes = pd.util.hash_array(df[key_col].to_numpy(dtype=object))
+    unseen = ~pd.Series(hashes).duplicated().to_numpy() & ~seen_hashes.contains(hashes)
+    seen_hashes.add(hashes[unseen])
+    return df[unseen]
+
+
+class SeenHashes:
+    """
+    Set of uint64 hashes stored as sorted runs, each more than twice the size of the next.
+    Added hashes form a new run and runs are merged to keep the sizes decreasing, so adding n
+    hashes copies O(n log n) in total, and a lookup is one binary search per run (O(log n) runs).
+    """
+
+    def __init__(self):
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def contains(self, hashes):
+        """Return a boolean array: whether each hash has been added."""
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, hashes), len(run) - 1)
+            found |= run[positions] == hashes
+        return found
+
+    def add(self, hashes):
+        """Add hashes not already in the set."""
+        if len(hashes) == 0:
+            return
+        self.runs.append(np.sort(hashes))
+        while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+            last = self.runs.pop()
+            self.runs[-1] = np.sort(np.concatenate([self.runs[-1], last]), kind='stable')
+
+
+class TableAppender:
+    """
+    Append DataFrame chunks to one CSV or Parquet file (chosen by the file extension). Rows are
+    written to <filepath>.tmp, which replaces `filepath` on close.
+    """
+
+    def __init__(self, filepath, columns, column_types):
+        self.filepath = filepath
+        self.columns = columns
+        self.rows = 0
+        self.tmp_filepath = filepath + '.tmp'
+
+        if filepath.endswith('.parquet'):
+            pa, pq = _import_pyarrow()
+            self.pa = pa
+            self.schema = pa.schema([(col, getattr(pa, column_types[col])()) for col in columns])
+            self.writer = pq.ParquetWriter(self.tmp_filepath, self.schema)
         else:
-            playlist_json['description'] = ''
-            
-        playlist_json['modified_at'] = playlist['modified_at']
-        playlist_json['num_artists'] = playlist['num_artists']
-        playlist_json['num_albums'] = playlist['num_albums']
-        playlist_json['num_tracks'] = playlist['num_tracks']
-        playlist_json['num_followers'] = playlist['num_followers']
-        playlist_json['num_edits'] = playlist['num_edits']
-        playlist_json['duration_ms'] = playlist['duration_ms']
-        playlist_json['collaborative'] = playlist['collaborative']
-        
-        playlists_json_list.append(playlist_json)
-        
-        
-        # -- Creating tracks csv
-        # Each playlist has any number of tracks.
-        # Use the *PID* to affiliate tracks with playlists
-        
-        # -- Saving tracks for each playlist
-        # Add n tracks as features to the playlist csv
-        # Where n is the input tracks_per_playlist
-        # Format: track_1_uri, track_2_uri,...
-        #         track_1_album_uri
-        #         track_1_artist_uri
-        #
-        # Use padding where track does not exist (only 5 tracks in playlist when we want 15)
-
-        track_counter = 1
-        
-        for track in playlist['tracks']:
-            
-            if track_counter <= tracks_per_playlist:
-                
-                # Track URI
-                track_feature_name = 'track_' + str(track_counter) + '_uri'
-                playlist_json[track_feature_name] = track['track_uri']
-                
-                # Album URI
-                album_feature_name = 'track_' + str(track_counter) + '_album_uri'
-                playlist_json[album_feature_name] = track['album_uri']
-                
-                # Arist URI
-                artist_feature_name = 'track_' + str(track_counter) + '_artist_uri'
-                playlist_json[artist_feature_name] = track['artist_uri']
-            
-            track_counter += 1
-
-            # Create tracks CSV
-            tracks_json = {}
-            tracks_json['pid'] = playlist['pid']
-            tracks_json['track_name'] = track['track_name']
-            tracks_json['track_uri'] = track['track_uri']
-            tracks_json['album_name'] = track['album_name']
-            tracks_json['album_uri'] = track['album_uri']
-            tracks_json['artist_name'] = track['artist_name']
-            tracks_json['artist_uri'] = track['artist_uri']
-            tracks_json['duration_ms'] = track['duration_ms']
-            tracks_json['pos'] = track['pos']
-            
-            tracks_json_list.append(tracks_json)
-            
-        # Check if there weren't enough tracks and we need to add padding
-        while track_counter <= tracks_per_playlist:
-            # Resume track_counter, but now we assign '0' values
-            # Track URI
-            track_feature_name = 'track_' + str(track_counter) + '_uri'
-            playlist_json[track_feature_name] = 0
-
-            # Album URI
-            album_feature_name = 'track_' + str(track_counter) + '_album_uri'
-            playlist_json[album_feature_name] = 0
-
-            # Arist URI
-            artist_feature_name = 'track_' + str(track_counter) + '_artist_uri'
-            playlist_json[artist_feature_name] = 0
-            
-            track_counter += 1
-            
-    # Now that we've parsed through the JSON, save data to CSV
-    
-    # mpd_playlists.csv
-    with open(f"{output_filepaths[0]}/{playlist_csv_name}.csv", 'w') as file:
-        dw = csv.DictWriter(file, playlists_json_list[0].keys())
-        dw.writeheader()
-        dw.writerows(playlists_json_list)
-        print(f"{playlist_csv_name}.csv saved to {output_filepaths[0]}")
-    
-    # mpd_tracks.csv
-    with open(f"{output_filepaths[1]}/{tracks_csv_name}.csv", 'w') as file:
-        dw = csv.DictWriter(file, tracks_json_list[0].keys())
-        dw.writeheader()
-        dw.writerows(tracks_json_list)
-        print(f"{tracks_csv_name}.csv saved to {output_filepaths[1]}")
-        
+            self.file = open(self.tmp_filepath, 'w', newline='')
+            pd.DataFrame(columns=columns).to_csv(self.file, index=False)
+
+    def append(self, df):
+        df = df[self.columns]
+        if self.filepath.endswith('.parquet'):
+            self.writer.write_table(self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        else:
+            df.to_csv(self.file, header=False, index=False)
+        self.rows += len(df)
+
+    def close(self):
+        if self.filepath.endswith('.parquet'):
+            self.writer.close()
+        else:
+            self.file.close()
+        os.replace(self.tmp_filepath, self.filepath)
+
+
+# ---------- Playlist Subsets ---------- #
+
+def add_date_columns(playlist_df):
+    """Add modified_at_date, _year, _month, _day and _dow (Monday = 0) columns derived from modified_at, in place."""
+    dates = pd.to_datetime(playlist_df['modified_at'], unit='s')
+    playlist_df['modified_at_date'] = dates
+    playlist_df['modified_at_year'] = dates.dt.year
+    playlist_df['modified_at_month'] = dates.dt.month
+    playlist_df['modified_at_day'] = dates.dt.day
+    playlist_df['modified_at_dow'] = dates.dt.dayofweek
+    return playlist_df
+
+
+def _epoch_seconds(value):
+    """Seconds since the epoch of a number (returned as is) or anything pd.Timestamp accepts, read as UTC."""
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return value
+    return pd.Timestamp(value).timestamp()
+
+
+def extract_playlist_subset(playlist_df, track_df, start=None, end=None, playlist_tracks_df=None):
+    """
+    Select the playlists last modified in [start, end) and the tracks, albums and artists they contain,
+    as done for the 2017 subset in save_clean_data.ipynb.
+
+    `playlist_df` is indexed by pid (playlists.csv) and `track_df` by unique track_uri (unique_tracks.csv).
+    `start` and `end` are modified_at bounds in seconds or dates such as '2017-01-01' (UTC); None
+    leaves that side open. Tracks are those in the track_N_uri columns of the selected playlists,
+    or, if the MPD tracks table is given as `playlist_tracks_df`, all tracks of those playlists.
+
+    Returns a dictionary of DataFrames:
+        - 'playlists': the selected playlists with date columns (see add_date_columns)
+        - 'tracks': their tracks in track_df order, with a popularity column (appearances in the subset)
+        - 'albums': album_name, album_uri, artist_name, popularity (appearances of the album's tracks)
+        - 'artists': artist_name, artist_uri, popularity (appearances of the artist's tracks)
+    """
+
+    modified_at = playlist_df['modified_at'].to_numpy()
+    in_window = np.ones(len(playlist_df), dtype=bool)
+    if start is not None:
+        in_window &= modified_at >= _epoch_seconds(start)
+    if end is not None:
+        in_window &= modified_at < _epoch_seconds(end)
+    playlists = add_date_columns(playlist_df[in_window].copy())
+
+    # Track URIs of the subset, as track_df row numbers; padding and unknown URIs become -1
+    if playlist_tracks_df is None:
+        track_uri_cols = [col for col in playlists.columns
+                          if col.startswith('track_') and col.endswith('_uri')
+                          and 'album' not in col and 'artist' not in col]
+        uris = playlists[track_uri_cols].to_numpy().ravel()
+    else:
+        uris = playlist_tracks_df.loc[playlist_tracks_df['pid'].isin(playlists.index), 'track_uri'].to_numpy()
+    track_ids = track_df.index.get_indexer(uris)
+
+    counts = np.bincount(track_ids[track_ids >= 0], minlength=len(track_df))
+    tracks = track_df[counts > 0].copy()
+    tracks['popularity'] = counts[counts > 0]
+
+    subset = {'playlists': playlists, 'tracks': tracks}
+    for kind, columns in [('album', ['album_name', 'album_uri', 'artist_name']), ('artist', ['artist_name', 'artist_uri'])]:
+        # Codes follow first appearance, so the first row of each code is in code order
+        codes, _ = pd.factorize(tracks[kind + '_uri'])
+        first_rows = np.unique(codes[codes >= 0], return_index=True)[1]
+        table = tracks.iloc[first_rows][columns].reset_index(drop=True)
+        table['popularity'] = np.bincount(codes[codes >= 0], weights=tracks['popularity'].to_numpy()[codes >= 0],
+                                          minlength=len(table)).astype(np.int64)
+        subset[kind + 's'] = table
+
+    return subset
+
+
+def save_playlist_subset(subset, out_path='../data', name='2017', output_format='csv'):
+    """
+    Save the tables of extract_playlist_subset as <out_path>/playlists_<name>, tracks_<name>,
+    albums_<name> and artists_<name> (.csv or .parquet). Index columns (pid, track_uri) are saved
+    as regular columns, so the files load with load_mpd_table(path, index_col=...).
+    """
+    filepaths = []
+    for table_name, df in subset.items():
+        filepath = os.path.join(out_path, f'{table_name}_{name}.{output_format}')
+        df = df.reset_index() if df.index.name is not None else df
+        if output_format == 'parquet':
+            _import_pyarrow()
+            df.to_parquet(filepath, index=False)
+        else:
+            df.to_csv(filepath, index=False)
+        print(f'{len(df)} rows saved to {filepath}')
+        filepaths.append(filepath)
+    return filepaths
+
 
 def delete_data_files(playlist_output, track_output):
     """
@@ -274,8 +1447,48 @@ def delete_data_files(playlist_output, track_output):
 
 # Running from Command Line
 if __name__ == "__main__":
-    path = sys.argv[1]
-    num_tracks = sys.argv[2]
-    # if len(sys.argv) > 2 and sys.argv[2] == "--quick":
-    #     quick = True
-    # process_mpd(path)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Parse Spotify's MPD JSON slices into CSV slices.")
+    parser.add_argument('path', nargs='?', default='', help='directory containing the MPD JSON slice files')
+    parser.add_argument('--num-tracks', type=int, default=15, help='tracks saved as columns of each playlist row')
+    parser.add_argument('--out', default='../data', help='base output directory')
+    parser.add_argument('--workers', type=int, default=1, help='number of slices parsed concurrently')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help='output file format')
+    parser.add_argument('--encode-ids', action='store_true', help='also write ID-encoded tables and URI dictionaries')
+    parser.add_argument('--force', action='store_true', help='reparse every slice, ignoring the manifest')
+    parser.add_argument('--consolidate', action='store_true',
+                        help='then combine the slices into playlists, tracks and unique_tracks/albums/artists tables')
+    parser.add_argument('--subset', nargs=3, action='append', default=[], metavar=('NAME', 'START', 'END'),
+                        help='then save the playlists modified in [START, END) and their tracks, albums and artists '
+                             'as *_NAME tables, e.g. --subset 2017 2017-01-01 2018-01-01 (repeatable; needs --consolidate '
+                             'or the tables of a previous run)')
+    parser.add_argument('--playlist-store', action='store_true',
+                        help='then build a ragged PlaylistStore of full playlists in <out>/playlist_store (implies --encode-ids)')
+    parser.add_argument('--metrics', default=None,
+                        help='record ingest metrics and write them to this file (Prometheus text if it ends in .prom, else JSON)')
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrumentation.enable()
+
+    process_mpd_data(args.path, num_tracks=args.num_tracks, out_path=args.out, num_workers=args.workers,
+                     output_format=args.format, encode_ids=args.encode_ids or args.playlist_store, force=args.force)
+
+    if args.playlist_store:
+        from playliststore import PlaylistStore
+        store = PlaylistStore.build(os.path.join(args.out, 'playlist_store'), os.path.join(args.out, 'ids'))
+        print(f"\nPlaylistStore: {len(store)} playlists, {store.meta['num_tracks']} tracks")
+
+    if args.consolidate:
+        consolidate_mpd_data(args.out)
+
+    if args.subset:
+        playlist_df = load_mpd_table(os.path.join(args.out, f'playlists.{args.format}'), index_col='pid')
+        track_df = load_mpd_table(os.path.join(args.out, f'unique_tracks.{args.format}'), index_col='track_uri')
+        for name, start, end in args.subset:
+            subset = extract_playlist_subset(playlist_df, track_df,
+                                             *[float(bound) if bound.isdigit() else bound for bound in (start, end)])
+            save_playlist_subset(subset, args.out, name, args.format)
+
+    if args.metrics:
+        instrumentation.METRICS.save(args.metrics)
+        print(f'Metrics saved to {args.metrics}')
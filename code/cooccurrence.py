@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""
+This module creates a CooccurrenceIndex: for every track, the top-N tracks that appear in the
+same playlists, for "tracks often found together" recommendations.
+
+Co-occurrence counts are the entries of X.T @ X, where X is the sparse (scipy CSR) binary
+playlist x track matrix. They are computed a range of tracks at a time, optionally in several
+processes, and each track's row is pruned to its top-N neighbours before the next range, so
+the full track x track matrix is never held in memory.
+
+Usage:
+    python3 cooccurrence.py ../data/ids [--out ../data/cooccurrence] [--neighbours 100] [--workers 4]
+
+where ../data/ids is the output of clean_raw_data.py --encode-ids.
+"""
+
+# ---------- Imports ---------- #
+import os
+import json
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import clean_raw_data
+
+
+# Neighbour scores: raw co-occurrence counts, or counts / sqrt(playlists of each track)
+SIMILARITIES = ['count', 'cosine']
+
+
+def _import_scipy_sparse():
+    """Import scipy.sparse on demand so that the rest of the package does not require scipy."""
+    try:
+        import scipy.sparse as sparse
+    except ImportError as e:
+        raise ImportError("The co-occurrence index requires scipy (pip install scipy).") from e
+    return sparse
+
+
+# ---------- Playlist x Track Matrix ---------- #
+
+def playlist_track_matrix(pids, track_ids, num_tracks=None):
+    """
+    Return the binary playlist x track CSR matrix of (pid, track_id) rows, such as the ID-encoded
+    tracks table. Rows must be grouped by playlist (as written by clean_raw_data.py); playlist rows
+    are numbered in order of appearance and a track repeated within a playlist counts once.
+    """
+    sparse = _import_scipy_sparse()
+
+    pids = np.asarray(pids)
+    track_ids = np.asarray(track_ids, dtype=np.int32)
+    num_tracks = int(track_ids.max(initial=-1)) + 1 if num_tracks is None else num_tracks
+
+    rows = np.cumsum(np.r_[False, pids[1:] != pids[:-1]]) if len(pids) else np.zeros(0, dtype=np.int64)
+    num_playlists = int(rows[-1]) + 1 if len(rows) else 0
+
+    matrix = sparse.csr_matrix((np.ones(len(track_ids), dtype=np.int32), (rows, track_ids)),
+                               shape=(num_playlists, num_tracks))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def chunk_boundaries(playlist_tracks, max_chunk_cost=20_000_000):
+    """
+    Split the track IDs into contiguous ranges whose co-occurrence rows cost about `max_chunk_cost`
+    multiply-adds each; the cost of a track is the total length of the playlists it appears in.
+    """
+    playlist_lengths = np.diff(playlist_tracks.indptr).astype(np.int64)
+    track_costs = np.asarray(playlist_tracks.T @ playlist_lengths).ravel()
+
+    cumulative = np.cumsum(track_costs)
+    boundaries = [0]
+    while boundaries[-1] < len(track_costs):
+        start_cost = cumulative[boundaries[-1] - 1] if boundaries[-1] > 0 else 0
+        stop = int(np.searchsorted(cumulative, start_cost + max_chunk_cost, side='right'))
+        boundaries.append(min(max(stop, boundaries[-1] + 1), len(track_costs)))
+    return boundaries
+
+
+# ---------- CooccurrenceIndex Class ---------- #
+
+class CooccurrenceIndex:
+    """
+    Top-N co-occurrence neighbours of every track, stored as a CSR matrix: the neighbours of
+    track t are neighbours.indices[indptr[t]:indptr[t + 1]], best first, with scores in
+    neighbours.data. Track IDs are row numbers in `track_uris`.
+    """
+
+    def __init__(self, track_uris, neighbours, meta=None):
+
+        self.track_uris = np.asarray(track_uris, dtype=object)
+        self.track_uri_index = pd.Index(self.track_uris)
+        self.neighbours = neighbours
+        self.meta = meta or {}
+
+
+    def __len__(self):
+        return len(self.track_uris)
+
+
+    @classmethod
+    def build(cls, playlist_tracks, track_uris, num_neighbours=100, similarity='count', min_count=1,
+              num_workers=1, max_chunk_cost=20_000_000, scratch_directory=None):
+        """
+        Build the index from a playlist x track matrix (see playlist_track_matrix).
+
+        Pairs seen together in fewer than `min_count` playlists are dropped. Track ranges of
+        about `max_chunk_cost` multiply-adds (see chunk_boundaries) are processed by `num_workers`
+        processes; peak memory per process grows with `max_chunk_cost`.
+
+        With several workers, the matrices are written once as .npy files to a temporary directory
+        (in `scratch_directory` if given) that every worker memory-maps, so they share one
+        page-cache copy instead of each unpickling its own.
+        """
+        sparse = _import_scipy_sparse()
+
+        if similarity not in SIMILARITIES:
+            raise ValueError(f'Unknown similarity {similarity!r}; expected one of {SIMILARITIES}.')
+
+        playlist_tracks = playlist_tracks.tocsr()
+        track_playlists = playlist_tracks.T.tocsr()
+        boundaries = chunk_boundaries(playlist_tracks, max_chunk_cost)
+        tasks = [(start, stop, num_neighbours, similarity, min_count)
+                 for start, stop in zip(boundaries[:-1], boundaries[1:])]
+
+        # Each worker opens the matrices once, then computes one track range per task
+        matrices = (track_playlists, playlist_tracks)
+        if num_workers > 1:
+            with tempfile.TemporaryDirectory(dir=scratch_directory) as matrix_directory:
+                for name, matrix in zip(MATRIX_NAMES, matrices):
+                    _save_csr(matrix_directory, name, matrix)
+                with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_cooccurrence_worker,
+                                         initargs=(matrix_directory,)) as executor:
+                    chunks = list(executor.map(_cooccurrence_chunk, tasks))
+        else:
+            _init_cooccurrence_worker(matrices)
+            chunks = [_cooccurrence_chunk(task) for task in tasks]
+
+        row_lengths = np.concatenate([lengths for lengths, _, _ in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+        indptr = np.zeros(playlist_tracks.shape[1] + 1, dtype=np.int64)
+        np.cumsum(row_lengths, out=indptr[1:])
+        indices = np.concatenate([indices for _, indices, _ in chunks]) if chunks else np.zeros(0, dtype=np.int32)
+        scores = np.concatenate([scores for _, _, scores in chunks]) if chunks else np.zeros(0, dtype=np.float32)
+
+        neighbours = sparse.csr_matrix((scores, indices, indptr), shape=(playlist_tracks.shape[1],) * 2)
+        meta = {'num_neighbours': num_neighbours, 'similarity': similarity, 'min_count': min_count,
+                'num_playlists': playlist_tracks.shape[0], 'num_pairs': int(playlist_tracks.nnz)}
+        return cls(track_uris, neighbours, meta)
+
+
+    @classmethod
+    def from_ids_output(cls, ids_output, **kwargs):
+        """Build the index from the ID-encoded tables written by clean_raw_data.py --encode-ids."""
+        tracks = clean_raw_data.load_mpd_table(os.path.join(ids_output, 'tracks'), columns=['pid', 'track_id'])
+        track_uris = clean_raw_data.load_uri_dictionaries(ids_output)['track'].uris
+        playlist_tracks = playlist_track_matrix(tracks['pid'].to_numpy(), tracks['track_id'].to_numpy(),
+                                                num_tracks=len(track_uris))
+        del tracks
+        return cls.build(playlist_tracks, track_uris, **kwargs)
+
+
+    # ---------- Recommendations ---------- #
+
+    def neighbours_of(self, track_id):
+        """Return the neighbour track IDs and scores of one track, best first."""
+        start, stop = self.neighbours.indptr[track_id], self.neighbours.indptr[track_id + 1]
+        return self.neighbours.indices[start:stop], self.neighbours.data[start:stop]
+
+
+    def recommend_tracks(self, num_tracks=5, input_track_uris=[]):
+        """
+        Recommend the tracks that co-occur most with the input tracks: the neighbour lists of the
+        input tracks are merged, adding up the scores of tracks found in several lists.
+        Input tracks not in the index are ignored.
+        """
+
+        seed_ids = []
+        for uri in input_track_uris:
+            try:
+                seed_ids.append(self.track_uri_index.get_loc(uri))
+            except KeyError:
+                continue
+
+        if not seed_ids:
+            return []
+
+        lists = [self.neighbours_of(track_id) for track_id in seed_ids]
+        candidates, position = np.unique(np.concatenate([ids for ids, _ in lists]), return_inverse=True)
+        totals = np.bincount(position, weights=np.concatenate([scores for _, scores in lists]),
+                             minlength=len(candidates))
+
+        # Never recommend a seed track; ties go to the lower track ID
+        totals[np.isin(candidates, seed_ids)] = -np.inf
+        ranked = np.argsort(-totals, kind='stable')[:num_tracks]
+        recommended_ids = candidates[ranked[np.isfinite(totals[ranked])]]
+
+        return self.track_uris[recommended_ids].tolist()
+
+
+    # ---------- Persistence ---------- #
+
+    def save(self, directory):
+        sparse = _import_scipy_sparse()
+        os.makedirs(directory, exist_ok=True)
+        sparse.save_npz(os.path.join(directory, 'neighbours.npz'), self.neighbours, compressed=False)
+        with open(os.path.join(directory, 'track_uris.txt'), 'w') as file:
+            file.write('\n'.join(self.track_uris))
+        with open(os.path.join(directory, 'meta.json'), 'w') as file:
+            json.dump(self.meta, file)
+
+
+    @classmethod
+    def load(cls, directory):
+        sparse = _import_scipy_sparse()
+        with open(os.path.join(directory, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        with open(os.path.join(directory, 'track_uris.txt'), 'r') as file:
+            track_uris = file.read().split('\n')
+        return cls(track_uris, sparse.load_npz(os.path.join(directory, 'neighbours.npz')).tocsr(), meta)
+
+
+# ---------- Worker Processes ---------- #
+
+# (track x playlist, playlist x track) matrices of the worker, set once by _init_cooccurrence_worker
+_matrices = None
+
+# File name prefixes of the matrices shared with worker processes
+MATRIX_NAMES = ('track_playlists', 'playlist_tracks')
+
+
+def _init_cooccurrence_worker(matrices):
+    """Set the worker's matrices: a (track_playlists, playlist_tracks) pair, or the directory they were saved to."""
+    global _matrices
+    if isinstance(matrices, str):
+        matrices = tuple(_load_csr(matrices, name) for name in MATRIX_NAMES)
+    _matrices = matrices
+
+
+def _save_csr(directory, name, matrix):
+    """Save the arrays and shape of a CSR matrix as <name>.*.npy files, to be memory-mapped by _load_csr."""
+    for part in ['data', 'indices', 'indptr']:
+        np.save(os.path.join(directory, f'{name}.{part}.npy'), getattr(matrix, part))
+    np.save(os.path.join(directory, f'{name}.shape.npy'), np.array(matrix.shape, dtype=np.int64))
+
+
+def _load_csr(directory, name):
+    """Open a CSR matrix saved by _save_csr; its arrays are read-only memory maps of the files."""
+    sparse = _import_scipy_sparse()
+    parts = [np.asarray(np.load(os.path.join(directory, f'{name}.{part}.npy'), mmap_mode='r'))
+             for part in ['data', 'indices', 'indptr']]
+    shape = tuple(np.load(os.path.join(directory, f'{name}.shape.npy')).tolist())
+    return sparse.csr_matrix(tuple(parts), shape=shape, copy=False)
+
+
+def _cooccurrence_chunk(args):
+    """
+    Compute the co-occurrence rows of tracks start..stop-1 and prune each to its top neighbours.
+    Returns (row lengths, neighbour IDs, scores) with each row's neighbours best first.
+    """
+    start, stop, num_neighbours, similarity, min_count = args
+    track_playlists, playlist_tracks = _matrices
+
+    counts = (track_playlists[start:stop] @ playlist_tracks).tocsr()
+    counts.sort_indices()
+    rows = np.repeat(np.arange(stop - start), np.diff(counts.indptr))
+    indices, scores = counts.indices, counts.data.astype(np.float32)
+
+    # Drop each track's count with itself and rare pairs
+    keep = (indices != rows + start) & (counts.data >= min_count)
+    rows, indices, scores = rows[keep], indices[keep], scores[keep]
+
+    if similarity == 'cosine':
+        track_counts = np.diff(track_playlists.indptr).astype(np.float32)
+        scores = scores / np.sqrt(track_counts[rows + start] * track_counts[indices])
+
+    # Sort by row, then score (descending), then neighbour ID, and keep the first num_neighbours per row.
+    # One int64 key (row, inverted float32 bits of the positive score) sorts much faster than
+    # np.lexsort; the stable sort keeps neighbour IDs ascending within equal scores.
+    key = (rows.astype(np.int64) << 32) | (0x7FFFFFFF - scores.view(np.int32)).astype(np.int64)
+    order = np.argsort(key, kind='stable')
+    rows, indices, scores = rows[order], indices[order], scores[order]
+    row_lengths = np.bincount(rows, minlength=stop - start)
+    rank = np.arange(len(rows)) - np.repeat(np.cumsum(row_lengths) - row_lengths, row_lengths)
+    keep = rank < num_neighbours
+
+    return (np.minimum(row_lengths, num_neighbours).astype(np.int64),
+            indices[keep].astype(np.int32), scores[keep])
+
+
+# Running from Command Line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a track co-occurrence index from ID-encoded MPD tables.')
+    parser.add_argument('ids', help='ID-encoded output directory of clean_raw_data.py --encode-ids')
+    parser.add_argument('--out', default='../data/cooccurrence', help='directory to save the index to')
+    parser.add_argument('--neighbours', type=int, default=100, help='neighbours kept per track')
+    parser.add_argument('--similarity', choices=SIMILARITIES, default='count')
+    parser.add_argument('--min-count', type=int, default=1, help='minimum playlists a pair must share')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes')
+    parser.add_argument('--chunk-cost', type=int, default=20_000_000, help='multiply-adds per track range')
+    args = parser.parse_args()
+
+    index = CooccurrenceIndex.from_ids_output(args.ids, num_neighbours=args.neighbours, similarity=args.similarity,
+                                              min_count=args.min_count, num_workers=args.workers,
+                                              max_chunk_cost=args.chunk_cost)
+    index.save(args.out)
+    print(f'{len(index)} tracks, {index.neighbours.nnz} neighbour pairs saved to {args.out}')
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+This module creates an approximate nearest-neighbour EmbeddingIndex over track embeddings
+(e.g. the word2vec vectors trained in jlj/jl_word2vec.ipynb) for playlist recommendations.
+
+The index is an inverted file (IVF): vectors are clustered with k-means and stored grouped by
+cluster, and a query only scores the vectors of the `nprobe` clusters closest to it.
+"""
+
+# ---------- Imports ---------- #
+import os
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+# ---------- EmbeddingIndex Class ---------- #
+
+class EmbeddingIndex:
+    """
+    IVF index over one embedding vector per track.
+
+    Vectors are L2-normalized, so scores are cosine similarities. The vectors of list l are
+    list_vectors[list_offsets[l]:list_offsets[l + 1]] and belong to tracks
+    list_track_ids[list_offsets[l]:list_offsets[l + 1]] (row numbers in `track_uris`).
+    """
+
+    def __init__(self, track_uris, centroids, list_offsets, list_track_ids, list_vectors, nprobe=16, build_stats=None):
+
+        self.track_uris = np.asarray(track_uris, dtype=object)
+        self.track_uri_index = pd.Index(self.track_uris)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_track_ids = list_track_ids
+        self.list_vectors = list_vectors
+        self.nprobe = nprobe
+        self.build_stats = build_stats or {}
+
+        # Row of each track's vector in list_vectors
+        self.vector_rows = np.empty(len(list_track_ids), dtype=np.int64)
+        self.vector_rows[list_track_ids] = np.arange(len(list_track_ids))
+
+
+    def __len__(self):
+        return len(self.track_uris)
+
+
+    @classmethod
+    def build(cls, vectors, track_uris, num_lists=None, nprobe=16, kmeans_iterations=10, kmeans_sample=None,
+              recall_queries=200, recall_k=10, seed=0, batch_size=65536):
+        """
+        Build an index over `vectors` (one row per track in `track_uris`).
+
+        `num_lists` defaults to about sqrt(number of tracks). k-means is fitted on a sample of
+        `kmeans_sample` vectors (default 64 per list). After building, recall@`recall_k` against
+        brute force search is measured on `recall_queries` random seed playlists, printed and
+        saved in build_stats.
+        """
+
+        rng = np.random.default_rng(seed)
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        num_tracks = len(vectors)
+        num_lists = num_lists or max(1, int(np.sqrt(num_tracks)))
+        num_lists = min(num_lists, num_tracks)
+
+        # Fit centroids on a sample, then assign every vector to its closest centroid
+        sample_size = min(num_tracks, kmeans_sample or 64 * num_lists)
+        sample = vectors[rng.choice(num_tracks, size=sample_size, replace=False)]
+        centroids = _spherical_kmeans(sample, num_lists, kmeans_iterations, rng, batch_size)
+        assignments = _closest_centroids(vectors, centroids, batch_size)
+
+        # Store vectors grouped by list so each list is one contiguous block
+        list_track_ids = np.argsort(assignments, kind='stable').astype(np.int64)
+        list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=num_lists), out=list_offsets[1:])
+
+        index = cls(track_uris, centroids, list_offsets, list_track_ids, vectors[list_track_ids], nprobe)
+        index.build_stats = index.measure_recall(recall_queries, recall_k, rng)
+        print(f"EmbeddingIndex: {num_tracks} tracks in {num_lists} lists, nprobe={nprobe}, "
+              f"recall@{recall_k} vs brute force = {index.build_stats['recall']:.3f}")
+        return index
+
+
+    # ---------- Search ---------- #
+
+    def search(self, query, k=10, nprobe=None, exclude_ids=()):
+        """Return the row numbers and scores of the `k` tracks closest to `query`, skipping `exclude_ids`."""
+
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        query = _normalize(np.asarray(query, dtype=np.float32)[None, :])[0]
+
+        # Scan the vectors of the nprobe closest lists
+        probe_lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        blocks = [slice(self.list_offsets[l], self.list_offsets[l + 1]) for l in probe_lists]
+        candidate_ids = np.concatenate([self.list_track_ids[block] for block in blocks])
+        scores = np.concatenate([self.list_vectors[block] @ query for block in blocks])
+
+        return _top_k(candidate_ids, scores, k, exclude_ids)
+
+
+    def brute_force_search(self, query, k=10, exclude_ids=()):
+        """Exact search over every vector, for measuring recall."""
+        query = _normalize(np.asarray(query, dtype=np.float32)[None, :])[0]
+        return _top_k(self.list_track_ids, self.list_vectors @ query, k, exclude_ids)
+
+
+    def measure_recall(self, num_queries=200, k=10, rng=None, seeds_per_query=5):
+        """Average recall@k of search against brute_force_search for random seed-track queries."""
+
+        rng = np.random.default_rng() if rng is None else rng
+        recalls = []
+        for _ in range(num_queries):
+            seed_ids = rng.choice(len(self), size=min(seeds_per_query, len(self)), replace=False)
+            query = self.seed_vector(seed_ids)
+            exact, _ = self.brute_force_search(query, k, seed_ids)
+            approximate, _ = self.search(query, k, exclude_ids=seed_ids)
+            if len(exact):
+                recalls.append(len(np.intersect1d(exact, approximate)) / len(exact))
+
+        return {'recall': float(np.mean(recalls)) if recalls else 1.0, 'k': k, 'queries': num_queries,
+                'nprobe': self.nprobe, 'num_lists': len(self.centroids)}
+
+
+    def seed_vector(self, seed_ids):
+        """Average of the (normalized) vectors of the seed tracks."""
+        return self.list_vectors[self.vector_rows[seed_ids]].mean(axis=0)
+
+
+    def recommend_tracks(self, num_tracks=5, input_track_uris=[]):
+        """
+        Recommend the tracks whose embeddings are closest to the average embedding of the
+        input tracks. Input tracks without an embedding are ignored.
+        """
+
+        seed_ids = []
+        for uri in input_track_uris:
+            try:
+                seed_ids.append(self.track_uri_index.get_loc(uri))
+            except KeyError:
+                continue
+
+        if not seed_ids:
+            return []
+
+        recommended_ids, _ = self.search(self.seed_vector(seed_ids), num_tracks, exclude_ids=seed_ids)
+        return self.track_uris[recommended_ids].tolist()
+
+
+    # ---------- Persistence ---------- #
+
+    def save(self, directory):
+        """Save the index to `directory`; vectors are memory-mapped when loaded back."""
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(directory, 'list_offsets.npy'), self.list_offsets)
+        np.save(os.path.join(directory, 'list_track_ids.npy'), self.list_track_ids)
+        np.save(os.path.join(directory, 'list_vectors.npy'), self.list_vectors)
+        with open(os.path.join(directory, 'track_uris.txt'), 'w') as file:
+            file.write('\n'.join(self.track_uris))
+        with open(os.path.join(directory, 'meta.json'), 'w') as file:
+            json.dump({'nprobe': self.nprobe, 'build_stats': self.build_stats}, file)
+
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        with open(os.path.join(directory, 'track_uris.txt'), 'r') as file:
+            track_uris = file.read().split('\n')
+
+        return cls(track_uris,
+                   np.load(os.path.join(directory, 'centroids.npy')),
+                   np.load(os.path.join(directory, 'list_offsets.npy')),
+                   np.load(os.path.join(directory, 'list_track_ids.npy')),
+                   np.load(os.path.join(directory, 'list_vectors.npy'), mmap_mode='r'),
+                   meta['nprobe'], meta['build_stats'])
+
+
+# ---------- Helpers ---------- #
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _closest_centroids(vectors, centroids, batch_size=65536):
+    """Index of the highest-scoring centroid for every vector, computed in batches."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        assignments[start:start + batch_size] = np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1)
+    return assignments
+
+
+def _spherical_kmeans(vectors, num_clusters, iterations, rng, batch_size=65536):
+    """k-means on normalized vectors using cosine similarity; returns normalized centroids."""
+    centroids = vectors[rng.choice(len(vectors), size=num_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = _closest_centroids(vectors, centroids, batch_size)
+
+        # Sum the vectors of each cluster
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=num_clusters)
+        starts = np.cumsum(counts) - counts
+        filled = counts > 0
+        sums = np.add.reduceat(vectors[order], starts[filled], axis=0)
+        centroids[filled] = _normalize(sums)
+
+        # Restart empty clusters from random vectors
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), size=len(empty), replace=False)]
+
+    return centroids
+
+
+def _top_k(track_ids, scores, k, exclude_ids=()):
+    """Return the k highest-scoring track IDs (and scores), best first, skipping `exclude_ids`."""
+    if len(exclude_ids):
+        keep = ~np.isin(track_ids, exclude_ids)
+        track_ids, scores = track_ids[keep], scores[keep]
+
+    k = min(k, len(scores))
+    if k == 0:
+        return track_ids[:0], scores[:0]
+
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return track_ids[top], scores[top]
+
+
+# Running from Command Line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build an EmbeddingIndex from saved track embeddings.')
+    parser.add_argument('vectors', help='.npy file with one embedding per row')
+    parser.add_argument('vocab', help='text file with the track URI of each row, one per line')
+    parser.add_argument('--out', default='../data/embedding_index', help='directory to save the index to')
+    parser.add_argument('--lists', type=int, default=None, help='number of IVF lists (default about sqrt(tracks))')
+    parser.add_argument('--nprobe', type=int, default=16, help='lists scanned per query')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    # splitlines, so a vocab file ending in a newline does not get an extra '' URI
+    with open(args.vocab, 'r') as file:
+        track_uris = file.read().splitlines()
+
+    vectors = np.load(args.vectors)
+    if len(track_uris) != len(vectors):
+        parser.error(f'{args.vocab} has {len(track_uris)} URIs but {args.vectors} has {len(vectors)} rows.')
+
+    EmbeddingIndex.build(vectors, track_uris, args.lists, args.nprobe, seed=args.seed).save(args.out)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+"""
+This script evaluates BaselineModels recommendation strategies offline with the metrics of
+the Spotify Million Playlist Dataset challenge.
+
+Usage:
+    python3 evaluation.py ../data/tracks ../data/playlists_2017.csv ../data/tracks_2017.csv
+        [--strategies popular artists_popular ...] [--playlists N] [--seeds 5] [--workers 4]
+
+For every evaluated playlist, the first `num_seeds` tracks of the tracks table are given to a
+strategy as seed tracks and the rest of the playlist is held out as ground truth G. The
+recommendations R (up to `num_tracks`, 500 in the challenge) are scored with:
+
+- R-precision: |G ∩ R[:|G|]| / |G|
+- NDCG: DCG / IDCG with DCG = rel_1 + sum_{i>=2} rel_i / log2(i) and IDCG the DCG of |G ∩ R| hits
+- clicks: number of 10-track pages shown before the first relevant track (num_tracks / 10 + 1 if none)
+
+The 'title' strategy is also given each playlist's name; with --seeds 0 it is evaluated on the
+challenge's title-only (cold-start) playlists.
+
+Metrics are track-level (the challenge's artist partial credit is not included). Note that
+popularities computed over the full tracks table include the held-out tracks.
+"""
+
+# ---------- Imports ---------- #
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import clean_raw_data
+import instrumentation
+from baselinemodels import BaselineModels
+
+
+# ---------- Strategies ---------- #
+
+# Strategy name -> (BaselineModels method, keyword arguments)
+STRATEGIES = {
+    'artists_popular': ('recommend_tracks_by_artists', {'popularity': True}),
+    'artists_random': ('recommend_tracks_by_artists', {'popularity': False}),
+    'albums_popular': ('recommend_tracks_by_albums', {'popularity': True}),
+    'albums_random': ('recommend_tracks_by_albums', {'popularity': False}),
+    'popular': ('recommend_popular_tracks', {}),
+    'embeddings': ('recommend_tracks_by_embeddings', {}),
+    'cooccurrence': ('recommend_tracks_by_cooccurrence', {}),
+    'title': ('recommend_tracks_by_title', {}),
+}
+
+# Strategies that are also given the playlist name, as name=
+TITLE_STRATEGIES = {'title'}
+
+# Strategies that need no attached index
+DEFAULT_STRATEGIES = ['artists_popular', 'artists_random', 'albums_popular', 'albums_random', 'popular']
+
+
+# ---------- Holdout ---------- #
+
+def holdout_split(tracks_df, num_seeds=5, num_playlists=None, min_holdout=1, seed=0):
+    """
+    Split playlists of a tracks table (pid, pos, track_uri columns) into seed tracks and held-out tracks.
+
+    Only playlists with at least num_seeds + min_holdout tracks are used; if `num_playlists` is
+    given, that many of them are sampled at random. Returns (pids, seeds, holdouts), where seeds
+    and holdouts are lists of track URI lists, one per playlist in pid order.
+    """
+
+    tracks_df = tracks_df[['pid', 'pos', 'track_uri']].sort_values(['pid', 'pos'], kind='stable')
+    pids = tracks_df['pid'].to_numpy()
+    uris = tracks_df['track_uri'].to_numpy()
+
+    starts = np.flatnonzero(np.r_[True, pids[1:] != pids[:-1]]) if len(pids) else np.zeros(0, dtype=np.int64)
+    lengths = np.diff(np.append(starts, len(pids)))
+
+    chosen = np.flatnonzero(lengths >= num_seeds + min_holdout)
+    if num_playlists is not None and num_playlists < len(chosen):
+        rng = np.random.default_rng(seed)
+        chosen = np.sort(rng.choice(chosen, size=num_playlists, replace=False))
+
+    seeds = [uris[start:start + num_seeds].tolist() for start in starts[chosen]]
+    holdouts = [uris[start + num_seeds:start + length].tolist()
+                for start, length in zip(starts[chosen], lengths[chosen])]
+    return pids[starts[chosen]], seeds, holdouts
+
+
+# ---------- Metrics ---------- #
+
+def score_recommendations(recommended, ground_truth, num_tracks=500):
+    """
+    Score lists of recommended track URIs against lists of held-out track URIs, one pair per playlist.
+
+    URIs are mapped to integer IDs and each (playlist, track) pair to a single integer key, so
+    hits for all playlists are found with one np.isin call. Returns a dictionary of per-playlist
+    arrays: 'r_precision', 'ndcg' and 'clicks'.
+    """
+
+    num_playlists = len(recommended)
+    rec_lengths = np.array([min(len(r), num_tracks) for r in recommended], dtype=np.int64)
+    truth_lengths = np.array([len(g) for g in ground_truth], dtype=np.int64)
+
+    flat_truth = [uri for g in ground_truth for uri in g]
+    flat_rec = [uri for r in recommended for uri in r[:num_tracks]]
+    codes, uniques = pd.factorize(pd.Series(flat_truth + flat_rec, dtype=object))
+    num_ids = len(uniques) + 1
+
+    # Ground truth as sets of (playlist, track) keys
+    truth_rows = np.repeat(np.arange(num_playlists), truth_lengths)
+    truth_keys = np.unique(truth_rows * num_ids + codes[:len(flat_truth)])
+    truth_sizes = np.bincount(truth_keys // num_ids, minlength=num_playlists)
+
+    # Recommendations as a (playlist, rank) matrix padded with -1
+    rec_ids = np.full((num_playlists, num_tracks), -1, dtype=np.int64)
+    rec_rows = np.repeat(np.arange(num_playlists), rec_lengths)
+    rec_ranks = np.arange(len(rec_rows)) - np.repeat(np.cumsum(rec_lengths) - rec_lengths, rec_lengths)
+    rec_ids[rec_rows, rec_ranks] = codes[len(flat_truth):]
+
+    keys = np.arange(num_playlists)[:, None] * num_ids + rec_ids
+    hits = (rec_ids >= 0) & np.isin(keys, truth_keys)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # R-precision: hits among the first |G| recommendations
+        in_first_g = np.arange(num_tracks)[None, :] < truth_sizes[:, None]
+        r_precision = (hits & in_first_g).sum(axis=1) / truth_sizes
+
+        # NDCG with the challenge's discount: 1 for rank 1, 1 / log2(i) for rank i >= 2
+        discounts = 1.0 / np.log2(np.maximum(np.arange(1, num_tracks + 1), 2))
+        dcg = hits @ discounts
+        ideal = np.r_[0.0, np.cumsum(discounts)][np.minimum(hits.sum(axis=1), num_tracks)]
+        ndcg = np.where(ideal > 0, dcg / ideal, 0.0)
+
+    # Clicks: pages of 10 tracks before the first hit
+    first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1), -1)
+    clicks = np.where(first_hit >= 0, first_hit // 10, num_tracks // 10 + 1)
+
+    return {'r_precision': np.nan_to_num(r_precision), 'ndcg': ndcg, 'clicks': clicks}
+
+
+# ---------- Evaluation ---------- #
+
+def evaluate(model, pids, seeds, holdouts, strategies=DEFAULT_STRATEGIES, num_tracks=500, num_workers=1,
+             chunk_size=500, seed=0, names=None):
+    """
+    Run each strategy (names in STRATEGIES) on every seed playlist and score it against the holdouts
+    (see holdout_split). Playlists are processed in chunks of `chunk_size` spread over `num_workers`
+    processes; each worker receives the model once. Random strategies get a generator per chunk
+    seeded from `seed`, so results do not depend on `num_workers`. `names` holds the playlist name
+    of every seed playlist, given to the TITLE_STRATEGIES.
+
+    Returns (results, summary): a DataFrame with one row per strategy and playlist (pid, metrics
+    and latency_ms of the recommend call) and a DataFrame of per-strategy aggregates.
+    """
+
+    for strategy in strategies:
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown strategy {strategy!r}, expected one of {list(STRATEGIES)}.')
+        if strategy in TITLE_STRATEGIES and names is None:
+            raise ValueError(f'Strategy {strategy!r} needs the playlist names.')
+
+    rng = np.random.default_rng(seed)
+    bounds = list(range(0, len(seeds), chunk_size)) + [len(seeds)]
+    tasks = [(strategy, num_tracks, seeds[a:b], holdouts[a:b], names[a:b] if strategy in TITLE_STRATEGIES else None,
+              chunk_seed)
+             for strategy in strategies
+             for a, b, chunk_seed in zip(bounds[:-1], bounds[1:], rng.integers(2**63, size=len(bounds) - 1))]
+
+    start = time.perf_counter()
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_evaluation_worker,
+                                 initargs=(model,)) as executor:
+            chunks = list(executor.map(_evaluate_chunk, tasks))
+    else:
+        _init_evaluation_worker(model)
+        chunks = [_evaluate_chunk(task) for task in tasks]
+    wall = time.perf_counter() - start
+
+    # Workers send back their metrics with each chunk when instrumentation is enabled
+    for chunk in chunks:
+        worker_metrics = chunk.pop('metrics')
+        if worker_metrics is not None:
+            instrumentation.METRICS.merge(worker_metrics)
+
+    results = pd.concat([pd.DataFrame(chunk) for chunk in chunks], ignore_index=True)
+    results.insert(1, 'pid', np.tile(np.asarray(pids), len(strategies)))
+
+    summary = results.groupby('strategy', sort=False).agg(
+        playlists=('pid', 'size'),
+        r_precision=('r_precision', 'mean'),
+        ndcg=('ndcg', 'mean'),
+        clicks=('clicks', 'mean'),
+        latency_p50_ms=('latency_ms', 'median'),
+        latency_p99_ms=('latency_ms', lambda latency: np.percentile(latency, 99)),
+        latency_mean_ms=('latency_ms', 'mean'),
+    )
+    summary.attrs['wall_s'] = wall
+    return results, summary
+
+
+# ---------- Worker Processes ---------- #
+
+# Model evaluated by worker processes, set once per process by _init_evaluation_worker
+_evaluation_model = None
+
+
+def _init_evaluation_worker(model):
+    global _evaluation_model
+    _evaluation_model = model
+
+
+def _evaluate_chunk(args):
+    """Recommend for and score one chunk of playlists with one strategy."""
+    strategy, num_tracks, seeds, holdouts, names, chunk_seed = args
+    method_name, kwargs = STRATEGIES[strategy]
+    recommend = getattr(_evaluation_model, method_name)
+    names = names if names is not None else [None] * len(seeds)
+
+    # Random picks use the model's generator; give it a per-chunk seed and restore it afterwards
+    model_rng = _evaluation_model.rng
+    _evaluation_model.rng = np.random.default_rng(chunk_seed)
+    try:
+        recommended, latencies = [], []
+        for seed_uris, name in zip(seeds, names):
+            start = time.perf_counter()
+            if name is None:
+                recommended.append(recommend(num_tracks, seed_uris, **kwargs))
+            else:
+                recommended.append(recommend(num_tracks, seed_uris, name=name, **kwargs))
+            latencies.append(time.perf_counter() - start)
+    finally:
+        _evaluation_model.rng = model_rng
+
+    scores = score_recommendations(recommended, holdouts, num_tracks)
+    return {'strategy': [strategy] * len(seeds), **scores, 'latency_ms': np.array(latencies) * 1000,
+            'metrics': instrumentation.METRICS.drain() if instrumentation.ENABLED else None}
+
+
+# Running from Command Line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate BaselineModels strategies with MPD challenge metrics.')
+    parser.add_argument('tracks', help='tracks table (file or directory of slices) with pid, pos and track_uri')
+    parser.add_argument('playlists', help='playlist table (e.g. playlists_2017.csv); only these playlists are evaluated')
+    parser.add_argument('track_table', help='unique track CSV indexed by track_uri (e.g. tracks_2017.csv)')
+    parser.add_argument('--strategies', nargs='+', choices=list(STRATEGIES), default=DEFAULT_STRATEGIES)
+    parser.add_argument('--playlists', dest='num_playlists', type=int, default=None,
+                        help='number of playlists to sample (default all)')
+    parser.add_argument('--seeds', type=int, default=5, help='seed tracks given to each strategy')
+    parser.add_argument('--num-tracks', type=int, default=500, help='tracks recommended per playlist')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--title-index', default=None, help='TitleIndex directory, for the title strategy')
+    parser.add_argument('--output', default=None, help='write per-playlist results to this CSV file')
+    parser.add_argument('--metrics', default=None,
+                        help='record recommender metrics and write them to this file (Prometheus text if it ends in .prom, else JSON)')
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrumentation.enable()
+
+    playlist_df = clean_raw_data.load_mpd_table(args.playlists, index_col='pid')
+    track_df = pd.read_csv(args.track_table, index_col='track_uri')
+    tracks_df = clean_raw_data.load_mpd_table(args.tracks, columns=['pid', 'pos', 'track_uri'])
+    tracks_df = tracks_df[tracks_df['pid'].isin(playlist_df.index)]
+
+    model = BaselineModels(playlist_df, track_df, seed=args.seed)
+    if args.title_index:
+        model.attach_title_index(args.title_index)
+    pids, seeds, holdouts = holdout_split(tracks_df, args.seeds, args.num_playlists, seed=args.seed)
+    names = playlist_df['name'].reindex(pids).fillna('').tolist() if 'name' in playlist_df.columns else None
+    results, summary = evaluate(model, pids, seeds, holdouts, args.strategies, args.num_tracks, args.workers,
+                                seed=args.seed, names=names)
+
+    print(f"{len(pids)} playlists evaluated in {summary.attrs['wall_s']:.1f}s")
+    print(summary.to_string())
+    if args.output:
+        results.to_csv(args.output, index=False)
+    if args.metrics:
+        instrumentation.METRICS.save(args.metrics)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+"""
+This module records metrics for the recommenders and the ingest pipeline.
+
+Instrumentation is off by default and costs one flag check per instrumented call while off.
+Turn it on with enable() or by setting the MPD_INSTRUMENTATION environment variable to 1;
+enable() also sets the variable, so worker processes started afterwards record too.
+
+Metrics are kept in the process-wide METRICS registry:
+
+- counters, e.g. rows written or tracks scanned, with optional labels
+- histograms, e.g. per-call latency in seconds or loop iterations per call
+- the calls with the largest value of a cost (e.g. loop iterations) and a detail of each,
+  to find pathological inputs such as seed sets that make the artist/album loops spin
+
+Worker processes return METRICS.drain() with their results and the parent calls METRICS.merge().
+Export with METRICS.to_json() or METRICS.to_prometheus(). profile_call runs a single call under
+cProfile or tracemalloc.
+"""
+
+# ---------- Imports ---------- #
+import os
+import io
+import json
+import time
+import heapq
+import bisect
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+import contextlib
+
+
+# ---------- Toggle ---------- #
+
+ENV_VAR = 'MPD_INSTRUMENTATION'
+
+# Checked by every instrumented call; use enable() rather than setting this directly
+ENABLED = os.environ.get(ENV_VAR, '0').lower() not in ('', '0', 'false', 'no')
+
+
+def enable(enabled=True):
+    """Turn instrumentation on (or off) in this process and in worker processes started afterwards."""
+    global ENABLED
+    ENABLED = enabled
+    os.environ[ENV_VAR] = '1' if enabled else '0'
+
+
+# ---------- Histograms ---------- #
+
+# Upper bounds of histogram buckets: latencies in seconds, and counts per call (loop iterations, rows)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = tuple(4 ** n for n in range(13))
+
+
+class Histogram:
+    """Fixed-bucket histogram; counts[i] holds values <= buckets[i] (and > buckets[i - 1]), the last one the rest."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def quantile(self, q):
+        """Approximate quantile: the upper bound of the bucket holding it (inf for the overflow bucket)."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+    def merge(self, state):
+        if tuple(state['buckets']) != self.buckets:
+            raise ValueError('Cannot merge histograms with different buckets.')
+        self.counts = [a + b for a, b in zip(self.counts, state['counts'])]
+        self.sum += state['sum']
+        self.count += state['count']
+
+
+# ---------- Metrics Registry ---------- #
+
+class Metrics:
+    """Thread-safe registry of counters, histograms and largest-cost calls. Metrics are keyed by name and labels."""
+
+    def __init__(self, max_slowest=10):
+        self.max_slowest = max_slowest
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            # Name -> min-heap of (value, sequence number, detail) of the calls with the largest values
+            self.slowest = {}
+            self._sequence = 0
+
+
+    def count(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+
+    def record_slowest(self, name, value, detail):
+        """
+        Keep `detail` if `value` is among the `max_slowest` largest recorded for `name`. `detail`
+        may be a function returning it, so it is only built for calls that are kept.
+        """
+        with self.lock:
+            heap = self.slowest.setdefault(name, [])
+            if len(heap) >= self.max_slowest and value <= heap[0][0]:
+                return
+            self._sequence += 1
+            entry = (value, self._sequence, detail() if callable(detail) else detail)
+            if len(heap) < self.max_slowest:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heapreplace(heap, entry)
+
+
+    # ---------- Export ---------- #
+
+    def to_dict(self):
+        """Return all metrics as JSON-serializable lists, largest-cost calls first."""
+        with self.lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                               for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])],
+                'slowest': {name: [{'value': value, 'detail': detail} for value, _, detail in sorted(heap, reverse=True)]
+                            for name, heap in self.slowest.items()},
+            }
+
+
+    def to_json(self, indent=2):
+        summary = self.to_dict()
+        for histogram in summary['histograms']:
+            state = Histogram(histogram['buckets'])
+            state.merge(histogram)
+            histogram['p50'], histogram['p99'] = state.quantile(0.5), state.quantile(0.99)
+        return json.dumps(summary, indent=indent, default=str)
+
+
+    def to_prometheus(self, prefix='mpd_'):
+        """Return the counters and histograms in the Prometheus text exposition format."""
+        lines = []
+        typed = set()
+        state = self.to_dict()
+
+        for counter in state['counters']:
+            name = prefix + counter['name']
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f"{name}{_prometheus_labels(counter['labels'])} {counter['value']}")
+
+        for histogram in state['histograms']:
+            name = prefix + histogram['name']
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_prometheus_labels(dict(histogram['labels'], le=bound))} {cumulative}")
+            lines.append(f"{name}_sum{_prometheus_labels(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{_prometheus_labels(histogram['labels'])} {histogram['count']}")
+
+        return '\n'.join(lines) + '\n'
+
+
+    def save(self, filepath):
+        """Write the metrics to `filepath`, as Prometheus text if it ends in .prom and as JSON otherwise."""
+        with open(filepath, 'w') as file:
+            file.write(self.to_prometheus() if filepath.endswith('.prom') else self.to_json())
+
+
+    # ---------- Worker Processes ---------- #
+
+    def drain(self):
+        """Return this process's metrics (see to_dict) and reset them, e.g. at the end of a worker task."""
+        state = self.to_dict()
+        self.reset()
+        return state
+
+
+    def merge(self, state):
+        """Add metrics returned by drain() in another process."""
+        for counter in state['counters']:
+            self.count(counter['name'], counter['value'], **counter['labels'])
+
+        for entry in state['histograms']:
+            key = (entry['name'], _label_key(entry['labels']))
+            with self.lock:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(entry['buckets'])
+                histogram.merge(entry)
+
+        for name, entries in state['slowest'].items():
+            for entry in entries:
+                self.record_slowest(name, entry['value'], entry['detail'])
+
+
+# Process-wide registry
+METRICS = Metrics()
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"') for key, value in labels.items()}
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped.items()) + '}'
+
+
+# ---------- Recording Helpers ---------- #
+
+def count(name, value=1, **labels):
+    """Add to a counter of METRICS if instrumentation is enabled."""
+    if ENABLED:
+        METRICS.count(name, value, **labels)
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """Add a value to a histogram of METRICS if instrumentation is enabled."""
+    if ENABLED:
+        METRICS.observe(name, value, buckets, **labels)
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    """Record the time spent in the block in histogram `name` (seconds) if instrumentation is enabled."""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.observe(name, time.perf_counter() - start, LATENCY_BUCKETS, **labels)
+
+
+def instrumented(method):
+    """
+    Decorator recording the latency of every call in the 'call_seconds' histogram and the
+    number of calls in 'calls_total', both labelled method=`method`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                METRICS.observe('call_seconds', time.perf_counter() - start, LATENCY_BUCKETS, method=method)
+                METRICS.count('calls_total', method=method)
+        return wrapper
+    return decorator
+
+
+# ---------- Profiling ---------- #
+
+def profile_call(func, *args, mode='cprofile', top=25, **kwargs):
+    """
+    Run func(*args, **kwargs) once under cProfile ('cprofile', sorted by cumulative time) or
+    tracemalloc ('tracemalloc', allocations by line and the peak) and return (result, report text).
+    """
+
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        result = profiler.runcall(func, *args, **kwargs)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(top)
+        return result, report.getvalue()
+
+    if mode == 'tracemalloc':
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        try:
+            result = func(*args, **kwargs)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+
+        lines = [f'Peak traced memory {peak / 2**20:.1f} MB, current {current / 2**20:.1f} MB',
+                 f'Top {top} allocations by line:']
+        lines += [str(stat) for stat in after.compare_to(before, 'lineno')[:top]]
+        return result, '\n'.join(lines) + '\n'
+
+    raise ValueError(f"Unknown profiling mode {mode!r}, expected 'cprofile' or 'tracemalloc'.")
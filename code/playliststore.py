@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+This module creates a memory-mapped PlaylistStore holding every track of every playlist, in order.
+
+Unlike the playlist tables' track_N_uri columns, which keep only the first `tracks_per_playlist`
+tracks of a playlist padded with 0, the store is ragged (CSR): the tracks of playlist row i are
+tracks[offsets[i]:offsets[i + 1]], with album and artist arrays aligned to tracks. Tracks, albums
+and artists are the int32 IDs of the URI dictionaries written by clean_raw_data.py --encode-ids.
+
+Usage:
+    python3 playliststore.py ../data/ids [--out ../data/playlist_store]
+"""
+
+# ---------- Imports ---------- #
+import os
+import json
+import shutil
+import argparse
+
+import numpy as np
+
+import clean_raw_data
+
+
+# Per-track arrays of the store and the ID-encoded tracks table column each is built from
+ROW_ARRAYS = {'tracks': 'track_id', 'albums': 'album_id', 'artists': 'artist_id'}
+
+# URI dictionary of each per-track array
+ARRAY_KINDS = {'tracks': 'track', 'albums': 'album', 'artists': 'artist'}
+
+
+# ---------- PlaylistStore Class ---------- #
+
+class PlaylistStore:
+    """
+    Ragged store of full playlists. Arrays are opened with memory maps, so loading is instant,
+    slices are views of the files, and processes reading the same directory share one page-cache copy.
+
+        - pids: int32, MPD pid of each playlist row, ascending
+        - offsets: int64, num_playlists + 1 row boundaries
+        - tracks, albums, artists: int32 IDs of every playlist track, in playlist order
+    """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r') as file:
+            self.meta = json.load(file)
+
+        self.arrays = {name: self._open_array(name) for name in self.meta['arrays']}
+        self.pids = self.arrays['pids']
+        self.offsets = self.arrays['offsets']
+
+        # URI dictionaries are loaded on first use by uris()
+        self._uri_dictionaries = {}
+
+
+    def _open_array(self, name):
+        dtype, length = self.meta['arrays'][name]
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.directory, f'{name}.bin'), dtype=dtype, mode='r', shape=(length,))
+
+
+    def __len__(self):
+        return len(self.pids)
+
+
+    @classmethod
+    def build(cls, directory, ids_output, chunk_rows=1_000_000):
+        """
+        Write a store of the ID-encoded tracks tables in <ids_output>/tracks (see clean_raw_data.py
+        --encode-ids) to `directory` and open it. Slices are streamed `chunk_rows` rows at a time
+        straight to the array files, so memory does not grow with the dataset. The URI dictionaries
+        are copied along so the store is self-contained.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        files = {name: open(os.path.join(directory, f'{name}.bin'), 'wb') for name in ['pids', 'offsets', *ROW_ARRAYS]}
+
+        num_rows, num_playlists, last_pid = 0, 0, None
+        try:
+            for filepath in clean_raw_data.mpd_table_filepaths(os.path.join(ids_output, 'tracks')):
+                for chunk in clean_raw_data.iter_table_chunks(filepath, ['pid', *ROW_ARRAYS.values()], chunk_rows):
+                    pids = chunk['pid'].to_numpy(dtype=np.int64)
+                    if len(pids) == 0:
+                        continue
+
+                    # A playlist starts wherever the pid changes; a chunk may continue the previous chunk's playlist
+                    starts = np.flatnonzero(np.r_[pids[0] != last_pid, pids[1:] != pids[:-1]])
+                    new_pids = pids[starts]
+                    if np.any(np.diff(np.r_[-1 if last_pid is None else last_pid, new_pids]) <= 0):
+                        raise ValueError(f'{filepath}: playlists must be in ascending pid order.')
+
+                    # offsets holds the first row of every playlist, then the total number of rows
+                    files['offsets'].write((num_rows + starts).astype(np.int64).tobytes())
+                    files['pids'].write(new_pids.astype(np.int32).tobytes())
+                    for name, column in ROW_ARRAYS.items():
+                        files[name].write(chunk[column].to_numpy(dtype=np.int32).tobytes())
+
+                    num_playlists += len(new_pids)
+                    num_rows += len(pids)
+                    last_pid = pids[-1]
+
+            files['offsets'].write(np.array([num_rows], dtype=np.int64).tobytes())
+        finally:
+            for file in files.values():
+                file.close()
+
+        for kind in clean_raw_data.URI_KINDS:
+            shutil.copy(os.path.join(ids_output, f'{kind}_uris.txt'), os.path.join(directory, f'{kind}_uris.txt'))
+
+        arrays = {'pids': ('int32', num_playlists), 'offsets': ('int64', num_playlists + 1)}
+        arrays.update({name: ('int32', num_rows) for name in ROW_ARRAYS})
+        with open(os.path.join(directory, 'meta.json'), 'w') as file:
+            json.dump({'num_playlists': num_playlists, 'num_tracks': num_rows, 'arrays': arrays}, file)
+
+        return cls(directory)
+
+
+    # ---------- Accessors ---------- #
+
+    def lengths(self):
+        """Number of tracks of every playlist row."""
+        return np.diff(self.offsets)
+
+
+    def row_of(self, pid):
+        """Return the playlist row of an MPD pid, or raise KeyError."""
+        row = int(np.searchsorted(self.pids, pid))
+        if row == len(self.pids) or self.pids[row] != pid:
+            raise KeyError(pid)
+        return row
+
+
+    def tracks_of(self, pid, kind='tracks'):
+        """Return the track (or 'albums' / 'artists') IDs of playlist `pid` in order, as a view of the store."""
+        row = self.row_of(pid)
+        return self.arrays[kind][self.offsets[row]:self.offsets[row + 1]]
+
+
+    def ragged(self, kind='tracks'):
+        """Return the (offsets, ids) ragged arrays of all playlists (views, no copy), e.g. for skipgrams."""
+        return self.offsets, self.arrays[kind]
+
+
+    def first_k(self, k, kind='tracks', pad=-1):
+        """
+        Return a (num_playlists, k) int32 matrix of the first k track (or 'albums' / 'artists') IDs
+        of every playlist, padded with `pad` for playlists shorter than k.
+        """
+        lengths = np.minimum(self.lengths(), k)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        columns = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        matrix = np.full((len(lengths), k), pad, dtype=np.int32)
+        matrix[rows, columns] = self.arrays[kind][self.offsets[:-1][rows] + columns]
+        return matrix
+
+
+    def counts(self, kind='tracks'):
+        """Number of appearances of every track (or album / artist) ID over all full playlists."""
+        return np.bincount(self.arrays[kind], minlength=len(self.uris(kind)))
+
+
+    def uris(self, kind='tracks'):
+        """Return the URI dictionary of track (or 'albums' / 'artists') IDs; decode IDs with .decode(ids)."""
+        if kind not in self._uri_dictionaries:
+            filepath = os.path.join(self.directory, f'{ARRAY_KINDS[kind]}_uris.txt')
+            self._uri_dictionaries[kind] = clean_raw_data.UriDictionary.load(filepath)
+        return self._uri_dictionaries[kind]
+
+
+# Running from Command Line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a PlaylistStore from ID-encoded MPD tables.')
+    parser.add_argument('ids', help='ID-encoded output directory of clean_raw_data.py --encode-ids')
+    parser.add_argument('--out', default='../data/playlist_store', help='directory to save the store to')
+    args = parser.parse_args()
+
+    store = PlaylistStore.build(args.out, args.ids)
+    print(f"{len(store)} playlists, {store.meta['num_tracks']} tracks saved to {args.out}")
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+
+"""
+This script serves BaselineModels recommendations over local HTTP, and load tests the service.
+
+Usage:
+    python3 service.py serve --snapshot ../data/snapshot [--port 8000] [--cache-size 100000] [--cache-ttl 300]
+    python3 service.py loadtest --snapshot ../data/snapshot [--url http://127.0.0.1:8000] [--concurrency 16]
+
+Endpoints:
+    POST /recommend   {"seeds": [track URIs], "strategy": "popular", "k": 10}
+                      -> {"tracks": [track URIs], "cached": false}
+                      {"name": "road trip", "strategy": "title", "k": 10} recommends from the playlist
+                      name alone (start with --title-index); "seeds" are optional and excluded
+    GET  /stats       request, cache and batch counters
+    GET  /metrics     recorded metrics in Prometheus text format (see instrumentation.py; start with --metrics)
+    GET  /health
+
+Strategies are the names of evaluation.STRATEGIES. Requests that arrive while a batch is being
+computed are coalesced into the next micro-batch and run through BaselineModels.recommend_batch.
+Results of deterministic strategies are kept in an LRU cache with a time-to-live, keyed on
+(seed set, strategy, k, name tokens of title requests), and repeated requests are answered from
+it without touching the model.
+"""
+
+# ---------- Imports ---------- #
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import traceback
+import http.client
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import numpy as np
+
+import instrumentation
+from evaluation import STRATEGIES, TITLE_STRATEGIES
+from title_index import normalize_name
+from baselinemodels import BaselineModels, UriIndex
+
+
+# ---------- Strategies ---------- #
+
+# Strategies run for a whole micro-batch with recommend_batch: name -> (batch strategy, popularity)
+BATCH_STRATEGIES = {
+    'popular': ('popular', True),
+    'artists_popular': ('artists', True),
+    'artists_random': ('artists', False),
+    'albums_popular': ('albums', True),
+    'albums_random': ('albums', False),
+}
+
+# Strategies whose results are cached: only deterministic ones, since a cached random draw would be
+# served for the whole TTL. The artist / album strategies pick groups at random even with popularity.
+CACHEABLE_STRATEGIES = {'popular', 'embeddings', 'cooccurrence', 'title'}
+
+# Largest number of tracks a request may ask for (the challenge asks for 500)
+MAX_TRACKS = 1000
+
+
+class BadRequest(ValueError):
+    """A request that fails validation; answered with 400 and its message. Other errors are 500s."""
+
+
+# ---------- Recommendation Cache ---------- #
+
+class RecommendationCache:
+    """
+    Thread-safe LRU cache with a time-to-live. Holds at most `max_entries` results; entries
+    older than `ttl_s` seconds are treated as missing, so results follow model updates.
+    """
+
+    def __init__(self, max_entries=100_000, ttl_s=300.0):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def get(self, key):
+        """Return the cached value of `key`, or None if it is missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_s, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+# ---------- Micro-batching ---------- #
+
+class MicroBatcher:
+    """
+    Runs recommendation requests on one background thread, in micro-batches.
+
+    Each batch takes every request queued so far (up to `max_batch`, waiting at most
+    `max_wait_ms` for more), groups them by (strategy, k) and makes one recommend_batch call
+    per group. Under load, requests queue up while a batch runs, so batches grow with traffic
+    and the per-request cost of the vectorized paths drops; a lone request is run immediately.
+    """
+
+    def __init__(self, model, max_batch=256, max_wait_ms=0.0):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.batched_requests = 0
+
+        self.thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+
+    def submit(self, seeds, strategy, k, name=''):
+        """Queue one request; returns a Future of its list of recommended track URIs."""
+        future = Future()
+        self.queue.put((seeds, strategy, k, name, future))
+        return future
+
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+    def _run(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                return
+
+            batch = [request]
+            deadline = time.monotonic() + self.max_wait_s
+            while len(batch) < self.max_batch:
+                try:
+                    request = self.queue.get(timeout=max(deadline - time.monotonic(), 0)) if self.max_wait_s \
+                              else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    # Finish this batch, then stop
+                    self.queue.put(None)
+                    break
+                batch.append(request)
+
+            self._run_batch(batch)
+
+
+    def _run_batch(self, batch):
+        self.batches += 1
+        self.batched_requests += len(batch)
+        instrumentation.observe('micro_batch_size', len(batch), instrumentation.COUNT_BUCKETS)
+
+        groups = defaultdict(list)
+        for seeds, strategy, k, name, future in batch:
+            groups[strategy, k].append((seeds, name, future))
+
+        for (strategy, k), requests in groups.items():
+            try:
+                results = self._recommend([seeds for seeds, _, _ in requests], strategy, k,
+                                          [name for _, name, _ in requests])
+            except Exception as e:
+                for _, _, future in requests:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), tracks in zip(requests, results):
+                future.set_result(tracks)
+
+
+    def _recommend(self, seed_lists, strategy, k, names):
+        """Recommend `k` track URIs for every seed list (and playlist name) with one strategy."""
+
+        if strategy in BATCH_STRATEGIES:
+            batch_strategy, popularity = BATCH_STRATEGIES[strategy]
+            recommended = self.model.recommend_batch(seed_lists, batch_strategy, k, popularity)
+            return [[uri for uri in row if uri is not None] for row in recommended.tolist()]
+
+        # Index-backed strategies answer one seed list at a time
+        method_name, kwargs = STRATEGIES[strategy]
+        recommend = getattr(self.model, method_name)
+        if strategy in TITLE_STRATEGIES:
+            return [recommend(k, seeds, name=name, **kwargs) for seeds, name in zip(seed_lists, names)]
+        return [recommend(k, seeds, **kwargs) for seeds in seed_lists]
+
+
+# ---------- Service ---------- #
+
+class RecommendationService:
+    """Validates requests and answers them from the cache or through the micro-batcher."""
+
+    def __init__(self, model, cache_entries=100_000, cache_ttl_s=300.0, max_batch=256, max_wait_ms=0.0,
+                 timeout_s=30.0):
+        self.model = model
+        self.cache = RecommendationCache(cache_entries, cache_ttl_s)
+        self.batcher = MicroBatcher(model, max_batch, max_wait_ms)
+        self.timeout_s = timeout_s
+        # Handler threads count requests concurrently
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.started = time.time()
+
+
+    def recommend(self, seeds, strategy='popular', k=10, name=''):
+        """Return (list of recommended track URIs, whether it came from the cache)."""
+
+        if strategy not in STRATEGIES:
+            raise BadRequest(f'Unknown strategy {strategy!r}, expected one of {list(STRATEGIES)}.')
+        # bool is a subclass of int, so JSON true / false would pass as 1 / 0
+        if isinstance(k, bool) or not isinstance(k, int) or not 0 < k <= MAX_TRACKS:
+            raise BadRequest(f'k must be an integer between 1 and {MAX_TRACKS}.')
+        if not isinstance(seeds, list) or not all(isinstance(uri, str) for uri in seeds):
+            raise BadRequest('seeds must be a list of track URIs.')
+        if not isinstance(name, str):
+            raise BadRequest('name must be a string.')
+
+        with self.lock:
+            self.requests += 1
+        # Names with the same tokens get the same title recommendations
+        tokens = tuple(normalize_name(name)) if strategy in TITLE_STRATEGIES else ()
+        key = (frozenset(seeds), strategy, k, tokens) if strategy in CACHEABLE_STRATEGIES else None
+        if key is not None:
+            tracks = self.cache.get(key)
+            instrumentation.count('cache_requests_total', cache='service', result='miss' if tracks is None else 'hit')
+            if tracks is not None:
+                return tracks, True
+
+        tracks = self.batcher.submit(seeds, strategy, k, name).result(self.timeout_s)
+        if key is not None:
+            self.cache.put(key, tracks)
+        return tracks, False
+
+
+    def stats(self):
+        batches = self.batcher.batches
+        lookups = self.cache.hits + self.cache.misses
+        return {
+            'uptime_s': time.time() - self.started,
+            'requests': self.requests,
+            'cache_entries': len(self.cache),
+            'cache_hits': self.cache.hits,
+            'cache_hit_rate': self.cache.hits / lookups if lookups else None,
+            'batches': batches,
+            'mean_batch_size': self.batcher.batched_requests / batches if batches else None,
+        }
+
+
+# ---------- HTTP Server ---------- #
+
+def make_handler(service):
+    """Return a request handler class serving `service`."""
+
+    class RecommendationHandler(BaseHTTPRequestHandler):
+
+        # Keep-alive connections, so clients do not reconnect for every request
+        protocol_version = 'HTTP/1.1'
+
+        # Headers and body are written separately; without TCP_NODELAY, Nagle's algorithm and the
+        # client's delayed ACK add about 40 ms to every keep-alive response
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            elif self.path == '/stats':
+                self._send_json(200, service.stats())
+            elif self.path == '/metrics':
+                body = instrumentation.METRICS.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/recommend':
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+            try:
+                body = self._read_json_object()
+                tracks, cached = service.recommend(body.get('seeds', []), body.get('strategy', 'popular'),
+                                                   body.get('k', 10), body.get('name', ''))
+            except BadRequest as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            except Exception:
+                # Internal errors are logged here, not sent to the client
+                print(f'Error handling {self.command} {self.path}:', flush=True)
+                traceback.print_exc()
+                self._send_json(500, {'error': 'Internal server error'})
+                return
+            self._send_json(200, {'tracks': tracks, 'cached': cached})
+
+        def _read_json_object(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            except ValueError as e:
+                raise BadRequest(f'Request body is not valid JSON: {e}') from e
+            if not isinstance(body, dict):
+                raise BadRequest('Request body must be a JSON object.')
+            return body
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # One log line per request would dominate the cost of serving
+            pass
+
+    return RecommendationHandler
+
+
+class RecommendationServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default listen backlog of 5 resets connections when many clients connect at once
+    request_queue_size = 1024
+
+
+def make_server(service, host='127.0.0.1', port=8000):
+    """Create a threaded HTTP server for `service`; port 0 picks a free port (see server.server_port)."""
+    return RecommendationServer((host, port), make_handler(service))
+
+
+# ---------- Load Testing ---------- #
+
+def sample_seed_lists(track_uris, num_lists=1000, seeds_per_list=5, seed=0):
+    """Draw `num_lists` random seed lists of `seeds_per_list` track URIs."""
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(len(track_uris), size=(num_lists, seeds_per_list))
+    return [list(track_uris[row]) for row in ids]
+
+
+def load_test(url, seed_lists, strategy='popular', k=10, concurrency=16, num_requests=5000, seed=0):
+    """
+    Send `num_requests` POST /recommend requests from `concurrency` client threads, each with its
+    own keep-alive connection. Seed lists are drawn at random from `seed_lists`, so the fraction
+    of repeated requests (and cache hits) falls as the number of distinct seed lists grows.
+
+    Returns QPS, latency percentiles in milliseconds, errors and the fraction served from cache.
+    """
+
+    parsed = urlsplit(url)
+    picks = np.random.default_rng(seed).integers(len(seed_lists), size=num_requests).tolist()
+    bodies = [json.dumps({'seeds': seed_lists[pick], 'strategy': strategy, 'k': k}).encode('utf-8')
+              for pick in picks]
+
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    cached = [0] * concurrency
+
+    def client(worker):
+        connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80)
+        for body in bodies[worker::concurrency]:
+            start = time.perf_counter()
+            connection.request('POST', '/recommend', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            payload = response.read()
+            latencies[worker].append(time.perf_counter() - start)
+            if response.status != 200:
+                errors[worker] += 1
+            elif json.loads(payload)['cached']:
+                cached[worker] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(worker,)) for worker in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    all_latencies = np.concatenate([np.asarray(worker_latencies) for worker_latencies in latencies]) * 1000
+    return {
+        'strategy': strategy,
+        'requests': num_requests,
+        'concurrency': concurrency,
+        'distinct_seed_lists': len(seed_lists),
+        'wall_s': wall,
+        'qps': num_requests / wall,
+        'p50_ms': float(np.percentile(all_latencies, 50)),
+        'p99_ms': float(np.percentile(all_latencies, 99)),
+        'errors': sum(errors),
+        'cached_fraction': sum(cached) / num_requests,
+    }
+
+
+# Running from Command Line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve or load test BaselineModels recommendations over HTTP.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='run the recommendation service')
+    serve_parser.add_argument('--snapshot', required=True, help='BaselineModels snapshot directory (see baselinemodels.py)')
+    serve_parser.add_argument('--track-store', default=None, help='TrackStore directory')
+    serve_parser.add_argument('--embedding-index', default=None, help='EmbeddingIndex directory')
+    serve_parser.add_argument('--cooccurrence-index', default=None, help='CooccurrenceIndex directory')
+    serve_parser.add_argument('--title-index', default=None, help='TitleIndex directory, for the title strategy')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--cache-size', type=int, default=100_000, help='maximum cached results')
+    serve_parser.add_argument('--cache-ttl', type=float, default=300.0, help='seconds a cached result is served')
+    serve_parser.add_argument('--max-batch', type=int, default=256, help='maximum requests per micro-batch')
+    serve_parser.add_argument('--max-wait-ms', type=float, default=0.0,
+                              help='time to wait for more requests before running a batch')
+    serve_parser.add_argument('--metrics', action='store_true', help='record metrics, served at /metrics')
+
+    test_parser = subparsers.add_parser('loadtest', help='load test a running service')
+    test_parser.add_argument('--snapshot', required=True, help='snapshot directory to draw seed track URIs from')
+    test_parser.add_argument('--url', default='http://127.0.0.1:8000')
+    test_parser.add_argument('--strategy', choices=list(STRATEGIES), default='popular')
+    test_parser.add_argument('--k', type=int, default=10, help='tracks per request')
+    test_parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    test_parser.add_argument('--requests', type=int, default=5000)
+    test_parser.add_argument('--distinct', type=int, default=1000, help='distinct seed lists to draw requests from')
+    test_parser.add_argument('--seeds', type=int, default=5, help='seed tracks per request')
+    test_parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if args.metrics:
+            instrumentation.enable()
+        model = BaselineModels.load_snapshot(args.snapshot, track_store=args.track_store,
+                                             embedding_index=args.embedding_index,
+                                             cooccurrence_index=args.cooccurrence_index,
+                                             title_index=args.title_index)
+        service = RecommendationService(model, args.cache_size, args.cache_ttl, args.max_batch, args.max_wait_ms)
+        server = make_server(service, args.host, args.port)
+        print(f"Serving {len(model.track_uris)} tracks on http://{args.host}:{server.server_port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    else:
+        track_uris = UriIndex(os.path.join(args.snapshot, 'track'))
+        seed_lists = sample_seed_lists(track_uris, args.distinct, args.seeds, args.seed)
+        results = load_test(args.url, seed_lists, args.strategy, args.k, args.concurrency, args.requests, args.seed)
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+This module generates word2vec skip-gram training data from playlists, treating each
+playlist as a sentence and each track as a word.
+
+It replaces the per-playlist generate_training_data loop of jlj/jl_word2vec.ipynb: pairs,
+subsampling and negative samples are produced with NumPy for many playlists at once, in
+shards, and can be streamed into a tf.data pipeline with make_tf_dataset.
+
+Playlists are given as ragged arrays of track IDs (e.g. the track_id column of the ID-encoded
+tracks tables written by clean_raw_data.process_mpd_data(encode_ids=True)): the tracks of
+playlist i are tokens[offsets[i]:offsets[i + 1]].
+"""
+
+# ---------- Imports ---------- #
+import numpy as np
+
+
+# ---------- Playlist Sequences ---------- #
+
+def sequences_from_tracks_table(tracks_df, token_col='track_id'):
+    """
+    Build (offsets, tokens) ragged arrays from a tracks table with pid, pos and `token_col`
+    columns, one playlist per distinct pid in order of pid and tracks in order of pos.
+    """
+    tracks_df = tracks_df.sort_values(['pid', 'pos'], kind='stable')
+    pids = tracks_df['pid'].to_numpy()
+    tokens = tracks_df[token_col].to_numpy().astype(np.int64)
+
+    starts = np.flatnonzero(np.r_[True, pids[1:] != pids[:-1]]) if len(pids) else np.zeros(0, dtype=np.int64)
+    offsets = np.append(starts, len(pids)).astype(np.int64)
+    return offsets, tokens
+
+
+# ---------- Sampling Tables ---------- #
+
+def make_sampling_table(token_counts, sample=1e-3):
+    """
+    Return the probability of keeping each token when subsampling frequent tokens, using the
+    word2vec formula on the observed frequency f: keep = (sqrt(f / sample) + 1) * sample / f.
+    Unlike tf.keras.preprocessing.sequence.make_sampling_table this uses real counts, so token
+    IDs do not need to be sorted by frequency.
+    """
+    frequency = token_counts / max(token_counts.sum(), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        keep = (np.sqrt(frequency / sample) + 1) * sample / frequency
+    return np.nan_to_num(np.minimum(keep, 1.0), nan=1.0, posinf=1.0)
+
+
+def make_negative_sampling_table(token_counts, power=0.75):
+    """Return the cumulative unigram ** power distribution used to draw negative samples."""
+    weights = np.asarray(token_counts, dtype=float) ** power
+    cumulative = np.cumsum(weights)
+    return cumulative / cumulative[-1]
+
+
+# ---------- Skip-grams ---------- #
+
+def skipgram_pairs(offsets, tokens, window_size=2, sampling_table=None, rng=None):
+    """
+    Return (targets, contexts) arrays of all positive skip-gram pairs within `window_size`
+    tracks of each other in the same playlist. If a `sampling_table` is given, tokens are
+    first dropped at random with it (see make_sampling_table).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+
+    lengths = np.diff(offsets)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    tokens = tokens[offsets[0]:offsets[-1]]
+
+    if sampling_table is not None:
+        keep = rng.random(len(tokens)) < sampling_table[tokens]
+        tokens, rows = tokens[keep], rows[keep]
+
+    targets, contexts = [], []
+    for distance in range(1, window_size + 1):
+        # Pairs `distance` apart that are still in the same playlist, in both directions
+        same_playlist = rows[:-distance] == rows[distance:]
+        left, right = tokens[:-distance][same_playlist], tokens[distance:][same_playlist]
+        targets += [left, right]
+        contexts += [right, left]
+
+    if not targets:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(targets), np.concatenate(contexts)
+
+
+def sample_negatives(contexts, num_ns, negative_table, rng=None):
+    """
+    Draw `num_ns` negative tokens for each positive context from the negative sampling table,
+    redrawing any that equal the positive context. Returns an array of shape (len(contexts), num_ns).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+
+    negatives = np.searchsorted(negative_table, rng.random((len(contexts), num_ns)), side='right')
+    for _ in range(10):
+        clashes = negatives == contexts[:, None]
+        if not clashes.any():
+            break
+        negatives[clashes] = np.searchsorted(negative_table, rng.random(clashes.sum()), side='right')
+    return np.minimum(negatives, len(negative_table) - 1)
+
+
+def generate_training_data(offsets, tokens, window_size=2, num_ns=4, vocab_size=None, sample=1e-3, seed=None):
+    """
+    Generate skip-gram training data for all playlists at once, in the format of the notebook:
+
+        - targets: (n,) target tokens
+        - contexts: (n, num_ns + 1) the positive context followed by `num_ns` negatives
+        - labels: (n, num_ns + 1) 1 for the positive context, 0 for the negatives
+    """
+    shard = next(generate_training_shards(offsets, tokens, window_size, num_ns, vocab_size, sample,
+                                          playlists_per_shard=max(len(offsets) - 1, 1), shuffle=False, seed=seed))
+    return shard
+
+
+def generate_training_shards(offsets, tokens, window_size=2, num_ns=4, vocab_size=None, sample=1e-3,
+                             playlists_per_shard=10_000, shuffle=True, seed=None):
+    """
+    Yield (targets, contexts, labels) training arrays (see generate_training_data) for
+    `playlists_per_shard` playlists at a time, so all playlists can be used without holding
+    every pair in memory. With `shuffle`, playlists are visited in random order and the
+    examples of each shard are shuffled.
+    """
+    rng = np.random.default_rng(seed)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    tokens = np.asarray(tokens, dtype=np.int64)
+
+    # Subsampling and negative tables are built once from counts over all playlists
+    token_counts = np.bincount(tokens, minlength=vocab_size or 0)
+    sampling_table = make_sampling_table(token_counts, sample) if sample else None
+    negative_table = make_negative_sampling_table(token_counts)
+
+    num_playlists = len(offsets) - 1
+    order = rng.permutation(num_playlists) if shuffle else np.arange(num_playlists)
+
+    for start in range(0, max(num_playlists, 1), playlists_per_shard):
+        shard_offsets, shard_tokens = _take_playlists(offsets, tokens, order[start:start + playlists_per_shard])
+
+        targets, positives = skipgram_pairs(shard_offsets, shard_tokens, window_size, sampling_table, rng)
+        negatives = sample_negatives(positives, num_ns, negative_table, rng)
+
+        contexts = np.concatenate([positives[:, None], negatives], axis=1)
+        labels = np.zeros_like(contexts)
+        labels[:, 0] = 1
+
+        if shuffle:
+            shuffled = rng.permutation(len(targets))
+            targets, contexts, labels = targets[shuffled], contexts[shuffled], labels[shuffled]
+
+        yield targets, contexts, labels
+
+
+def _take_playlists(offsets, tokens, playlists):
+    """Return the (offsets, tokens) ragged arrays of a subset of playlists, in the given order."""
+    lengths = offsets[playlists + 1] - offsets[playlists]
+    new_offsets = np.zeros(len(playlists) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.repeat(offsets[playlists] - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return new_offsets, tokens[positions]
+
+
+# ---------- tf.data ---------- #
+
+def make_tf_dataset(offsets, tokens, window_size=2, num_ns=4, vocab_size=None, sample=1e-3,
+                    batch_size=1024, playlists_per_shard=10_000, seed=None, drop_remainder=False):
+    """
+    Return a tf.data.Dataset of ((target, context), label) batches for a word2vec model, generated
+    shard by shard with generate_training_shards. Without a `seed`, each pass over the dataset
+    draws new subsamples and negatives. TensorFlow is only imported when this function is called.
+
+    Examples left over at the end of a shard are carried into the next one, so every batch has
+    `batch_size` examples except the last, which is shorter, or dropped if `drop_remainder` is set
+    (the batch dimension is then fixed in the dataset's shapes).
+    """
+    import tensorflow as tf
+
+    def batches():
+        held = None
+        for shard in generate_training_shards(offsets, tokens, window_size, num_ns, vocab_size,
+                                              sample, playlists_per_shard, seed=seed):
+            targets, contexts, labels = shard if held is None else \
+                [np.concatenate([a, b]) for a, b in zip(held, shard)]
+            full = len(targets) - len(targets) % batch_size
+            for start in range(0, full, batch_size):
+                stop = start + batch_size
+                yield (targets[start:stop], contexts[start:stop]), labels[start:stop]
+            held = (targets[full:], contexts[full:], labels[full:])
+
+        if held is not None and len(held[0]) and not drop_remainder:
+            targets, contexts, labels = held
+            yield (targets, contexts), labels
+
+    rows = batch_size if drop_remainder else None
+    signature = ((tf.TensorSpec(shape=(rows,), dtype=tf.int64),
+                  tf.TensorSpec(shape=(rows, num_ns + 1), dtype=tf.int64)),
+                 tf.TensorSpec(shape=(rows, num_ns + 1), dtype=tf.int64))
+
+    return tf.data.Dataset.from_generator(batches, output_signature=signature).prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,64 @@
+"""
+Shared fixtures: a small synthetic MPD dataset (see benchmarks.generate_mpd_slices), parsed once
+per test session with ID encoding and consolidation, and a BaselineModels built from it.
+"""
+
+# ---------- Imports ---------- #
+import os
+import sys
+
+import pytest
+
+# The modules under test are flat scripts in code/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clean_raw_data
+import instrumentation
+from benchmarks import generate_mpd_slices
+from baselinemodels import BaselineModels
+
+
+@pytest.fixture(scope='session')
+def mpd_output(tmp_path_factory):
+    """Output directory of clean_raw_data for 2 slices of 100 playlists over 400 tracks."""
+    root = tmp_path_factory.mktemp('mpd')
+    generate_mpd_slices(str(root / 'json'), num_slices=2, playlists_per_slice=100, mean_tracks_per_playlist=20,
+                        catalog_size=400, seed=0)
+    out_path = str(root / 'data')
+    clean_raw_data.process_mpd_data(str(root / 'json'), num_tracks=15, out_path=out_path, encode_ids=True)
+    clean_raw_data.consolidate_mpd_data(out_path)
+    return out_path
+
+
+@pytest.fixture(scope='session')
+def tracks_table(mpd_output):
+    """The consolidated tracks table: one row per playlist track."""
+    return clean_raw_data.load_mpd_table(os.path.join(mpd_output, 'tracks'))
+
+
+@pytest.fixture(scope='session')
+def playlist_df(mpd_output):
+    return clean_raw_data.load_mpd_table(os.path.join(mpd_output, 'playlists'), index_col='pid')
+
+
+@pytest.fixture(scope='session')
+def track_df(tracks_table):
+    """Unique tracks indexed by track_uri, in the shape the notebooks use."""
+    return tracks_table.drop(columns=['pid', 'pos']).drop_duplicates(subset=['track_uri']).set_index('track_uri')
+
+
+@pytest.fixture
+def model(playlist_df, track_df):
+    model = BaselineModels(playlist_df, track_df.copy(), seed=0)
+    model.calculate_track_popularities()
+    return model
+
+
+@pytest.fixture
+def metrics():
+    """Enable instrumentation on a clean registry for one test."""
+    instrumentation.METRICS.reset()
+    instrumentation.enable()
+    yield instrumentation.METRICS
+    instrumentation.enable(False)
+    instrumentation.METRICS.reset()
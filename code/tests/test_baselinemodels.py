@@ -0,0 +1,126 @@
+"""Tests of BaselineModels batch recommendations, track features, snapshots and title recommendations."""
+
+# ---------- Imports ---------- #
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from baselinemodels import BaselineModels
+from playliststore import PlaylistStore
+from title_index import TitleIndex
+
+
+def _seed_lists(playlist_df, num_playlists=40, num_seeds=3):
+    columns = [f'track_{n}_uri' for n in range(1, num_seeds + 1)]
+    return [[uri for uri in row if isinstance(uri, str)] for row in playlist_df[columns].to_numpy()[:num_playlists]]
+
+
+# ---------- Track Features ---------- #
+
+@pytest.mark.parametrize('with_store', [False, True])
+def test_get_track_features_of_recommend_batch_ids(model, playlist_df, tmp_path, with_store):
+    # An empty seed list guarantees a row of -1 padding
+    track_ids = model.recommend_batch(_seed_lists(playlist_df) + [[]], 'artists', 10, return_ids=True)
+    assert track_ids.ndim == 2 and (track_ids < 0).any()
+
+    if with_store:
+        model.build_track_store(str(tmp_path / 'store'))
+    features = model.get_track_features(track_ids, ('track_uri', 'track_name', 'duration_ms'))
+
+    flat = track_ids.ravel()
+    padding = flat < 0
+    assert len(features) == track_ids.size
+    assert features.index.tolist() == flat.tolist()
+    assert features['track_uri'][~padding].tolist() == model.track_uris[flat[~padding]].tolist()
+    assert features['track_name'][~padding].tolist() == model.track_df['track_name'].iloc[flat[~padding]].tolist()
+    assert features[padding].isna().all().all()
+
+
+def test_get_track_features_store_matches_dataframe(model, tmp_path):
+    track_ids = np.array([[0, 5, -1], [len(model.track_uris) - 1, -1, -1]])
+    fields = ('track_uri', 'artist_name', 'album_uri', 'duration_ms')
+    from_df = model.get_track_features(track_ids, fields)
+    model.build_track_store(str(tmp_path / 'store'))
+    from_store = model.get_track_features(track_ids, fields)
+
+    valid = track_ids.ravel() >= 0
+    assert from_df[valid].astype(object).equals(from_store[valid].astype(object))
+    assert from_store[~valid].isna().all().all()
+
+
+# ---------- Batch Recommendations ---------- #
+
+@pytest.mark.parametrize('strategy', ['popular', 'artists', 'albums'])
+def test_recommend_batch_excludes_seeds(model, playlist_df, strategy):
+    seed_lists = _seed_lists(playlist_df)
+    recommended = model.recommend_batch(seed_lists, strategy, 10)
+    assert recommended.shape == (len(seed_lists), 10)
+    for seeds, row in zip(seed_lists, recommended.tolist()):
+        tracks = [uri for uri in row if uri is not None]
+        assert not set(seeds) & set(tracks)
+        assert len(set(tracks)) == len(tracks)
+
+
+def test_recommend_batch_popular_matches_recommend_popular_tracks(model, playlist_df):
+    seed_lists = _seed_lists(playlist_df)
+    recommended = model.recommend_batch(seed_lists, 'popular', 10)
+    for seeds, row in zip(seed_lists, recommended.tolist()):
+        assert row == model.recommend_popular_tracks(10, seeds)
+
+
+def test_ragged_from_ingest_ids(model, mpd_output, tmp_path):
+    store = PlaylistStore.build(str(tmp_path / 'playlists'), os.path.join(mpd_output, 'ids'))
+    offsets, track_ids = store.ragged()
+    seed_lists = [store.uris().decode(track_ids[offsets[i]:offsets[i + 1]]).tolist() for i in range(len(store))]
+
+    ragged = model.ragged_from_ingest_ids(offsets, track_ids, store.uris())
+    assert (model.recommend_batch(ragged, 'popular', 10) == model.recommend_batch(seed_lists, 'popular', 10)).all()
+
+
+def test_recommend_batch_rejects_ids_outside_the_model(model):
+    with pytest.raises(ValueError, match='ragged_from_ingest_ids'):
+        model.recommend_batch((np.array([0, 1]), np.array([len(model.track_uris)])))
+
+
+# ---------- Snapshots ---------- #
+
+def test_snapshot_round_trip(model, playlist_df, tmp_path):
+    directory = str(tmp_path / 'snapshot')
+    model.save_snapshot(directory)
+    snapshot = BaselineModels.load_snapshot(directory, seed=0)
+    seed_lists = _seed_lists(playlist_df)
+
+    assert (snapshot.recommend_batch(seed_lists, 'popular', 10) == model.recommend_batch(seed_lists, 'popular', 10)).all()
+    for seeds in seed_lists[:10]:
+        assert snapshot.recommend_popular_tracks(10, seeds) == model.recommend_popular_tracks(10, seeds)
+
+    restored = pickle.loads(pickle.dumps(snapshot))
+    assert restored.recommend_popular_tracks(5, seed_lists[0]) == snapshot.recommend_popular_tracks(5, seed_lists[0])
+
+
+# ---------- Title Recommendations ---------- #
+
+def test_recommend_tracks_by_title(model, playlist_df, mpd_output):
+    model.attach_title_index(TitleIndex.build(os.path.join(mpd_output, 'playlists'), os.path.join(mpd_output, 'ids')))
+    name = playlist_df['name'].iloc[0]
+
+    recommended = model.recommend_tracks_by_title(10, name=name)
+    assert len(recommended) == 10 and len(set(recommended)) == 10
+
+    seeds = recommended[:3]
+    assert not set(seeds) & set(model.recommend_tracks_by_title(10, seeds, name=name))
+
+    # Unknown names fall back to the most popular tracks
+    assert model.recommend_tracks_by_title(5, name='zzz qqq') == model.recommend_popular_tracks(5)
+
+
+def test_recommend_tracks_by_title_name_is_keyword_only(model):
+    with pytest.raises(TypeError):
+        model.recommend_tracks_by_title(5, [], 'road trip')
+
+
+def test_recommend_tracks_by_title_needs_an_index(model):
+    with pytest.raises(ValueError, match='attach_title_index'):
+        model.recommend_tracks_by_title(5, name='road trip')
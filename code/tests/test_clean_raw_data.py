@@ -0,0 +1,37 @@
+"""Tests of the slice consolidation and its de-duplication of tracks, albums and artists."""
+
+# ---------- Imports ---------- #
+import os
+
+import numpy as np
+import pytest
+
+import clean_raw_data
+from clean_raw_data import SeenHashes
+
+
+def test_seen_hashes_matches_a_set():
+    rng = np.random.default_rng(0)
+    seen, expected = SeenHashes(), set()
+    for size in [1, 7, 0, 50, 3, 200, 2, 2, 90]:
+        hashes = rng.integers(0, 500, size=size).astype(np.uint64)
+        assert seen.contains(hashes).tolist() == [h in expected for h in hashes.tolist()]
+
+        new = np.unique(hashes[~seen.contains(hashes)])
+        seen.add(new)
+        expected.update(new.tolist())
+        assert len(seen) == len(expected)
+
+    # Runs stay sorted, each more than twice the size of the next
+    assert all((np.diff(run.astype(np.int64)) > 0).all() for run in seen.runs)
+    assert all(len(a) > 2 * len(b) for a, b in zip(seen.runs, seen.runs[1:]))
+
+
+@pytest.mark.parametrize('name, key_col', [('unique_tracks', 'track_uri'), ('unique_albums', 'album_uri'),
+                                           ('unique_artists', 'artist_uri')])
+def test_unique_tables_keep_the_first_row_of_every_uri(mpd_output, tracks_table, name, key_col):
+    unique = clean_raw_data.load_mpd_table(os.path.join(mpd_output, f'{name}.csv'))
+    assert unique[key_col].is_unique
+    first_rows = tracks_table.drop_duplicates(key_col)
+    assert unique[key_col].tolist() == first_rows[key_col].tolist()
+    assert unique[unique.columns].astype(object).equals(first_rows[unique.columns].reset_index(drop=True).astype(object))
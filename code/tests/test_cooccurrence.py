@@ -0,0 +1,82 @@
+"""Tests of the sparse track co-occurrence index."""
+
+# ---------- Imports ---------- #
+import os
+import mmap
+
+import numpy as np
+import pytest
+
+import cooccurrence
+from cooccurrence import CooccurrenceIndex
+
+
+@pytest.fixture(scope='module')
+def index(mpd_output):
+    return CooccurrenceIndex.from_ids_output(os.path.join(mpd_output, 'ids'), num_neighbours=10, max_chunk_cost=5000)
+
+
+def _dense_counts(mpd_output):
+    ids = cooccurrence.clean_raw_data.load_mpd_table(os.path.join(mpd_output, 'ids', 'tracks'), columns=['pid', 'track_id'])
+    matrix = cooccurrence.playlist_track_matrix(ids['pid'].to_numpy(), ids['track_id'].to_numpy()).toarray()
+    counts = matrix.T @ matrix
+    np.fill_diagonal(counts, 0)
+    return counts
+
+
+def test_playlist_track_matrix_dedupes_and_groups():
+    matrix = cooccurrence.playlist_track_matrix([7, 7, 7, 3, 3], [0, 2, 0, 1, 2], num_tracks=4)
+    assert matrix.toarray().tolist() == [[1, 0, 1, 0], [0, 1, 1, 0]]
+
+
+def test_chunks_cover_every_track():
+    playlist_tracks = cooccurrence.playlist_track_matrix([0, 0, 1, 1, 1, 2], [0, 1, 1, 2, 3, 3])
+    boundaries = cooccurrence.chunk_boundaries(playlist_tracks, max_chunk_cost=4)
+    assert boundaries[0] == 0 and boundaries[-1] == 4
+    assert (np.diff(boundaries) > 0).all()
+
+
+def test_neighbours_are_the_top_counts(index, mpd_output):
+    counts = _dense_counts(mpd_output)
+    for track_id in [0, 1, len(index) // 2, len(index) - 1]:
+        neighbour_ids, scores = index.neighbours_of(track_id)
+        row = counts[track_id]
+        expected = [n for n in np.argsort(-row, kind='stable') if row[n] > 0][:10]
+        assert neighbour_ids.tolist() == expected
+        assert scores.tolist() == row[expected].tolist()
+
+
+def test_workers_match_a_single_process(mpd_output, index, tmp_path):
+    parallel = CooccurrenceIndex.from_ids_output(os.path.join(mpd_output, 'ids'), num_neighbours=10, max_chunk_cost=5000,
+                                                 num_workers=2, scratch_directory=str(tmp_path))
+    assert (parallel.neighbours != index.neighbours).nnz == 0
+    assert (parallel.neighbours.indptr == index.neighbours.indptr).all()
+    assert os.listdir(tmp_path) == []
+
+
+def test_recommend_tracks_excludes_seeds(index):
+    seeds = index.track_uris[[0, 5]].tolist()
+    recommended = index.recommend_tracks(10, seeds + ['spotify:track:unknown'])
+    assert 0 < len(recommended) <= 10
+    assert not set(seeds) & set(recommended)
+    assert index.recommend_tracks(10, ['spotify:track:unknown']) == []
+
+
+def test_save_and_load(index, tmp_path):
+    index.save(str(tmp_path / 'index'))
+    loaded = CooccurrenceIndex.load(str(tmp_path / 'index'))
+    assert loaded.meta == index.meta
+    assert loaded.track_uris.tolist() == index.track_uris.tolist()
+    assert (loaded.neighbours != index.neighbours).nnz == 0
+
+
+def test_csr_files_are_memory_mapped(tmp_path):
+    matrix = cooccurrence.playlist_track_matrix([0, 0, 1], [0, 2, 1])
+    cooccurrence._save_csr(str(tmp_path), 'm', matrix)
+    loaded = cooccurrence._load_csr(str(tmp_path), 'm')
+    assert (loaded != matrix).nnz == 0
+
+    for part in [loaded.data, loaded.indices, loaded.indptr]:
+        while isinstance(part, np.ndarray):
+            part = part.base
+        assert isinstance(part, mmap.mmap)
@@ -0,0 +1,60 @@
+"""Tests of the IVF EmbeddingIndex."""
+
+# ---------- Imports ---------- #
+import numpy as np
+import pytest
+
+from embedding_index import EmbeddingIndex
+
+
+@pytest.fixture(scope='module')
+def vectors():
+    return np.random.default_rng(0).normal(size=(500, 16)).astype(np.float32)
+
+
+@pytest.fixture(scope='module')
+def index(vectors):
+    track_uris = [f'spotify:track:{n}' for n in range(len(vectors))]
+    return EmbeddingIndex.build(vectors, track_uris, num_lists=20, nprobe=4, recall_queries=20, seed=0)
+
+
+def test_lists_partition_the_tracks(index, vectors):
+    assert len(index) == len(vectors)
+    assert index.list_offsets[-1] == len(vectors)
+    assert sorted(index.list_track_ids.tolist()) == list(range(len(vectors)))
+    assert np.allclose(np.linalg.norm(index.list_vectors, axis=1), 1)
+    assert 0 <= index.build_stats['recall'] <= 1
+
+
+def test_probing_every_list_is_exact(index, vectors):
+    query = vectors[:5].mean(axis=0)
+    exclude = np.arange(5)
+    exact_ids, exact_scores = index.brute_force_search(query, 10, exclude)
+    ids, scores = index.search(query, 10, nprobe=len(index.centroids), exclude_ids=exclude)
+
+    assert ids.tolist() == exact_ids.tolist()
+    assert np.allclose(scores, exact_scores)
+    assert (np.diff(scores) <= 0).all()
+
+    # Brute force itself agrees with a full sort of the cosine similarities
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    order = [n for n in np.argsort(-(normalized @ (query / np.linalg.norm(query)))) if n >= 5]
+    assert exact_ids.tolist() == order[:10]
+
+
+def test_recommend_tracks_skips_seeds_and_unknown_uris(index):
+    seeds = index.track_uris[[3, 40, 41]].tolist()
+    recommended = index.recommend_tracks(10, seeds + ['spotify:track:unknown'])
+    assert len(recommended) == 10
+    assert not set(seeds) & set(recommended)
+    assert index.recommend_tracks(10, ['spotify:track:unknown']) == []
+
+
+def test_save_and_load(index, tmp_path):
+    index.save(str(tmp_path / 'index'))
+    loaded = EmbeddingIndex.load(str(tmp_path / 'index'))
+
+    assert isinstance(loaded.list_vectors, np.memmap)
+    assert loaded.nprobe == index.nprobe and loaded.build_stats == index.build_stats
+    seeds = index.track_uris[:4].tolist()
+    assert loaded.recommend_tracks(10, seeds) == index.recommend_tracks(10, seeds)
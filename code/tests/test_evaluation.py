@@ -0,0 +1,81 @@
+"""Tests of the offline evaluation: holdout split, challenge metrics and the evaluate loop."""
+
+# ---------- Imports ---------- #
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import evaluation
+from title_index import TitleIndex
+
+
+# ---------- Holdout ---------- #
+
+def test_holdout_split():
+    tracks_df = pd.DataFrame({'pid': [1, 1, 1, 2, 2, 3, 3, 3, 3],
+                              'pos': [2, 0, 1, 0, 1, 0, 1, 2, 3],
+                              'track_uri': ['c', 'a', 'b', 'd', 'e', 'f', 'g', 'h', 'i']})
+    pids, seeds, holdouts = evaluation.holdout_split(tracks_df, num_seeds=2)
+    assert pids.tolist() == [1, 3]
+    assert seeds == [['a', 'b'], ['f', 'g']]
+    assert holdouts == [['c'], ['h', 'i']]
+
+    pids, _, _ = evaluation.holdout_split(tracks_df, num_seeds=2, num_playlists=1, seed=0)
+    assert len(pids) == 1 and pids[0] in (1, 3)
+
+
+# ---------- Metrics ---------- #
+
+def test_score_recommendations():
+    recommended = [['x', 'a', 'y', 'b'], ['x', 'y'], [f'n{n}' for n in range(11)] + ['a']]
+    ground_truth = [['a', 'b', 'c'], ['a'], ['a', 'b']]
+    scores = evaluation.score_recommendations(recommended, ground_truth, num_tracks=20)
+
+    # Hits at ranks 2 and 4: DCG = 1 + 1/2, IDCG of 2 hits = 1 + 1
+    assert np.allclose(scores['r_precision'], [1 / 3, 0, 0])
+    assert np.allclose(scores['ndcg'], [0.75, 0, 1 / np.log2(12)])
+    assert scores['clicks'].tolist() == [0, 3, 1]
+
+
+def test_score_recommendations_truncates_and_ignores_duplicate_truth():
+    scores = evaluation.score_recommendations([['b', 'a']], [['a', 'a']], num_tracks=1)
+    assert scores['r_precision'].tolist() == [0]
+    assert scores['clicks'].tolist() == [1]
+
+
+# ---------- Evaluation ---------- #
+
+def test_evaluate_is_independent_of_workers(model, tracks_table):
+    pids, seeds, holdouts = evaluation.holdout_split(tracks_table, num_seeds=3, num_playlists=30)
+    strategies = ['popular', 'artists_random']
+    results, summary = evaluation.evaluate(model, pids, seeds, holdouts, strategies, num_tracks=50, chunk_size=7)
+    parallel, _ = evaluation.evaluate(model, pids, seeds, holdouts, strategies, num_tracks=50, chunk_size=7,
+                                      num_workers=2)
+
+    assert len(results) == 2 * len(pids)
+    assert results['pid'].tolist() == pids.tolist() * 2
+    assert summary.index.tolist() == strategies
+    assert (summary['playlists'] == len(pids)).all()
+    columns = ['strategy', 'pid', 'r_precision', 'ndcg', 'clicks']
+    assert results[columns].equals(parallel[columns])
+
+
+def test_evaluate_title_strategy(model, mpd_output, playlist_df, tracks_table):
+    model.attach_title_index(TitleIndex.build(os.path.join(mpd_output, 'playlists'), os.path.join(mpd_output, 'ids')))
+    pids, seeds, holdouts = evaluation.holdout_split(tracks_table, num_seeds=0, num_playlists=20)
+    names = playlist_df.loc[pids, 'name'].tolist()
+
+    with pytest.raises(ValueError, match='playlist names'):
+        evaluation.evaluate(model, pids, seeds, holdouts, ['title'])
+
+    results, summary = evaluation.evaluate(model, pids, seeds, holdouts, ['title', 'popular'], num_tracks=50,
+                                           names=names)
+    assert summary.loc['title', 'playlists'] == len(pids)
+    assert summary.loc['title', 'r_precision'] >= 0
+
+
+def test_evaluate_rejects_unknown_strategies(model):
+    with pytest.raises(ValueError, match='Unknown strategy'):
+        evaluation.evaluate(model, [], [], [], ['nearest'])
@@ -0,0 +1,115 @@
+"""Tests of the metrics registry and the recording helpers."""
+
+# ---------- Imports ---------- #
+import json
+
+import pytest
+
+import evaluation
+import instrumentation
+from instrumentation import Histogram, Metrics
+
+
+# ---------- Histograms ---------- #
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram(buckets=(1, 10, 100))
+    for value in [0.5, 1, 5, 50, 50, 500]:
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 1, 2, 1]
+    assert histogram.count == 6 and histogram.sum == pytest.approx(606.5)
+    assert histogram.quantile(0.3) == 1
+    assert histogram.quantile(0.5) == 10
+    assert histogram.quantile(0.8) == 100
+    assert histogram.quantile(1.0) == float('inf')
+    assert Histogram().quantile(0.5) is None
+
+
+def test_histogram_merge():
+    a, b = Histogram(buckets=(1, 10)), Histogram(buckets=(1, 10))
+    a.observe(0.5)
+    b.observe(5)
+    b.observe(50)
+    a.merge(b.to_dict())
+    assert a.counts == [1, 1, 1] and a.count == 3
+
+    with pytest.raises(ValueError):
+        a.merge(Histogram(buckets=(2,)).to_dict())
+
+
+# ---------- Registry ---------- #
+
+def test_slowest_keeps_the_largest_values():
+    metrics = Metrics(max_slowest=3)
+    built = []
+    for value in [5, 9, 7, 1, 3]:
+        metrics.record_slowest('picks', value, lambda value=value: built.append(value) or {'value': value})
+
+    assert [entry['value'] for entry in metrics.to_dict()['slowest']['picks']] == [9, 7, 5]
+    # Details are only built for calls that are kept
+    assert built == [5, 9, 7]
+
+
+def test_drain_and_merge():
+    worker = Metrics()
+    worker.count('rows_total', 4, kind='track')
+    worker.observe('call_seconds', 0.002, method='a')
+    worker.record_slowest('picks', 12, {'seeds': 3})
+    state = json.loads(json.dumps(worker.drain()))
+    assert worker.to_dict() == {'counters': [], 'histograms': [], 'slowest': {}}
+
+    parent = Metrics()
+    parent.count('rows_total', 1, kind='track')
+    parent.merge(state)
+    parent.merge(state)
+    summary = parent.to_dict()
+    assert summary['counters'] == [{'name': 'rows_total', 'labels': {'kind': 'track'}, 'value': 9}]
+    assert summary['histograms'][0]['count'] == 2
+    assert [entry['value'] for entry in summary['slowest']['picks']] == [12, 12]
+
+
+def test_to_prometheus():
+    metrics = Metrics()
+    metrics.count('calls_total', 2, method='a')
+    metrics.count('calls_total', 1, method='b"c')
+    metrics.observe('call_seconds', 0.5, buckets=(0.1, 1), method='a')
+    text = metrics.to_prometheus()
+
+    assert text.count('# TYPE mpd_calls_total counter') == 1
+    assert 'mpd_calls_total{method="a"} 2' in text
+    assert 'mpd_calls_total{method="b\\"c"} 1' in text
+    assert 'mpd_call_seconds_bucket{method="a",le="0.1"} 0' in text
+    assert 'mpd_call_seconds_bucket{method="a",le="+Inf"} 1' in text
+    assert 'mpd_call_seconds_count{method="a"} 1' in text
+
+
+# ---------- Recording Helpers ---------- #
+
+def test_disabled_helpers_record_nothing(monkeypatch):
+    monkeypatch.setattr(instrumentation, 'ENABLED', False)
+    instrumentation.METRICS.reset()
+    instrumentation.count('rows_total')
+    with instrumentation.timed('block_seconds'):
+        pass
+    assert instrumentation.METRICS.to_dict()['counters'] == []
+    assert instrumentation.METRICS.to_dict()['histograms'] == []
+
+
+def test_instrumented_model_calls(metrics, model):
+    model.recommend_popular_tracks(10)
+    model.recommend_popular_tracks(10)
+    summary = metrics.to_dict()
+
+    calls = {(c['name'], c['labels'].get('method')): c['value'] for c in summary['counters']}
+    assert calls['calls_total', 'recommend_popular_tracks'] == 2
+    histogram = next(h for h in summary['histograms'] if h['labels'] == {'method': 'recommend_popular_tracks'})
+    assert histogram['count'] == 2
+
+
+def test_evaluation_workers_send_back_their_metrics(metrics, model, tracks_table):
+    pids, seeds, holdouts = evaluation.holdout_split(tracks_table, num_seeds=3, num_playlists=20)
+    evaluation.evaluate(model, pids, seeds, holdouts, ['popular'], num_tracks=20, chunk_size=5, num_workers=2)
+
+    calls = {(c['name'], c['labels'].get('method')): c['value'] for c in metrics.to_dict()['counters']}
+    assert calls['calls_total', 'recommend_popular_tracks'] == len(pids)
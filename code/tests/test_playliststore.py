@@ -0,0 +1,52 @@
+"""Tests of the ragged, memory-mapped PlaylistStore."""
+
+# ---------- Imports ---------- #
+import os
+
+import numpy as np
+import pytest
+
+from playliststore import PlaylistStore
+
+
+@pytest.fixture
+def store(mpd_output, tmp_path):
+    return PlaylistStore.build(str(tmp_path / 'store'), os.path.join(mpd_output, 'ids'), chunk_rows=97)
+
+
+def test_playlists_match_the_tracks_table(store, tracks_table):
+    pids = np.sort(tracks_table['pid'].unique())
+    assert store.pids.tolist() == pids.tolist()
+    assert store.meta['num_tracks'] == len(tracks_table)
+
+    for pid in pids[[0, 1, len(pids) // 2, len(pids) - 1]]:
+        expected = tracks_table[tracks_table['pid'] == pid].sort_values('pos')['track_uri'].tolist()
+        assert store.uris().decode(store.tracks_of(pid)).tolist() == expected
+
+
+def test_album_and_artist_arrays_align_with_tracks(store, tracks_table):
+    pid = int(store.pids[3])
+    rows = tracks_table[tracks_table['pid'] == pid].sort_values('pos')
+    assert store.uris('albums').decode(store.tracks_of(pid, 'albums')).tolist() == rows['album_uri'].tolist()
+    assert store.uris('artists').decode(store.tracks_of(pid, 'artists')).tolist() == rows['artist_uri'].tolist()
+
+
+def test_first_k_pads_short_playlists(store):
+    k = int(store.lengths().max()) + 1
+    matrix = store.first_k(k)
+    for row in [0, len(store) - 1]:
+        tracks = store.tracks_of(int(store.pids[row]))
+        assert matrix[row, :len(tracks)].tolist() == tracks.tolist()
+        assert (matrix[row, len(tracks):] == -1).all()
+
+
+def test_counts(store, tracks_table):
+    counts = store.counts()
+    expected = tracks_table['track_uri'].value_counts()
+    uris = store.uris().decode(np.arange(len(counts)))
+    assert counts.tolist() == expected.reindex(uris).tolist()
+
+
+def test_unknown_pid(store):
+    with pytest.raises(KeyError):
+        store.row_of(10 ** 9)
@@ -0,0 +1,115 @@
+"""Tests of the recommendation HTTP service: validation, caching, micro-batching and error responses."""
+
+# ---------- Imports ---------- #
+import os
+import json
+import threading
+import http.client
+
+import pytest
+
+import service
+from title_index import TitleIndex
+
+
+@pytest.fixture
+def recommendation_service(model, mpd_output):
+    model.attach_title_index(TitleIndex.build(os.path.join(mpd_output, 'playlists'), os.path.join(mpd_output, 'ids')))
+    recommendation_service = service.RecommendationService(model, max_batch=8)
+    yield recommendation_service
+    recommendation_service.batcher.close()
+
+
+@pytest.fixture
+def post(recommendation_service):
+    """POST a raw body to the running service; returns (status, decoded JSON payload)."""
+    server = service.make_server(recommendation_service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def post(body, path='/recommend'):
+        connection = http.client.HTTPConnection('127.0.0.1', server.server_port)
+        connection.request('POST', path, body, {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        payload = json.loads(response.read())
+        connection.close()
+        return response.status, payload
+
+    yield post
+    server.shutdown()
+    server.server_close()
+
+
+# ---------- Recommendations ---------- #
+
+def test_recommend_matches_the_model(recommendation_service, model, playlist_df):
+    seeds = playlist_df[['track_1_uri', 'track_2_uri']].iloc[0].tolist()
+    tracks, cached = recommendation_service.recommend(seeds, 'popular', 10)
+    assert tracks == model.recommend_popular_tracks(10, seeds)
+    assert not cached
+    assert recommendation_service.recommend(list(reversed(seeds)), 'popular', 10) == (tracks, True)
+    assert recommendation_service.stats()['requests'] == 2
+
+
+def test_random_strategies_are_not_cached(recommendation_service, playlist_df):
+    seeds = playlist_df[['track_1_uri']].iloc[0].tolist()
+    for strategy in ['artists_popular', 'artists_random', 'albums_popular', 'albums_random']:
+        assert strategy not in service.CACHEABLE_STRATEGIES
+        recommendation_service.recommend(seeds, strategy, 10)
+        assert recommendation_service.recommend(seeds, strategy, 10)[1] is False
+    assert len(recommendation_service.cache) == 0
+
+
+def test_title_cache_key_uses_name_tokens(recommendation_service, playlist_df):
+    name = playlist_df['name'].iloc[0]
+    tracks, cached = recommendation_service.recommend([], 'title', 10, name=name)
+    assert len(tracks) == 10 and not cached
+    assert recommendation_service.recommend([], 'title', 10, name=f'  {name.upper()}! ') == (tracks, True)
+    assert recommendation_service.recommend([], 'title', 10, name=f'{name} zzz')[1] is False
+
+
+def test_concurrent_requests_are_counted(recommendation_service, playlist_df):
+    seed_lists = [[uri] for uri in playlist_df['track_1_uri'].iloc[:50]]
+    threads = [threading.Thread(target=recommendation_service.recommend, args=(seeds, 'artists_random', 5))
+               for seeds in seed_lists for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert recommendation_service.stats()['requests'] == len(threads)
+    assert recommendation_service.batcher.batched_requests == len(threads)
+
+
+@pytest.mark.parametrize('kwargs', [{'strategy': 'nearest'}, {'k': True}, {'k': 0}, {'k': service.MAX_TRACKS + 1},
+                                    {'k': '10'}, {'seeds': 'spotify:track:1'}, {'name': 3}])
+def test_invalid_requests(recommendation_service, kwargs):
+    with pytest.raises(service.BadRequest):
+        recommendation_service.recommend(**{'seeds': [], **kwargs})
+
+
+# ---------- HTTP ---------- #
+
+def test_post_recommend(post, model, playlist_df):
+    seeds = playlist_df[['track_1_uri']].iloc[1].tolist()
+    status, payload = post(json.dumps({'seeds': seeds, 'k': 5}))
+    assert status == 200
+    assert payload == {'tracks': model.recommend_popular_tracks(5, seeds), 'cached': False}
+
+
+@pytest.mark.parametrize('body', [b'{"seeds": [', b'[1, 2]', json.dumps({'k': False}).encode('utf-8')])
+def test_bad_requests_are_400s(post, body):
+    status, payload = post(body)
+    assert status == 400
+    assert payload['error']
+
+
+def test_internal_errors_are_500s(post, capsys):
+    # No embedding index is attached, so the model raises a plain ValueError
+    status, payload = post(json.dumps({'seeds': [], 'strategy': 'embeddings'}))
+    assert status == 500
+    assert payload == {'error': 'Internal server error'}
+    assert 'No embedding index attached' in capsys.readouterr().err
+
+
+def test_unknown_path(post):
+    assert post(b'{}', path='/nowhere')[0] == 404
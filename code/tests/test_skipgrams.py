@@ -0,0 +1,104 @@
+"""Tests of the vectorized skip-gram training data generator."""
+
+# ---------- Imports ---------- #
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import skipgrams
+
+
+def _ragged(lengths, vocab_size=50, seed=0):
+    rng = np.random.default_rng(seed)
+    offsets = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+    return offsets, rng.integers(0, vocab_size, size=offsets[-1]).astype(np.int64)
+
+
+def _loop_pairs(offsets, tokens, window_size):
+    """Skip-gram pairs of the notebook's per-playlist loop."""
+    pairs = []
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        playlist = tokens[start:stop].tolist()
+        for i, target in enumerate(playlist):
+            for j in range(max(0, i - window_size), min(len(playlist), i + window_size + 1)):
+                if j != i:
+                    pairs.append((target, playlist[j]))
+    return sorted(pairs)
+
+
+def test_sequences_from_tracks_table():
+    tracks_df = pd.DataFrame({'pid': [2, 1, 1, 2, 1], 'pos': [1, 1, 0, 0, 2], 'track_id': [20, 11, 10, 21, 12]})
+    offsets, tokens = skipgrams.sequences_from_tracks_table(tracks_df)
+    assert offsets.tolist() == [0, 3, 5]
+    assert tokens.tolist() == [10, 11, 12, 21, 20]
+
+
+@pytest.mark.parametrize('window_size', [1, 2, 4])
+def test_skipgram_pairs_match_the_loop(window_size):
+    offsets, tokens = _ragged([1, 5, 2, 9, 3])
+    targets, contexts = skipgrams.skipgram_pairs(offsets, tokens, window_size)
+    assert sorted(zip(targets.tolist(), contexts.tolist())) == _loop_pairs(offsets, tokens, window_size)
+
+
+def test_sample_negatives_avoid_the_positive_context():
+    table = skipgrams.make_negative_sampling_table(np.ones(10))
+    contexts = np.random.default_rng(1).integers(0, 10, size=1000)
+    negatives = skipgrams.sample_negatives(contexts, 4, table, np.random.default_rng(0))
+    assert negatives.shape == (1000, 4)
+    assert ((negatives >= 0) & (negatives < 10)).all()
+    assert (negatives != contexts[:, None]).all()
+
+
+def test_shards_cover_every_playlist():
+    offsets, tokens = _ragged(np.full(25, 6))
+    full = skipgrams.generate_training_data(offsets, tokens, sample=None, seed=0)
+    shards = list(skipgrams.generate_training_shards(offsets, tokens, sample=None, playlists_per_shard=7, seed=0))
+    assert len(shards) == 4
+    assert sum(len(targets) for targets, _, _ in shards) == len(full[0])
+
+    targets, contexts, labels = shards[0]
+    assert contexts.shape == labels.shape == (len(targets), 5)
+    assert (labels[:, 0] == 1).all() and (labels[:, 1:] == 0).all()
+
+
+# ---------- tf.data ---------- #
+
+@pytest.fixture
+def fake_tensorflow(monkeypatch):
+    """A stand-in for the parts of TensorFlow make_tf_dataset uses, exposing its generator and signature."""
+
+    class Dataset:
+        def __init__(self, generator, output_signature):
+            self.generator, self.output_signature = generator, output_signature
+
+        @classmethod
+        def from_generator(cls, generator, output_signature):
+            return cls(generator, output_signature)
+
+        def prefetch(self, buffer_size):
+            return self
+
+    tf = types.ModuleType('tensorflow')
+    tf.int64 = 'int64'
+    tf.TensorSpec = lambda shape, dtype: shape
+    tf.data = types.SimpleNamespace(Dataset=Dataset, AUTOTUNE=-1)
+    monkeypatch.setitem(sys.modules, 'tensorflow', tf)
+    return tf
+
+
+@pytest.mark.parametrize('drop_remainder', [False, True])
+def test_make_tf_dataset_keeps_shard_remainders(fake_tensorflow, drop_remainder):
+    offsets, tokens = _ragged(np.full(30, 8))
+    total = sum(len(targets) for targets, _, _ in
+                skipgrams.generate_training_shards(offsets, tokens, sample=None, playlists_per_shard=7, seed=1))
+
+    dataset = skipgrams.make_tf_dataset(offsets, tokens, sample=None, batch_size=64, playlists_per_shard=7, seed=1,
+                                        drop_remainder=drop_remainder)
+    sizes = [len(targets) for (targets, _), _ in dataset.generator()]
+
+    assert all(size == 64 for size in sizes[:-1])
+    assert sum(sizes) == (total - total % 64 if drop_remainder else total)
+    assert dataset.output_signature[1] == ((64 if drop_remainder else None), 5)
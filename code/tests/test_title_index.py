@@ -0,0 +1,80 @@
+"""Tests of the playlist-name TitleIndex."""
+
+# ---------- Imports ---------- #
+import os
+from collections import Counter, defaultdict
+
+import numpy as np
+import pytest
+
+from title_index import TitleIndex, normalize_name
+
+
+@pytest.fixture(scope='module')
+def index(mpd_output):
+    return TitleIndex.build(os.path.join(mpd_output, 'playlists'), os.path.join(mpd_output, 'ids'), top_n=1000)
+
+
+def _token_counts(index, token):
+    token_id = index.token_ids[token]
+    block = slice(index.top_offsets[token_id], index.top_offsets[token_id + 1])
+    return dict(zip(index.track_uris[index.top_tracks[block]].tolist(), index.top_counts[block].tolist()))
+
+
+def test_normalize_name():
+    assert normalize_name('Road Trip!! 🚗') == ['road', 'trip']
+    assert normalize_name('Café_del-MAR café') == ['cafe', 'del', 'mar']
+    assert normalize_name('') == normalize_name(None) == normalize_name(float('nan')) == []
+
+
+def test_index_matches_the_tables(index, playlist_df, tracks_table):
+    # Brute force: playlists and per-playlist track counts of every token
+    playlists_of, counts_of = defaultdict(set), defaultdict(Counter)
+    for pid, uris in tracks_table.groupby('pid')['track_uri']:
+        for token in normalize_name(playlist_df.loc[pid, 'name']):
+            playlists_of[token].add(pid)
+            counts_of[token].update(set(uris))
+
+    assert sorted(index.tokens) == sorted(playlists_of)
+    assert index.meta['num_playlists'] == tracks_table['pid'].nunique()
+    for token in index.tokens:
+        token_id = index.token_ids[token]
+        pids = index.posting_pids[index.posting_offsets[token_id]:index.posting_offsets[token_id + 1]]
+        assert pids.tolist() == sorted(playlists_of[token])
+        assert _token_counts(index, token) == dict(counts_of[token])
+
+
+def test_top_tracks_are_most_frequent_first(mpd_output, index):
+    small = TitleIndex.build(os.path.join(mpd_output, 'playlists'), os.path.join(mpd_output, 'ids'), top_n=3)
+    for token in index.tokens:
+        token_id = small.token_ids[token]
+        counts = small.top_counts[small.top_offsets[token_id]:small.top_offsets[token_id + 1]]
+        assert (np.diff(counts) <= 0).all()
+        assert counts.tolist() == sorted(_token_counts(index, token).values(), reverse=True)[:3]
+
+
+def test_compacting_small_buffers(mpd_output, index):
+    compacted = TitleIndex.build(os.path.join(mpd_output, 'playlists'), os.path.join(mpd_output, 'ids'), top_n=1000,
+                                 max_buffered_pairs=50)
+    assert compacted.tokens == index.tokens
+    for token in index.tokens:
+        assert _token_counts(compacted, token) == _token_counts(index, token)
+
+
+def test_recommend_tracks(index, playlist_df):
+    name = playlist_df['name'].iloc[0]
+    recommended = index.recommend_tracks(10, name)
+    assert len(recommended) == 10 and len(set(recommended)) == 10
+    assert index.recommend_tracks(10, 'zzz qqq') == []
+
+    pids, scores = index.playlists(name, k=5)
+    assert playlist_df.index[0] in pids.tolist()
+    assert (np.diff(scores) <= 0).all()
+
+
+def test_save_and_load(index, playlist_df, tmp_path):
+    index.save(str(tmp_path / 'index'))
+    loaded = TitleIndex.load(str(tmp_path / 'index'))
+    assert loaded.tokens == index.tokens and loaded.meta == index.meta
+    for name in playlist_df['name'].iloc[:10]:
+        assert loaded.recommend_tracks(20, name) == index.recommend_tracks(20, name)
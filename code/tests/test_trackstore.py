@@ -0,0 +1,49 @@
+"""Tests of the memory-mapped TrackStore."""
+
+# ---------- Imports ---------- #
+import numpy as np
+import pytest
+
+from trackstore import TrackStore, StringColumn
+
+
+@pytest.fixture
+def store(track_df, tmp_path):
+    return TrackStore.build(str(tmp_path / 'store'), track_df)
+
+
+def test_track_ids_are_track_df_rows(store, track_df):
+    assert len(store) == len(track_df)
+    uris = track_df.index[[0, 7, len(track_df) - 1]]
+    assert store.track_ids(uris).tolist() == [0, 7, len(track_df) - 1]
+    assert store.track_id('spotify:track:not-a-track') == -1
+
+
+@pytest.mark.parametrize('feature', ['track_uri', 'track_name', 'album_uri', 'album_name', 'artist_uri',
+                                     'artist_name', 'duration_ms'])
+def test_get_matches_track_df(store, track_df, feature):
+    for track_id in [0, 3, len(track_df) - 1]:
+        expected = track_df.index[track_id] if feature == 'track_uri' else track_df[feature].iloc[track_id]
+        assert store.get(track_id, feature) == expected
+
+
+def test_get_many_flattens_and_masks_padding(store, track_df):
+    features = store.get_many(np.array([[1, -1], [2, 0]]), ('track_name', 'artist_name', 'duration_ms'))
+    assert features.index.tolist() == [1, -1, 2, 0]
+    names = features['track_name']
+    assert names.iloc[[0, 2, 3]].tolist() == track_df['track_name'].iloc[[1, 2, 0]].tolist()
+    assert features.iloc[1].isna().all()
+    assert features.drop(index=-1).notna().all().all()
+
+
+def test_unknown_feature(store):
+    with pytest.raises(KeyError):
+        store.get(0, 'genre')
+
+
+def test_string_column_round_trip(tmp_path):
+    strings = ['', 'abc', 'ünïcødé', None, 'x' * 1000]
+    StringColumn.write(str(tmp_path / 'col'), strings)
+    column = StringColumn(str(tmp_path / 'col'))
+    assert len(column) == len(strings)
+    assert column.take(range(len(strings))) == ['', 'abc', 'ünïcødé', '', 'x' * 1000]
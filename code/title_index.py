@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+This module creates a TitleIndex for recommending tracks to playlists that only have a name,
+the cold-start case of the Spotify MPD Playlist Challenge.
+
+Playlist names are normalized into tokens (see normalize_name). The index holds, for every token:
+
+- its posting list: the pids of the playlists whose name contains it
+- its top tracks: the tracks found in the most of those playlists, with their playlist counts
+
+A title query looks up the top tracks of each of its tokens and merges them, weighting each token
+by its inverse document frequency, so no playlist is read at query time.
+
+Usage:
+    python3 title_index.py ../data/playlists ../data/ids [--out ../data/title_index] [--top 500]
+"""
+
+# ---------- Imports ---------- #
+import os
+import re
+import json
+import argparse
+import unicodedata
+
+import numpy as np
+
+import clean_raw_data
+
+
+# ---------- Name Normalization ---------- #
+
+# Anything that is not a letter or digit separates tokens
+_SEPARATORS = re.compile(r'[\W_]+')
+
+
+def normalize_name(name):
+    """
+    Return the tokens of a playlist name: lowercased, accents removed, and split on anything that
+    is not a letter or digit (so punctuation and emoji are dropped). Repeated tokens are kept once.
+    """
+    if not isinstance(name, str):
+        return []
+    decomposed = unicodedata.normalize('NFKD', name.lower())
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return list(dict.fromkeys(token for token in _SEPARATORS.split(stripped) if token))
+
+
+# ---------- TitleIndex Class ---------- #
+
+class TitleIndex:
+    """
+    Inverted index from name tokens to playlists and to their top tracks, stored CSR-style:
+    the playlists of token t are posting_pids[posting_offsets[t]:posting_offsets[t + 1]] and its
+    top tracks are top_tracks[top_offsets[t]:top_offsets[t + 1]] (rows of `track_uris`), most
+    frequent first, found in top_counts of its playlists.
+    """
+
+    def __init__(self, tokens, posting_offsets, posting_pids, top_offsets, top_tracks, top_counts, track_uris, meta):
+
+        self.tokens = list(tokens)
+        self.token_ids = {token: token_id for token_id, token in enumerate(self.tokens)}
+        self.posting_offsets = posting_offsets
+        self.posting_pids = posting_pids
+        self.top_offsets = top_offsets
+        self.top_tracks = top_tracks
+        self.top_counts = top_counts
+        self.track_uris = np.asarray(track_uris, dtype=object)
+        self.meta = meta
+
+        # Number of playlists per token, and the idf weight of each token
+        self.document_frequency = np.diff(posting_offsets)
+        self.idf = np.log(max(meta['num_playlists'], 1) / np.maximum(self.document_frequency, 1))
+
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+    @classmethod
+    def build(cls, playlists_path, ids_output, top_n=500, max_buffered_pairs=20_000_000):
+        """
+        Build an index from the playlist tables in `playlists_path` (file or directory of slices
+        with pid and name columns) and the ID-encoded tracks tables in <ids_output>/tracks (see
+        clean_raw_data.py --encode-ids), in one pass over the slices.
+
+        The (token, track) pairs of each chunk of playlists are counted once per playlist and
+        buffered as sorted (key, count) arrays, which are compacted whenever more than `max_buffered_pairs` are held.
+        The `top_n` tracks of every token are kept.
+        """
+
+        # pid -> name of every playlist; only these two columns are read
+        names = clean_raw_data.load_mpd_table(playlists_path, columns=['pid', 'name'])
+        names = names.drop_duplicates('pid').set_index('pid')['name']
+
+        token_ids = {}
+        postings = []
+        pair_keys, pair_counts, buffered = [], [], 0
+
+        for pids, track_ids in _playlist_chunks(ids_output):
+            # Tokens of each distinct playlist in the chunk
+            chunk_pids, rows = np.unique(pids, return_inverse=True)
+            playlist_tokens = [[token_ids.setdefault(token, len(token_ids)) for token in normalize_name(name)]
+                               for name in names.reindex(chunk_pids).tolist()]
+            num_tokens = np.array([len(tokens) for tokens in playlist_tokens], dtype=np.int64)
+            token_starts = np.cumsum(num_tokens) - num_tokens
+            flat_tokens = np.array([token for tokens in playlist_tokens for token in tokens], dtype=np.int64)
+            postings.append((flat_tokens, np.repeat(chunk_pids, num_tokens)))
+
+            # Each track counts once per playlist, then pairs with each of the playlist's tokens
+            playlist_tracks = np.unique((rows << 32) | track_ids)
+            pair_rows, pair_tracks = playlist_tracks >> 32, playlist_tracks & 0xFFFFFFFF
+            repeats = num_tokens[pair_rows]
+            within = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+            tokens = flat_tokens[np.repeat(token_starts[pair_rows], repeats) + within]
+            keys, counts = np.unique((tokens << 32) | np.repeat(pair_tracks, repeats), return_counts=True)
+
+            pair_keys.append(keys)
+            pair_counts.append(counts)
+            buffered += len(keys)
+            if buffered > max_buffered_pairs:
+                pair_keys, pair_counts = _compact_pairs(pair_keys, pair_counts)
+                buffered = len(pair_keys[0])
+
+        pair_keys, pair_counts = _compact_pairs(pair_keys, pair_counts)
+        tokens = [None] * len(token_ids)
+        for token, token_id in token_ids.items():
+            tokens[token_id] = token
+
+        # Posting lists, grouped by token, pids ascending
+        flat_tokens = np.concatenate([p[0] for p in postings]) if postings else np.zeros(0, dtype=np.int64)
+        flat_pids = np.concatenate([p[1] for p in postings]) if postings else np.zeros(0, dtype=np.int64)
+        order = np.lexsort((flat_pids, flat_tokens))
+        posting_offsets = _offsets(flat_tokens, len(tokens))
+        posting_pids = flat_pids[order].astype(np.int32)
+
+        # Top tracks per token: sort by token, then by descending count, and keep the first top_n
+        pair_tokens, pair_tracks = pair_keys[0] >> 32, pair_keys[0] & 0xFFFFFFFF
+        counts = pair_counts[0]
+        order = np.argsort((pair_tokens << 32) | (0x7FFFFFFF - counts), kind='stable')
+        pair_tokens, pair_tracks, counts = pair_tokens[order], pair_tracks[order], counts[order]
+        all_offsets = _offsets(pair_tokens, len(tokens))
+        keep = np.arange(len(pair_tokens)) - all_offsets[pair_tokens] < top_n
+        pair_tokens, pair_tracks, counts = pair_tokens[keep], pair_tracks[keep], counts[keep]
+
+        # Only tracks in some top list are kept, renumbered
+        kept_tracks, top_tracks = np.unique(pair_tracks, return_inverse=True)
+        track_uris = clean_raw_data.UriDictionary.load(os.path.join(ids_output, 'track_uris.txt')).decode(kept_tracks)
+
+        meta = {'num_playlists': int(len(np.unique(flat_pids))), 'num_tokens': len(tokens),
+                'num_tracks': len(track_uris), 'top_n': top_n}
+        return cls(tokens, posting_offsets, posting_pids, _offsets(pair_tokens, len(tokens)),
+                   top_tracks.astype(np.int32), counts.astype(np.int32), track_uris, meta)
+
+
+    # ---------- Queries ---------- #
+
+    def query_tokens(self, name):
+        """Return the IDs of the indexed tokens of a playlist name."""
+        return [self.token_ids[token] for token in normalize_name(name) if token in self.token_ids]
+
+
+    def playlists(self, name, k=100):
+        """
+        Return the pids and scores of the `k` playlists whose names best match `name`: posting
+        lists of the query tokens are merged, each playlist scoring the idf of every token it has.
+        """
+        token_ids = self.query_tokens(name)
+        if not token_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        pids = np.concatenate([self.posting_pids[self.posting_offsets[t]:self.posting_offsets[t + 1]] for t in token_ids])
+        weights = np.repeat(self.idf[token_ids], self.document_frequency[token_ids])
+        return _merge_top_k(pids, weights, k)
+
+
+    def search(self, name, k=500):
+        """
+        Return the row numbers (in track_uris) and scores of the `k` tracks best matching a
+        playlist name. A track scores, for every query token, the share of the token's playlists
+        that contain it times the token's idf; scores of the tokens' top tracks are summed.
+        """
+        token_ids = self.query_tokens(name)
+        if not token_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        blocks = [slice(self.top_offsets[t], self.top_offsets[t + 1]) for t in token_ids]
+        tracks = np.concatenate([self.top_tracks[block] for block in blocks])
+        weights = np.concatenate([self.top_counts[block] * (self.idf[t] / max(self.document_frequency[t], 1))
+                                  for t, block in zip(token_ids, blocks)])
+        return _merge_top_k(tracks, weights, k)
+
+
+    def recommend_tracks(self, num_tracks=5, name=''):
+        """Recommend the tracks best matching a playlist name (see search); [] if no token of it is indexed."""
+        track_rows, _ = self.search(name, num_tracks)
+        return self.track_uris[track_rows].tolist()
+
+
+    # ---------- Persistence ---------- #
+
+    def save(self, directory):
+        """Save the index to `directory`; arrays are memory-mapped when loaded back."""
+        os.makedirs(directory, exist_ok=True)
+        for name in ['posting_offsets', 'posting_pids', 'top_offsets', 'top_tracks', 'top_counts']:
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'tokens.txt'), 'w', encoding='utf-8') as file:
+            file.write('\n'.join(self.tokens))
+        with open(os.path.join(directory, 'track_uris.txt'), 'w') as file:
+            file.write('\n'.join(self.track_uris))
+        with open(os.path.join(directory, 'meta.json'), 'w') as file:
+            json.dump(self.meta, file)
+
+
+    @classmethod
+    def load(cls, directory):
+        """Open an index saved with save; the arrays are memory-mapped."""
+        with open(os.path.join(directory, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        with open(os.path.join(directory, 'tokens.txt'), 'r', encoding='utf-8') as file:
+            tokens = file.read().split('\n') if meta['num_tokens'] else []
+        with open(os.path.join(directory, 'track_uris.txt'), 'r') as file:
+            track_uris = file.read().split('\n') if meta['num_tracks'] else []
+
+        # Memory-mapped, as plain ndarrays since slicing an np.memmap is slower than the slice itself
+        arrays = {name: np.asarray(np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+                  for name in ['posting_offsets', 'posting_pids', 'top_offsets', 'top_tracks', 'top_counts']}
+        return cls(tokens, arrays['posting_offsets'], arrays['posting_pids'], arrays['top_offsets'],
+                   arrays['top_tracks'], arrays['top_counts'], track_uris, meta)
+
+
+# ---------- Helpers ---------- #
+
+def _offsets(groups, num_groups):
+    """CSR offsets of the groups numbered 0..num_groups - 1, for the group number of every entry."""
+    offsets = np.zeros(num_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=num_groups), out=offsets[1:])
+    return offsets
+
+
+def _playlist_chunks(ids_output):
+    """
+    Yield the (pid, track_id) int64 arrays of the ID-encoded tracks tables (in ascending pid order)
+    chunk by chunk, holding back the last playlist of each chunk so no playlist is split between two.
+    """
+    held_pids, held_tracks = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    for filepath in clean_raw_data.mpd_table_filepaths(os.path.join(ids_output, 'tracks')):
+        for chunk in clean_raw_data.iter_table_chunks(filepath, ['pid', 'track_id']):
+            pids = np.concatenate([held_pids, chunk['pid'].to_numpy(dtype=np.int64)])
+            track_ids = np.concatenate([held_tracks, chunk['track_id'].to_numpy(dtype=np.int64)])
+            if len(pids) == 0:
+                continue
+            split = np.searchsorted(pids, pids[-1])
+            held_pids, held_tracks = pids[split:], track_ids[split:]
+            if split:
+                yield pids[:split], track_ids[:split]
+    if len(held_pids):
+        yield held_pids, held_tracks
+
+
+def _compact_pairs(pair_keys, pair_counts):
+    """Merge buffered (key, count) arrays into one array of unique keys with summed counts."""
+    if not pair_keys:
+        return [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    keys, rows = np.unique(np.concatenate(pair_keys), return_inverse=True)
+    counts = np.bincount(rows, weights=np.concatenate(pair_counts), minlength=len(keys)).astype(np.int64)
+    return [keys], [counts]
+
+
+def _merge_top_k(ids, weights, k):
+    """Sum the weights of repeated ids and return the k ids with the largest sums, best first."""
+    unique_ids, rows = np.unique(ids, return_inverse=True)
+    scores = np.bincount(rows, weights=weights, minlength=len(unique_ids))
+
+    k = min(k, len(scores))
+    if k == 0:
+        return unique_ids[:0].astype(np.int64), scores[:0]
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return unique_ids[top].astype(np.int64), scores[top]
+
+
+# Running from Command Line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a TitleIndex from MPD playlist names and ID-encoded tracks.')
+    parser.add_argument('playlists', help='playlist table (file or directory of slices) with pid and name columns')
+    parser.add_argument('ids', help='ID-encoded output directory of clean_raw_data.py --encode-ids')
+    parser.add_argument('--out', default='../data/title_index', help='directory to save the index to')
+    parser.add_argument('--top', type=int, default=500, help='top tracks kept per token')
+    args = parser.parse_args()
+
+    index = TitleIndex.build(args.playlists, args.ids, args.top)
+    index.save(args.out)
+    print(f"{len(index)} tokens over {index.meta['num_playlists']} playlists saved to {args.out}")
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""This module creates a memory-mapped TrackStore of track, album and artist metadata."""
+
+# ---------- Imports ---------- #
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+# ---------- Fields ---------- #
+
+# Fixed-width numeric track columns
+TRACK_NUMERIC_FIELDS = {'album_id': np.int32, 'artist_id': np.int32, 'duration_ms': np.int32, 'popularity': np.int64}
+
+# String columns of each table, stored as offset-indexed UTF-8 blobs
+STRING_FIELDS = {
+    'tracks': ['track_uri', 'track_name'],
+    'albums': ['album_uri', 'album_name'],
+    'artists': ['artist_uri', 'artist_name'],
+}
+
+
+def uri_hash(uri):
+    """Stable 64-bit hash of a URI (Python's hash() differs between processes)."""
+    return int.from_bytes(hashlib.blake2b(uri.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _fill_missing(values, valid):
+    """Spread the values of the valid rows over all rows, with NaN (numeric) or None (strings) elsewhere."""
+    if valid.all():
+        return values
+    if isinstance(values, np.ndarray):
+        filled = np.full(len(valid), np.nan)
+    else:
+        filled = np.full(len(valid), None, dtype=object)
+    filled[valid] = values
+    return filled
+
+
+# ---------- String Columns ---------- #
+
+class StringColumn:
+    """
+    Read-only column of strings stored as one UTF-8 blob plus an offsets array:
+    string i is blob[offsets[i]:offsets[i + 1]]. Both files are memory-mapped.
+    """
+
+    def __init__(self, path_prefix):
+        self.offsets = np.load(path_prefix + '.offsets.npy', mmap_mode='r')
+        if os.path.getsize(path_prefix + '.blob') > 0:
+            self.blob = np.memmap(path_prefix + '.blob', dtype=np.uint8, mode='r')
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def take(self, ids):
+        return [self[i] for i in ids]
+
+    @staticmethod
+    def write(path_prefix, strings):
+        encoded = [('' if pd.isna(s) else str(s)).encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        np.save(path_prefix + '.offsets.npy', offsets)
+        with open(path_prefix + '.blob', 'wb') as file:
+            file.write(b''.join(encoded))
+
+
+# ---------- TrackStore Class ---------- #
+
+class TrackStore:
+    """
+    Compact on-disk store of track, album and artist metadata, opened with memory maps so that
+    every process reading the same directory shares one page-cache copy.
+
+    Track IDs are row positions in the track_df the store was built from, which matches the
+    track IDs used by BaselineModels. Albums and artists are numbered in order of first appearance.
+
+    Features include:
+        - 'track_uri'
+        - 'track_name'
+        - 'album_uri'
+        - 'album_name'
+        - 'album_id'
+        - 'artist_uri'
+        - 'artist_name'
+        - 'artist_id'
+        - 'duration_ms'
+        - 'popularity'
+    """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r') as file:
+            self.meta = json.load(file)
+
+        self.numeric = {field: np.load(os.path.join(directory, f'tracks.{field}.npy'), mmap_mode='r')
+                        for field in TRACK_NUMERIC_FIELDS}
+
+        self.strings = {}
+        for table, fields in STRING_FIELDS.items():
+            for field in fields:
+                self.strings[field] = StringColumn(os.path.join(directory, f'{table}.{field}'))
+
+        # Sorted URI hashes and the track ID of each, for URI -> ID lookups
+        self.uri_hashes = np.load(os.path.join(directory, 'tracks.uri_hash.npy'), mmap_mode='r')
+        self.uri_hash_ids = np.load(os.path.join(directory, 'tracks.uri_hash_ids.npy'), mmap_mode='r')
+
+
+    def __len__(self):
+        return self.meta['num_tracks']
+
+
+    @classmethod
+    def build(cls, directory, track_df):
+        """
+        Write a store for `track_df` (indexed by track_uri, with track_name, album_uri, album_name,
+        artist_uri, artist_name, duration_ms and optionally popularity columns) and open it.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+
+        track_uris = track_df.index.to_numpy()
+        columns = {'duration_ms': track_df['duration_ms'].to_numpy(),
+                   'popularity': track_df['popularity'].to_numpy() if 'popularity' in track_df.columns
+                                 else np.zeros(len(track_df))}
+
+        # Albums and artists become their own tables, referenced from tracks by ID
+        for kind, table in [('album', 'albums'), ('artist', 'artists')]:
+            group_ids, group_uris = pd.factorize(track_df[kind + '_uri'])
+            columns[kind + '_id'] = group_ids
+            first_rows = track_df.iloc[np.unique(group_ids[group_ids >= 0], return_index=True)[1]]
+            StringColumn.write(os.path.join(directory, f'{table}.{kind}_uri'), group_uris)
+            StringColumn.write(os.path.join(directory, f'{table}.{kind}_name'), first_rows[kind + '_name'])
+
+        for field, dtype in TRACK_NUMERIC_FIELDS.items():
+            np.save(os.path.join(directory, f'tracks.{field}.npy'), np.nan_to_num(columns[field]).astype(dtype))
+
+        StringColumn.write(os.path.join(directory, 'tracks.track_uri'), track_uris)
+        StringColumn.write(os.path.join(directory, 'tracks.track_name'), track_df['track_name'])
+
+        hashes = np.fromiter((uri_hash(uri) for uri in track_uris), dtype=np.uint64, count=len(track_uris))
+        order = np.argsort(hashes, kind='stable')
+        np.save(os.path.join(directory, 'tracks.uri_hash.npy'), hashes[order])
+        np.save(os.path.join(directory, 'tracks.uri_hash_ids.npy'), order.astype(np.int32))
+
+        with open(os.path.join(directory, 'meta.json'), 'w') as file:
+            json.dump({'num_tracks': len(track_uris),
+                       'num_albums': int(columns['album_id'].max(initial=-1)) + 1,
+                       'num_artists': int(columns['artist_id'].max(initial=-1)) + 1}, file)
+
+        return cls(directory)
+
+
+    def track_id(self, uri):
+        """Return the track ID of `uri`, or -1 if it is not in the store."""
+        h = np.uint64(uri_hash(uri))
+        position = int(np.searchsorted(self.uri_hashes, h))
+        # Check every track with this hash, in case of collisions
+        while position < len(self.uri_hashes) and self.uri_hashes[position] == h:
+            candidate = int(self.uri_hash_ids[position])
+            if self.strings['track_uri'][candidate] == uri:
+                return candidate
+            position += 1
+        return -1
+
+
+    def track_ids(self, uris):
+        """Return the track IDs of many URIs as an array, with -1 for URIs not in the store."""
+        return np.array([self.track_id(uri) for uri in uris], dtype=np.int64)
+
+
+    def get(self, track_id, feature='track_name'):
+        """Return one feature of one track."""
+
+        if feature in self.numeric:
+            return self.numeric[feature][track_id].item()
+        if feature in STRING_FIELDS['tracks']:
+            return self.strings[feature][track_id]
+
+        # Album / artist strings are stored once per album / artist
+        kind = self._group_kind(feature)
+        return self.strings[feature][int(self.numeric[kind + '_id'][track_id])]
+
+
+    def get_many(self, track_ids, features=('track_name',)):
+        """
+        Return a DataFrame of the requested features for an array of track IDs, one row per ID.
+        2-D arrays (e.g. recommend_batch(..., return_ids=True)) are flattened row by row, and
+        negative IDs (its -1 padding) give NaN for numeric features and None for string features.
+        """
+
+        track_ids = np.ravel(np.asarray(track_ids, dtype=np.int64))
+        valid = track_ids >= 0
+        ids = track_ids[valid]
+
+        result = {}
+        for feature in features:
+            if feature in self.numeric:
+                values = np.asarray(self.numeric[feature][ids])
+            elif feature in STRING_FIELDS['tracks']:
+                values = self.strings[feature].take(ids)
+            else:
+                kind = self._group_kind(feature)
+                values = self.strings[feature].take(np.asarray(self.numeric[kind + '_id'][ids]))
+            result[feature] = _fill_missing(values, valid)
+
+        return pd.DataFrame(result, index=track_ids)
+
+
+    def _group_kind(self, feature):
+        """Return 'album' or 'artist' for an album / artist string feature."""
+        kind = feature.split('_')[0]
+        if kind not in ('album', 'artist') or feature not in self.strings:
+            raise KeyError(f'Unknown track feature {feature!r}.')
+        return kind